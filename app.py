@@ -1,19 +1,27 @@
-import io
+import math
 import os
-import uuid
-import json
 import pathlib
 import tomllib
+import time
 
-from PIL import Image
-from typing import Any
-from datetime import datetime
+from typing import TYPE_CHECKING, Any
+from time import perf_counter_ns
 
-import cv2
-import pytesseract
-import pandas as pd
 import streamlit as st
 
+# light on purpose, every script run imports these; pandas and modules.ingest
+# (cv2, numpy, pytesseract) are imported where they're first needed
+import modules.summarizer as summarizer
+from modules import metrics
+from modules.index import TokenIndex
+from modules.jobs import ACTIVE, JobQueue
+from modules.store import MetadataStore
+
+if TYPE_CHECKING:
+    from modules.ingest import IngestWorker
+    from modules.server import LocalSummarizer, SummarizerClient
+    from modules.vectors import VectorIndex
+
 
 def configs() -> dict[str, Any]:
     """Load configs from local or make new."""
@@ -27,6 +35,23 @@ page_title = "HomeDocs"
 page_icon = ":shark:"
 layout = "centered"
 data_path_root = "data"
+gallery_page_size = 24
+# hextree levels, each one a hex digit of the file name, 16 ** depth leaf directories
+hextree_depth = 3
+# start the OCR processes and load the summarizer when the app starts, not at the first upload
+warm_up = true
+# ingest and T5 metrics for Prometheus on http://127.0.0.1:<port>/metrics, remove to turn off
+metrics_port = 9464
+
+[t5]
+# "auto" picks mlx on apple silicon and numpy everywhere else
+backend = "auto"
+# load weights from `python -m modules.convert --quantize int8` (or int4)
+# quantize = "int8"
+# summarize on `python -m modules.server` rather than loading the model in the app
+# server = "http://127.0.0.1:8765"
+# seconds the server may send nothing, while a request is queued or between deltas, before it fails
+# server_timeout = 600
 """
     if not os.path.exists("config.toml"):
         with open("config.toml", "w") as f:
@@ -38,180 +63,226 @@ data_path_root = "data"
     return data
 
 
-def show_thumbnails(root):
-    df_dir_map = pd.read_json(root + '/map.json').T
+@st.cache_data(max_entries=64)
+def load_page(root: str, revision: tuple, page: int, page_size: int) -> list[dict]:
+    """One page of documents, newest first, cached until the store's revision changes."""
+    return open_store(root).documents(limit=page_size, offset=page * page_size)
+
+
+@st.cache_data(max_entries=4096)
+def load_thumbnail(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def load_original(path: str) -> bytes:
+    # not cached, full resolution images are only read when asked for
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@st.cache_data(max_entries=32)
+def load_highlighted(path: str, words: list, query: str, transform: list = None, width: int = 1000):
+    """The photo with the words matching the query highlighted, from the OCR's word boxes."""
+    import cv2
+
+    from modules.ingest import decode_image
+    from modules.ocr import highlight, matching_words
+
+    img = highlight(decode_image(load_original(path)), matching_words(words, query), transform)
+    scale = min(1.0, width / img.shape[1])
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def show_thumbnails(root, uuids=None, page_size: int = 24, query: str = ''):
+    """Show one page of documents, all of them or the given search results."""
+    import pandas as pd
+
+    store = open_store(root)
+    revision = store.revision()
+    total = revision[0] if uuids is None else len(uuids)
+    if not total:
+        return
+
+    pages = math.ceil(total / page_size)
+    # the archive or the results may have shrunk since the page was picked
+    st.session_state['gallery_page'] = min(st.session_state.get('gallery_page', 1), pages)
+    page = st.number_input(f'Page of {pages}', min_value=1, max_value=pages, key='gallery_page') - 1
+    if uuids is None:
+        documents = load_page(root, revision, page, page_size)
+    else:
+        documents = store.get_many(uuids[page * page_size:(page + 1) * page_size])
+    # word boxes and stage timings are for highlighting and the diagnostics page
+    hidden = ['ocr_words', 'stage_timings', 'page']
+    df_dir_map = pd.DataFrame(documents).drop(columns=hidden, errors='ignore')
     st.dataframe(df_dir_map, use_container_width=True)
 
     ##### show thumbnails #####
     st.caption('Thumbnails')
-    for i in df_dir_map.iterrows():
-        with open(i[1]['thumbnail']) as f:
-            with st.container(border=True):
-                thumb_col1, thumb_col2 = st.columns([5, 2])
-                with thumb_col1:
-                    st.dataframe(i[1])
-                with thumb_col2:
-                    st.image(Image.open(i[1]["thumbnail"]), width=128, use_column_width="never")
-                    with open(i[1]["full_path"], "rb") as file:
-                        st.download_button(
-                            label="save",
-                            data=file,
-                            file_name=i[1]["original_filename"].split("/")[-1],
-                            mime=f"image/{i[1]['full_path'].split('/')[-1]}.split('.')[-1]",
-                            key=uuid.uuid4()
-                        )
-                    st.button("delete", key=uuid.uuid4())
-
-
-def generate_hextree(root: str):
-    """Generate a hex tree folder structure.
-    :param root:
-    """
-    for i in [hex(x)[2:] for x in range(0, 16)]:
-        for j in [hex(x)[2:] for x in range(0, 16)]:
-            for k in [hex(x)[2:] for x in range(0, 16)]:
-                os.makedirs(pathlib.PurePath(root, str(i), str(j), str(k)), exist_ok=True)
+    for doc in documents:
+        with st.container(border=True):
+            thumb_col1, thumb_col2 = st.columns([5, 2])
+            with thumb_col1:
+                st.dataframe(pd.Series(doc).drop(hidden, errors='ignore'))
+            with thumb_col2:
+                try:
+                    st.image(load_thumbnail(doc["thumbnail"]), width=128, use_column_width="never")
+                except FileNotFoundError:
+                    st.caption('no thumbnail')
+                download_key = f'download-{doc["uuid"]}'
+                if st.session_state.get(download_key):
+                    st.download_button(
+                        label="save",
+                        data=load_original(doc["full_path"]),
+                        file_name=doc["original_filename"].split("/")[-1],
+                        mime="image/jpeg",
+                        key=f'save-{doc["uuid"]}',
+                    )
+                else:
+                    st.button("save", key=f'prepare-{doc["uuid"]}',
+                              on_click=st.session_state.__setitem__, args=(download_key, True))
+                st.button("delete", key=f'delete-{doc["uuid"]}')
+            if query and doc.get("ocr_words") and st.toggle('highlight matches', key=f'matches-{doc["uuid"]}'):
+                transform = doc.get("page", {}).get("transform")
+                st.image(load_highlighted(doc["full_path"], doc["ocr_words"], query, transform), channels="BGR")
 
 
 def find_all_files(root):
-    import glob
-    files = glob.glob(f'{root}/**/*.jpg', recursive=True)
-    return files
+    from modules.ingest import find_images
 
+    # hextree directories only exist once something is written to them
+    return find_images(root)
 
-def query_hextree(filename: str):
-    """Query the data hex tree directory."""
-    # TODO: Store the set of all OCR'd words
-    # in a trie. The leaf node will map to
-    # the index of each document that contain
-    # the word.
 
-    pass
+@st.cache_resource
+def open_store(root: str) -> MetadataStore:
+    """Open the metadata store, moving an old map.json into it the first time."""
+    os.makedirs(root, exist_ok=True)
+    store = MetadataStore(os.path.join(root, 'metadata.db'))
+    map_root = os.path.join(root, 'map.json')
+    if os.path.exists(map_root):
+        store.migrate_map_json(map_root)
+    return store
 
 
-def map_hextree(root: str, map_path: str):
-    """Map the data hex tree."""
-    # TODO: Save a default map JSON if none exists
-    # TODO: The root is the data path root
-    # TODO: The map path is from the configs; path to JSON
+@st.cache_resource
+def open_index(root: str) -> TokenIndex:
+    """Open the token index, indexing what's in the store the first time."""
+    index = TokenIndex(os.path.join(root, 'index'))
+    if not len(index):
+        for doc in open_store(root).documents():
+            index.add(doc["uuid"], doc.get("ocr_string"), doc.get("tags"), doc.get("t5_summary"))
+        index.compact()
+    return index
 
-    if not os.path.exists(os.path.join(root, map_path)):
-        pass
+
+@st.cache_resource
+def open_vectors(root: str) -> "VectorIndex":
+    """Open the document embeddings, filled as documents are summarized."""
+    from modules.vectors import VectorIndex
+
+    return VectorIndex(os.path.join(root, 'vectors'))
 
 
-def preprocess_img_and_save(file_path):
-    # grayscale the image
-    # TODO: just do this operation on the bytes
-    img = cv2.imread(str(file_path))
-    # convert to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+@st.cache_resource
+def open_summarizer(url: str = None, timeout: float = 600.0) -> "LocalSummarizer | SummarizerClient":
+    """The summarization server at ``url``, or the model loaded in this process without one."""
+    from modules.server import LocalSummarizer, SummarizerClient
 
-    # apply adaptive threshold on gray img
-    threshold = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 15)
+    return SummarizerClient(url, timeout) if url else LocalSummarizer()
 
-    # apply white where threshold is white to a copy
-    result = img.copy()
-    result[threshold == 255] = (255, 255, 255)
 
-    # save the copy
-    cv2.imwrite(str(file_path), threshold)
+def query_meaning(root: str, query: str, k: int = 24) -> list[str]:
+    """Uuids of the documents nearest the query in meaning, by their T5 embeddings."""
+    vectors = open_vectors(root)
+    if not len(vectors):
+        return []
+    # the worker thread summarizes with the same model, a local embed waits for its current step or batch
+    t5 = config.get('t5', {})
+    embedding = open_summarizer(t5.get('server'), t5.get('server_timeout', 600.0)).embed([query])[0]
+    return [uuid for uuid, _ in vectors.search(embedding, k)]
 
 
-def generate_thumbnail_bytes(root, thumb_root: str, data: bytes) -> str:
-    """Generate thumbnails.
+def query_hextree(root: str, query: str) -> list[str]:
+    """Uuids of the documents containing every word of the query, newest first.
 
-    :returns: thumbnail uuid + \".jpg\""""
-    os.makedirs(os.path.join(root, thumb_root), exist_ok=True)
+    Words match as prefixes of the OCR'd text, tags and summary."""
+    return open_index(root).search(query)
 
-    size = (128, 128)
-    thumb_uuid = str(uuid.uuid4())
 
-    with Image.open(io.BytesIO(data)) as f:
-        f.thumbnail(size)
-        f.save(os.path.join(root, thumb_root, thumb_uuid + ".jpg"), "JPEG")
+def map_hextree(root: str, map_path: str):
+    """Map the data hex tree."""
+    # TODO: Save a default map JSON if none exists
+    # TODO: The root is the data path root
+    # TODO: The map path is from the configs; path to JSON
+
+    if not os.path.exists(os.path.join(root, map_path)):
+        pass
 
-    # returns the path to the thumbnail as str
-    return str(os.path.join(root, thumb_root, thumb_uuid)) + ".jpg"
 
+@st.cache_resource
+def open_queue(root: str) -> JobQueue:
+    os.makedirs(root, exist_ok=True)
+    return JobQueue(os.path.join(root, 'metadata.db'))
 
-def generate_thumbnail_from_file(root, thumb_root: str, file_path: pathlib.Path) -> str:
-    """Generate thumbnails.
 
-    Arguments
-    ---------
-    file_path : pathlib.Path - The path-like object to the file, for thumb-nailing.
+@st.cache_resource
+def open_worker(root: str) -> "IngestWorker":
+    """Start the background OCR and summarizer workers, once per server."""
+    from modules.ingest import IngestWorker
 
-    :returns: thumbnail uuid + \".jpg\""""
-    os.makedirs(os.path.join(root, thumb_root), exist_ok=True)
-    size = (128, 128)
-    thumb_uuid = str(uuid.uuid4())
+    t5 = config.get('t5', {})
+    return IngestWorker(
+        root, open_queue(root), open_store(root), open_index(root),
+        warm_up=config['app'].get('warm_up', False), vectors=open_vectors(root),
+        service=open_summarizer(t5.get('server'), t5.get('server_timeout', 600.0)),
+    )
 
-    with Image.open(file_path) as f:
-        f.thumbnail(size)
-        f.save(os.path.join(root, thumb_root, thumb_uuid + ".jpg"), "JPEG")
 
-    # returns the path to the thumbnail as str
-    return str(os.path.join(root, thumb_root, thumb_uuid)) + ".jpg"
+@st.cache_resource
+def serve_metrics(port: int) -> int:
+    """Serve the ingest and T5 metrics for Prometheus, once per server."""
+    return metrics.serve(port)
 
 
 def scan_image(root: str, data: bytes, metadata: dict):
-    """Save an image to hex tree directory."""
-    new_uid = uuid.uuid4()
-    _file = str(new_uid) + ".jpg"
-    metadata["uuid"] = str(new_uid)
-    metadata["extension"] = ".jpg"
-    _first = _file[0]
-    _second = _file[1]
-    _third = _file[2]
-    file_path = pathlib.Path(root, _first, _second, _third, _file)
-    metadata["full_path"] = str(file_path)
-    metadata["upload_time"] = datetime.isoformat(datetime.utcnow())
-    metadata["upload_time_zone"] = "utc"
-
-    with open(file_path, "wb") as img:
-        img.write(data)
-
-    # scan, preprocess, map, thumbnail, and save the img
-    preprocess_img_and_save(file_path)
-    metadata["thumbnail"] = generate_thumbnail_from_file(root, 'previews', file_path)
-
-    # generate OCR with tesseract
-    ocr_str = pytesseract.image_to_string(Image.open(str(file_path)))
-    metadata["ocr_string"] = ocr_str
-
-    # # some text cleaning
-    # from nltk.corpus import stopwords
-    #
-    # def remove_stopwords(tokens):
-    #     stop_words = set(stopwords.words('english'))
-    #     filtered_tokens = [word for word in tokens if word not in stop_words]
-    #     return filtered_tokens
-    # # TODO: test removing stop words
-
-    # t5 inference here
-    import modules.t5 as t5
-    metadata["t5_summary"] = t5.summarize(ocr_str)
-
-    # create new empty database mapping if not exist
-    map_root = str(pathlib.Path(root, 'map.json'))
-    if not os.path.exists(map_root):
-        with open(map_root, "w") as f:
-            json.dump({}, f)
-
-    # read in database mapping
-    with open(map_root, "r") as map_file:
-        map_data = json.load(map_file)
-
-    map_data[len(map_data.keys())] = metadata
-
-    with open(map_root, "w") as map_file:
-        json.dump(map_data, map_file)
-
-    st.success(f'Wrote image to hex: {file_path}')
+    """Save an image to hex tree directory and queue it for OCR and summarizing."""
+    from modules.ingest import save_upload
+
+    metadata = save_upload(root, data, metadata, config['app'].get('hextree_depth', 3))
+    if open_store(root).with_hash(metadata["sha256"]):
+        st.info(f'Already have {metadata["original_filename"]}, its OCR and summary are reused.')
+    open_queue(root).enqueue(metadata)
+    open_worker(root).notify()
+    st.success(f'Wrote image to hex: {metadata["full_path"]}')
+
+
+def show_jobs(root) -> bool:
+    """List documents still being processed, and failed ones.
+
+    :returns: whether any are still in progress
+    """
+    jobs = open_queue(root).jobs(statuses=(*ACTIVE, 'failed'))
+    if not jobs:
+        return False
+    st.caption('Processing')
+    for job in jobs:
+        with st.container(border=True):
+            st.write(f'{job["data"]["original_filename"]}: **{job["status"]}**')
+            if job["data"].get("partial_summary"):
+                st.info(job["data"]["partial_summary"])
+            if job["status"] == 'failed':
+                st.code(job["error"])
+                if st.button('retry', key=f'retry-{job["id"]}'):
+                    open_queue(root).retry(job["id"])
+                    open_worker(root).notify()
+                    st.rerun()
+    return any(job["status"] in ACTIVE for job in jobs)
 
 
 config = configs()
 DATA_PATH_ROOT = config['app']['data_path_root']
+summarizer.configure(**config.get('t5', {}))
 
 st.set_page_config(
     page_title=config['app']['page_title'],
@@ -219,29 +290,54 @@ st.set_page_config(
     layout=config['app']['layout'],
 )
 
-if not os.path.exists(DATA_PATH_ROOT):
-    generate_hextree(DATA_PATH_ROOT)
+if config['app'].get('metrics_port'):
+    try:
+        serve_metrics(config['app']['metrics_port'])
+    except OSError as e:
+        st.warning(f"Metrics aren't served on port {config['app']['metrics_port']}: {e}")
+
+os.makedirs(DATA_PATH_ROOT, exist_ok=True)
 
 st.header('Docs uploader')
 st.subheader('Upload')
 upload_col1, upload_col2 = st.columns([5, 2])
-st_file_uploader = st.file_uploader('New image', type='jpg', accept_multiple_files=False)
+st_file_uploader = st.file_uploader('New images', type=['jpg', 'jpeg'], accept_multiple_files=True)
 st_file_uploader_description = st.text_input('Manual tags', placeholder='\"2023 1099 tax form\"...')
 st_file_uploader_submit = st.button('Upload')
 st.divider()
 
-# upload an image to the database
+# upload images to the database, each one is queued and processed in the background
 if st_file_uploader_submit:
-    bytes_data = st_file_uploader.getvalue()
-
-    attach_metadata = dict(
-        original_filename=st_file_uploader.name,
-        tags=st_file_uploader_description,
-    )
-    scan_image(DATA_PATH_ROOT, bytes_data, attach_metadata)
+    for uploaded_file in st_file_uploader:
+        attach_metadata = dict(
+            original_filename=uploaded_file.name,
+            tags=st_file_uploader_description,
+        )
+        scan_image(DATA_PATH_ROOT, uploaded_file.getvalue(), attach_metadata)
+
+##### search #####
+st.subheader('Search')
+search_col1, search_col2 = st.columns([5, 1])
+st_search = search_col1.text_input('Search', placeholder='\"1099 tax\"...', label_visibility='collapsed')
+st_semantic = search_col2.toggle('by meaning', help='"the insurance letter", nearest documents by their T5 embeddings')
+search_results = None
+if st_search:
+    search_start = perf_counter_ns()
+    if st_semantic:
+        search_results = query_meaning(DATA_PATH_ROOT, st_search, config['app'].get('gallery_page_size', 24))
+    else:
+        search_results = query_hextree(DATA_PATH_ROOT, st_search)
+    st.caption(f'{len(search_results)} documents in {(perf_counter_ns() - search_start) / 1.0e6:.2f} ms')
 
 ##### metadata and display #####
+open_worker(DATA_PATH_ROOT)
+processing = show_jobs(DATA_PATH_ROOT)
 try:
-    show_thumbnails(DATA_PATH_ROOT)
+    show_thumbnails(DATA_PATH_ROOT, search_results, config['app'].get('gallery_page_size', 24), st_search)
 except FileNotFoundError:
     pass
+
+# poll while documents are processing, they show up as they finish
+if processing:
+    time.sleep(1)
+    st.rerun()
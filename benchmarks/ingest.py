@@ -0,0 +1,167 @@
+"""Per-stage time and peak memory of ingesting one document image.
+
+Renders a synthetic letter-size page, JPEG encodes it like an upload, and runs
+it through the ingest pipeline (decode once, shared arrays) and through the
+file based pipeline it replaced (write, re-read, copy, overwrite, re-open for
+the thumbnail and again for OCR). From the repo root:
+
+    python -m benchmarks.ingest --dpi 300
+
+OCR is timed when the tesseract binary is on the PATH. Peak memory is what
+``tracemalloc`` sees NumPy allocate in each stage, plus the process's maximum
+resident set size at the end.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import tracemalloc
+import uuid
+from time import perf_counter_ns
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from modules import ingest
+from modules.ocr import read as read_blocks
+from modules.page import flatten
+
+
+def synthetic_page(dpi: int = 300, lines: int = 40, seed: int = 0) -> bytes:
+    """JPEG bytes of a letter-size page of typewritten looking lines."""
+    rng = np.random.default_rng(seed)
+    width, height = int(8.5 * dpi), int(11 * dpi)
+    page = np.full((height, width, 3), 245, dtype=np.uint8)
+    page += rng.integers(0, 10, page.shape, dtype=np.uint8)  # paper grain for the JPEG to chew on
+    words = ["invoice", "total", "1099-misc", "payment", "due", "account", "2023", "tax", "form", "amount"]
+    scale = dpi / 150
+    for i in range(lines):
+        text = " ".join(rng.choice(words, 8))
+        y = int((i + 2) * height / (lines + 4))
+        cv2.putText(page, text, (int(0.5 * dpi), y), cv2.FONT_HERSHEY_SIMPLEX, scale, (20, 20, 20), max(1, int(scale * 2)))
+    ok, encoded = cv2.imencode(".jpg", page, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+
+class Stages:
+    """Collects ``{stage: {"seconds", "peak_bytes"}}`` from ``with stages("name"):`` blocks."""
+
+    def __init__(self):
+        self.results = {}
+        self._name = None
+
+    def __call__(self, name: str):
+        self._name = name
+        return self
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        self._start = perf_counter_ns()
+
+    def __exit__(self, *exc):
+        seconds = (perf_counter_ns() - self._start) / 1.0e9
+        peak = tracemalloc.get_traced_memory()[1] - self._base
+        self.results[self._name] = {"seconds": seconds, "peak_bytes": peak}
+
+
+def pipeline(root: str, data: bytes, ocr: bool) -> dict:
+    stages = Stages()
+    file_path = os.path.join(root, str(uuid.uuid4()) + ".jpg")
+    with stages("write_original"):
+        with open(file_path, "wb") as f:
+            f.write(data)
+    with stages("decode"):
+        img = ingest.decode_image(data)
+    with stages("flatten"):
+        img, _ = flatten(img)
+    with stages("threshold"):
+        threshold = ingest.threshold_image(img)
+        cv2.imwrite(os.path.splitext(file_path)[0] + ".threshold.png", threshold)
+    with stages("thumbnail"):
+        ingest.generate_thumbnail_array(file_path, img)
+    del img
+    if ocr:
+        with stages("ocr"):
+            read_blocks(threshold)
+    return stages.results
+
+
+def legacy_pipeline(root: str, data: bytes, ocr: bool) -> dict:
+    """The pipeline before ingest decoded once, kept here for comparison."""
+    stages = Stages()
+    file_path = os.path.join(root, str(uuid.uuid4()) + ".jpg")
+    with stages("write_original"):
+        with open(file_path, "wb") as f:
+            f.write(data)
+    with stages("decode"):
+        img = cv2.imread(file_path)
+    with stages("threshold"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        threshold = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 15)
+        result = img.copy()
+        result[threshold == 255] = (255, 255, 255)
+        cv2.imwrite(file_path, threshold)
+    del img, gray, result, threshold
+    with stages("thumbnail"):
+        os.makedirs(os.path.join(root, "previews"), exist_ok=True)
+        with Image.open(file_path) as f:
+            f.thumbnail((128, 128))
+            f.save(os.path.join(root, "previews", str(uuid.uuid4()) + ".jpg"), "JPEG")
+    if ocr:
+        import pytesseract
+        with stages("ocr"):
+            pytesseract.image_to_string(Image.open(file_path))
+    return stages.results
+
+
+def total(results: dict) -> dict:
+    return {
+        "seconds": sum(r["seconds"] for r in results.values()),
+        "peak_bytes": max(r["peak_bytes"] for r in results.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--no-ocr", action="store_true")
+    args = parser.parse_args()
+
+    ocr = not args.no_ocr and shutil.which("tesseract") is not None
+    data = synthetic_page(args.dpi)
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as root:
+        for name, run in (("pipeline", pipeline), ("legacy", legacy_pipeline)):
+            run(root, data, ocr)  # warm up
+            runs = [run(root, data, ocr) for _ in range(args.repeat)]
+            stages = {
+                stage: {
+                    "seconds": min(r[stage]["seconds"] for r in runs),
+                    "peak_bytes": max(r[stage]["peak_bytes"] for r in runs),
+                }
+                for stage in runs[0]
+            }
+            print(json.dumps({
+                "benchmark": "ingest",
+                "pipeline": name,
+                "dpi": args.dpi,
+                "upload_bytes": len(data),
+                "ocr": ocr,
+                "stages": stages,
+                "total": total(stages),
+            }))
+
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    print(json.dumps({"benchmark": "ingest", "max_rss_bytes": maxrss}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""OCR time and accuracy with and without auto-crop, deskew and DPI normalization.
+
+Renders pages of known text with PIL (see ``benchmarks.suite``) and turns them
+into the kinds of image people upload:
+- a flat scan
+- a scan a few degrees off
+- phone photos of the page on a dark table, shot at an angle and turned
+
+Each image is thresholded and OCR'd as it is and after ``modules.page.flatten``.
+The runs report the seconds of each stage, the megapixels tesseract was given
+and, when the tesseract binary is on the PATH, accuracy against the known text.
+The skew left on the flattened page and how far the found page corners are
+from the true ones are reported either way. From the repo root:
+
+    python -m benchmarks.page
+"""
+
+import argparse
+import json
+import shutil
+from time import perf_counter_ns
+
+import cv2
+import numpy as np
+
+from benchmarks.suite import accuracy, document_text, synthetic_document
+from modules import ingest, page
+from modules.ocr import read as read_blocks
+
+# name, degrees turned counterclockwise, keystone (top edge narrower by), on a table
+CASES = (
+    ("scan", 0.0, 0.0, False),
+    ("skewed_scan", 4.0, 0.0, False),
+    ("photo", 0.0, 0.08, True),
+    ("skewed_photo", 6.0, 0.06, True),
+)
+
+
+def synthetic_photo(
+    page_img: np.ndarray, angle: float, keystone: float, table: bool,
+    frame: tuple = (3024, 4032), seed: int = 0,
+) -> tuple:
+    """JPEG bytes of ``page_img`` turned and keystoned, and where its corners ended up.
+
+    On a ``table`` the page fills 80% of a phone sized ``frame`` over a dark,
+    noisy background, otherwise it's a scan the size of the page with a white
+    lid around it.
+    """
+    rng = np.random.default_rng(seed)
+    page_h, page_w = page_img.shape[:2]
+    src = np.float32([[0, 0], [page_w, 0], [page_w, page_h], [0, page_h]])
+    if table:
+        width, height = frame
+        k = 0.8 * min(width / page_w, height / page_h)
+        background = np.clip(rng.normal((60, 75, 95), 18, (height, width, 3)), 0, 255).astype(np.uint8)
+    else:
+        width, height, k = page_w, page_h, 1.0
+        background = np.full((height, width, 3), 255, dtype=np.uint8)
+    w, h = page_w * k, page_h * k
+    shrink = keystone * w / 2
+    dst = np.float32([[shrink, 0], [w - shrink, 0], [w, h], [0, h]]) - (w / 2, h / 2)
+    theta = np.radians(angle)
+    turn = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
+    dst = (dst @ turn.T + (width / 2, height / 2)).astype(np.float32)
+    photo = cv2.warpPerspective(
+        page_img, cv2.getPerspectiveTransform(src, dst), (width, height),
+        dst=background, borderMode=cv2.BORDER_TRANSPARENT,
+    )
+    ok, encoded = cv2.imencode(".jpg", photo, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes(), dst
+
+
+def timed(fn, *args):
+    start = perf_counter_ns()
+    result = fn(*args)
+    return result, (perf_counter_ns() - start) / 1.0e9
+
+
+def run(data: bytes, text: str, corrected: bool, ocr: bool) -> dict:
+    seconds = {}
+    img, seconds["decode"] = timed(ingest.decode_image, data)
+    info = None
+    if corrected:
+        (img, info), seconds["flatten"] = timed(page.flatten, img)
+    threshold, seconds["threshold"] = timed(ingest.threshold_image, img)
+    results = {"megapixels": threshold.size / 1.0e6, "seconds": seconds}
+    # measured on the page tesseract gets, up to 45 degrees so a wrong turn shows
+    results["skew_degrees"] = page.skew_angle(ingest.grayscale(img), max_skew=45.0)
+    if ocr:
+        (read, _), seconds["ocr"] = timed(read_blocks, threshold)
+        results["accuracy"] = accuracy(text, read)
+    results["total_seconds"] = sum(seconds.values())
+    return results, info, img.shape[:2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dpi", type=int, default=300, help="of the rendered page")
+    parser.add_argument("--no-ocr", action="store_true")
+    args = parser.parse_args()
+
+    ocr = not args.no_ocr and shutil.which("tesseract") is not None
+    text = document_text(np.random.default_rng(0))
+    page_img = ingest.decode_image(synthetic_document(text, args.dpi))
+    for name, angle, keystone, table in CASES:
+        data, corners = synthetic_photo(page_img, angle, keystone, table)
+        before, _, _ = run(data, text, False, ocr)
+        after, info, (height, width) = run(data, text, True, ocr)
+        results = {
+            "benchmark": "page",
+            "case": name,
+            "ocr": ocr,
+            "as_uploaded": before,
+            "flattened": after,
+            "found": info["found"],
+            "skew": info["skew"],
+            "residual_skew_degrees": after["skew_degrees"],
+            "scale": info["scale"],
+        }
+        if table and info["found"]:
+            back = page.to_photo(info["transform"], np.float32([[0, 0], [width, 0], [width, height], [0, height]]))
+            results["corner_error_px"] = float(np.linalg.norm(back - corners, axis=1).mean())
+        print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
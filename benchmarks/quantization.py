@@ -0,0 +1,69 @@
+"""Accuracy and size of quantized T5 weights against the unquantized model.
+
+Quantizes a tiny, randomly initialized T5 with ``modules.quantize`` and compares
+logits for the same inputs. From the repo root:
+
+    python -m benchmarks.quantization --backend numpy
+"""
+
+import argparse
+import json
+
+import numpy as np
+
+from benchmarks.t5_decode import array_ops, tiny_config
+from modules import quantize, summarizer
+
+
+def state_dict(backend_name: str, model) -> dict:
+    """``{name: np.ndarray}`` of a model's weights, the shape ``convert.py`` writes."""
+    if backend_name == "mlx":
+        from mlx.utils import tree_flatten
+        return {k: np.array(v) for k, v in tree_flatten(model.parameters())}
+    return dict(model.parameters())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", default="auto", choices=["auto", *summarizer.BACKENDS])
+    parser.add_argument("--group-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--d-model", type=int, default=256)
+    args = parser.parse_args()
+
+    backend_name = summarizer.default_backend() if args.backend == "auto" else args.backend
+    t5 = summarizer.backend(backend_name)
+    asarray, _, evaluate = array_ops(backend_name)
+
+    config = tiny_config(args.layers, args.d_model)
+    t5.seed(0)
+    model = t5.T5(config)
+    rng = np.random.default_rng(0)
+    inputs = asarray(rng.integers(0, config.vocab_size, (4, 128)))
+    decoder_inputs = asarray(rng.integers(0, config.vocab_size, (4, 16)))
+    reference = np.array(model(inputs, decoder_inputs), dtype=np.float32)
+    weights = state_dict(backend_name, model)
+
+    for mode in ("int8", "int4"):
+        quantized = t5.T5(config)
+        t5.load_weights(quantized, quantize.quantize_weights(weights, mode, args.group_size))
+        logits = quantized(inputs, decoder_inputs)
+        evaluate(logits)
+        logits = np.array(logits, dtype=np.float32)
+
+        error = np.abs(logits - reference)
+        print(json.dumps({
+            "benchmark": "quantization",
+            "backend": backend_name,
+            "mode": mode,
+            "group_size": args.group_size if mode == "int4" else None,
+            "nbytes": t5.model_nbytes(quantized),
+            "float32_nbytes": t5.model_nbytes(model),
+            "max_abs_error": float(error.max()),
+            "relative_error": float(np.linalg.norm(logits - reference) / np.linalg.norm(reference)),
+            "top1_agreement": float((logits.argmax(-1) == reference.argmax(-1)).mean()),
+        }))
+
+
+if __name__ == "__main__":
+    main()
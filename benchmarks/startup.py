@@ -0,0 +1,79 @@
+"""Import time of the app's startup, and of the modules it defers.
+
+Runs ``python -X importtime`` in a fresh interpreter on the modules ``app.py``
+imports at the top, which every first script run pays for, then once more for
+each module the app only imports when it's needed. From the repo root:
+
+    python -m benchmarks.startup
+
+Prints one JSON object per measurement with the cumulative seconds and the
+slowest imports under it, so a heavy import creeping back into startup shows
+up in the diff. Modules that aren't installed are listed as ``missing``.
+"""
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported inside the functions that use them, see app.py
+DEFERRED = ("pandas", "modules.ingest", "modules.tokenizer", "modules.t5_numpy", "modules.t5")
+
+
+def startup_imports(path: str = os.path.join(ROOT, "app.py")) -> list:
+    """Modules imported at the top level of ``path``, in order."""
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def import_time(modules: list, top: int = 10) -> dict:
+    """Import ``modules`` in a fresh interpreter and parse its ``-X importtime`` report."""
+    code = "\n".join(
+        ["missing = []"]
+        + [f"try:\n    import {m}\nexcept ImportError:\n    missing.append({m!r})" for m in modules]
+        + ["print(missing)"]
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    # "import time: self [us] | cumulative | imported package", nesting indents the name
+    timings = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings.append((name.rstrip()[1:], int(cumulative)))
+    top_level = [(name, us) for name, us in timings if not name.startswith(" ")]
+    slowest = sorted(((name.strip(), us) for name, us in timings), key=lambda t: -t[1])[:top]
+    return {
+        "seconds": sum(us for _, us in top_level) / 1.0e6,
+        "slowest": [{"module": name, "seconds": us / 1.0e6} for name, us in slowest],
+        "missing": ast.literal_eval(proc.stdout.strip().splitlines()[-1]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    args = parser.parse_args()
+
+    modules = startup_imports()
+    print(json.dumps({"benchmark": "startup", "imports": "app", "modules": modules, **import_time(modules, args.top)}))
+    for module in DEFERRED:
+        print(json.dumps({"benchmark": "startup", "imports": module, **import_time([module], args.top)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Every ingest stage, alone and end to end, as the archive grows.
+
+Renders synthetic document pages with known text using PIL, then scans them
+into an archive that is filled to each of ``--sizes`` documents with synthetic
+metadata. Each scan times the stages one at a time:
+
+- save_upload
+- decode, flatten, threshold, thumbnail, dhash and OCR
+- flag_duplicates, the store insert and the index update
+- a search and a gallery page
+- for comparison, the old OCR, which read the whole page in one call
+
+The whole scan is also timed end to end. Timings come from scans without
+``tracemalloc``, which slows Python code down a lot. Peak memory comes from one
+more scan with it on. When the tesseract binary is on the PATH, OCR is
+included and both readings are scored against the known text. Last, the tiny random T5 of
+``benchmarks.t5_decode`` is run. From the repo root:
+
+    python -m benchmarks.suite --sizes 1000 10000 100000
+
+Prints one JSON object per archive size, plus one for T5, so runs can be diffed
+across commits.
+"""
+
+import argparse
+import difflib
+import io
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+from statistics import median
+from time import perf_counter_ns
+from typing import Optional
+
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image, ImageDraw, ImageFont
+
+from benchmarks import t5_decode
+from benchmarks.ingest import Stages
+from modules import ingest, ocr as layout
+from modules.index import TokenIndex
+from modules.page import flatten
+from modules.store import MetadataStore
+
+WORDS = (
+    "invoice total payment due account tax form amount balance statement interest"
+    " dividends wages employer federal state refund receipt deposit insurance policy"
+    " premium mortgage property utility electric water medical claim pharmacy"
+).split()
+
+
+def document_text(rng: np.random.Generator, lines: int = 30, words: int = 8) -> str:
+    """Known text for a page, common words with a few form numbers and amounts."""
+    vocabulary = WORDS + ["1099-misc", "1098-t", "w-2", "2023", "2024"]
+    return "\n".join(
+        " ".join([*rng.choice(vocabulary, words - 1), f"{rng.integers(1, 10000)}.{rng.integers(0, 100):02d}"])
+        for _ in range(lines)
+    )
+
+
+def synthetic_document(text: str, dpi: int = 200) -> bytes:
+    """JPEG bytes of a letter-size page with ``text`` typed on it, one line per line."""
+    width, height = int(8.5 * dpi), int(11 * dpi)
+    page = Image.new("L", (width, height), 250)
+    draw = ImageDraw.Draw(page)
+    font = ImageFont.load_default(size=dpi // 6)
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        draw.text((dpi // 2, dpi // 2 + i * (height - dpi) // len(lines)), line, fill=20, font=font)
+    buffer = io.BytesIO()
+    page.convert("RGB").save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def synthetic_metadata(rng: np.random.Generator, upload_time: datetime) -> dict:
+    """Metadata of a document that was never rendered, to fill the archive."""
+    text = " ".join(rng.choice(WORDS, 30)) + " " + " ".join(str(n) for n in rng.integers(0, 100000, 5))
+    return {
+        "uuid": str(uuid.UUID(bytes=rng.bytes(16), version=4)),
+        "original_filename": "synthetic.jpg",
+        "tags": " ".join(rng.choice(WORDS, 2)),
+        "sha256": rng.bytes(32).hex(),
+        "dhash": rng.bytes(8).hex(),
+        "upload_time": datetime.isoformat(upload_time),
+        "upload_time_zone": "utc",
+        "ocr_string": text,
+        "t5_summary": " ".join(rng.choice(WORDS, 12)),
+    }
+
+
+def grow(store: MetadataStore, index: TokenIndex, size: int, rng: np.random.Generator, batch: int = 5000):
+    """Add synthetic documents until the archive holds ``size``."""
+    start = datetime(2020, 1, 1) + timedelta(minutes=len(store))
+    while len(store) < size:
+        documents = [
+            synthetic_metadata(rng, start + timedelta(minutes=i))
+            for i in range(min(batch, size - len(store)))
+        ]
+        start += timedelta(minutes=len(documents))
+        store.add_many(documents)
+        index.add_many((d["uuid"], d["ocr_string"], d["tags"], d["t5_summary"]) for d in documents)
+    index.compact()
+
+
+def accuracy(text: str, read: str) -> float:
+    return difflib.SequenceMatcher(None, " ".join(text.split()), " ".join(read.split())).ratio()
+
+
+def scan(
+    root: str, store: MetadataStore, index: TokenIndex, data: bytes, text: str, ocr: bool,
+    ocr_threads: Optional[int] = None,
+) -> dict:
+    """Scan one page as the ingest worker would, minus summarizing, timing each stage."""
+    stages = Stages()
+    start = perf_counter_ns()
+    with stages("save_upload"):
+        metadata = ingest.save_upload(root, data, dict(original_filename="page.jpg", tags="benchmark"))
+    file_path = metadata["full_path"]
+    with stages("decode"):
+        img = ingest.decode_image(data)
+    with stages("flatten"):
+        img, metadata["page"] = flatten(img)
+        gray = ingest.grayscale(img)
+    with stages("threshold"):
+        threshold = ingest.threshold_image(gray)
+        cv2.imwrite(os.path.splitext(file_path)[0] + ingest.THRESHOLD_SUFFIX, threshold)
+    with stages("thumbnail"):
+        metadata["thumbnail"] = ingest.generate_thumbnail_array(file_path, img)
+    with stages("dhash"):
+        metadata["dhash"] = ingest.dhash(gray)
+    del img, gray
+    metadata["ocr_string"] = ""
+    if ocr:
+        with stages("ocr"):
+            metadata["ocr_string"], metadata["ocr_words"] = layout.read(threshold, ocr_threads)
+    metadata["t5_summary"] = ""
+    with stages("flag_duplicates"):
+        ingest.flag_duplicates(store, metadata)
+    with stages("store_add"):
+        store.add(metadata)
+    with stages("index_add"):
+        index.add(metadata["uuid"], metadata["ocr_string"], metadata["tags"], metadata["t5_summary"])
+    end_to_end = (perf_counter_ns() - start) / 1.0e9
+
+    query = " ".join(text.split()[:2])
+    with stages("search"):
+        index.search(query)
+    with stages("gallery_page"):
+        store.documents(limit=24)
+
+    results = {"stages": stages.results, "end_to_end_seconds": end_to_end}
+    if ocr:
+        with stages("ocr_whole_page"):
+            whole_page = pytesseract.image_to_string(threshold)
+        results["ocr_accuracy"] = accuracy(text, metadata["ocr_string"])
+        results["ocr_whole_page_accuracy"] = accuracy(text, whole_page)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="archive sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="pages scanned at each size")
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--no-ocr", action="store_true")
+    parser.add_argument("--ocr-threads", type=int, default=None, help="every core by default")
+    parser.add_argument("--no-t5", action="store_true")
+    parser.add_argument("--backend", default="auto", help="T5 backend")
+    args = parser.parse_args()
+
+    ocr = not args.no_ocr and shutil.which("tesseract") is not None
+    rng = np.random.default_rng(0)
+    # one more page than repeats, for the scan under tracemalloc
+    texts = [document_text(rng) for _ in range(args.repeat + 1)]
+    pages = [synthetic_document(text, args.dpi) for text in texts]
+
+    with tempfile.TemporaryDirectory() as root:
+        store = MetadataStore(os.path.join(root, "metadata.db"))
+        # compacted once per size by grow, not every thousand documents on the way
+        index = TokenIndex(os.path.join(root, "index"), compact_every=2 ** 62)
+        for size in sorted(args.sizes):
+            start = perf_counter_ns()
+            grow(store, index, size, rng)
+            grow_seconds = (perf_counter_ns() - start) / 1.0e9
+
+            runs = [
+                scan(root, store, index, data, text, ocr, args.ocr_threads)
+                for data, text in zip(pages[1:], texts[1:])
+            ]
+            tracemalloc.start()
+            peaks = scan(root, store, index, pages[0], texts[0], ocr, args.ocr_threads)["stages"]
+            tracemalloc.stop()
+            results = {
+                "benchmark": "suite",
+                "archive_size": size,
+                "grow_seconds": grow_seconds,
+                "dpi": args.dpi,
+                "ocr": ocr,
+                "stages": {
+                    stage: {
+                        "seconds": median(r["stages"][stage]["seconds"] for r in runs),
+                        "peak_bytes": peaks[stage]["peak_bytes"],
+                    }
+                    for stage in runs[0]["stages"]
+                },
+                "end_to_end_seconds": median(r["end_to_end_seconds"] for r in runs),
+            }
+            if ocr:
+                results["ocr_threads"] = args.ocr_threads or os.cpu_count()
+                results["ocr_accuracy"] = median(r["ocr_accuracy"] for r in runs)
+                results["ocr_whole_page_accuracy"] = median(r["ocr_whole_page_accuracy"] for r in runs)
+            print(json.dumps(results), flush=True)
+
+    if not args.no_t5:
+        print(json.dumps(t5_decode.run(args.backend, source_len=512, steps=50)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Decode throughput of the T5 backends on a tiny, randomly initialized T5.
+
+Runs without the converted t5-3b weights. From the repo root:
+
+    python -m benchmarks.t5_decode --backend numpy --source-len 512 --steps 100
+"""
+
+import argparse
+import json
+from time import perf_counter_ns
+
+import numpy as np
+from transformers import T5Config
+
+from modules import summarizer
+
+
+def tiny_config(num_layers: int = 4, d_model: int = 256, num_heads: int = 8) -> T5Config:
+    return T5Config(
+        vocab_size=1024,
+        d_model=d_model,
+        d_kv=d_model // num_heads,
+        d_ff=d_model * 4,
+        num_layers=num_layers,
+        num_heads=num_heads,
+        feed_forward_proj="relu",
+        decoder_start_token_id=0,
+        tie_word_embeddings=True,
+    )
+
+
+def array_ops(backend_name: str):
+    """``(asarray, argmax, evaluate)`` for a backend, MLX is lazy so it needs an explicit eval."""
+    if backend_name == "mlx":
+        import mlx.core as mx
+        return mx.array, lambda a: mx.argmax(a, axis=-1), mx.eval
+    return np.asarray, lambda a: np.argmax(a, axis=-1), lambda *a: None
+
+
+def decode(model, memory, steps: int, reproject: bool, ops):
+    """Greedy decode ``steps`` tokens, returns tokens/sec and the final cache.
+
+    With ``reproject`` the cross-attention keys/values are projected from the
+    encoder output again before every step, which is what the decoder did before
+    they were kept in the cache.
+    """
+    asarray, argmax, evaluate = ops
+    cache = model.decoder.make_cache(memory, steps)
+    y = asarray([[0]])
+    start = perf_counter_ns()
+    for _ in range(steps):
+        if reproject:
+            cache.memory_kv = model.decoder.project_memory(memory)
+        logits, cache = model.decode(y, memory, cache=cache)
+        y = argmax(logits[:, -1, :])[:, None]
+        evaluate(y)
+    return steps / ((perf_counter_ns() - start) / 1.0e9), cache
+
+
+def run(backend: str = "auto", source_len: int = 512, steps: int = 100, layers: int = 4, d_model: int = 256) -> dict:
+    """Encode ``source_len`` random tokens and decode ``steps`` with and without reprojection."""
+    backend_name = summarizer.default_backend() if backend == "auto" else backend
+    t5 = summarizer.backend(backend_name)
+    ops = array_ops(backend_name)
+    asarray, _, evaluate = ops
+
+    t5.seed(0)
+    model = t5.T5(tiny_config(layers, d_model))
+    source = np.random.default_rng(0).integers(0, 1024, (1, source_len))
+    start = perf_counter_ns()
+    memory = model.encode(asarray(source))
+    evaluate(memory)
+    encode_seconds = (perf_counter_ns() - start) / 1.0e9
+
+    # one untimed pass so both measurements start warm
+    decode(model, memory, 2, reproject=False, ops=ops)
+    reproject_tps, _ = decode(model, memory, steps, reproject=True, ops=ops)
+    cached_tps, cache = decode(model, memory, steps, reproject=False, ops=ops)
+    return {
+        "benchmark": "t5_decode",
+        "backend": backend_name,
+        "source_len": source_len,
+        "steps": steps,
+        "layers": layers,
+        "d_model": d_model,
+        "encode_tokens_per_sec": source_len / encode_seconds,
+        "reproject_tokens_per_sec": reproject_tps,
+        "cached_tokens_per_sec": cached_tps,
+        "cache_nbytes": cache.nbytes,
+        "self_kv_nbytes": sum(c.nbytes for c in cache.self_kv),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", default="auto", choices=["auto", *summarizer.BACKENDS])
+    parser.add_argument("--source-len", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--d-model", type=int, default=256)
+    args = parser.parse_args()
+    print(json.dumps(run(args.backend, args.source_len, args.steps, args.layers, args.d_model)))
+
+
+if __name__ == "__main__":
+    main()
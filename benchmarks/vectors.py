@@ -0,0 +1,82 @@
+"""Semantic search latency and recall over archives of synthetic embeddings.
+
+Fills a ``modules.vectors.VectorIndex`` with ``--sizes`` unit vectors of the
+summarizer's width, drawn around a few hundred topics so they cluster like
+document embeddings do, then times queries near random documents. Each size
+is searched exactly, every row scored, and through the clusters, which are
+trained once the archive passes ``--ivf-min-rows``. Recall is the share of the
+exact top ``k`` the clustered search finds too. No model is needed. From the
+repo root:
+
+    python -m benchmarks.vectors --sizes 1000 10000 100000
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+from statistics import median
+from time import perf_counter_ns
+
+import numpy as np
+
+from modules.vectors import VectorIndex, normalize
+
+
+def synthetic_embeddings(rng: np.random.Generator, n: int, dim: int, topics: int = 300) -> np.ndarray:
+    centers = normalize(rng.normal(size=(topics, dim)))
+    return normalize(centers[rng.integers(0, topics, n)] + rng.normal(scale=0.04, size=(n, dim)))
+
+
+def run(size: int, dim: int, queries: int, k: int, ivf_min_rows: int, probe: int, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    root = tempfile.mkdtemp()
+    try:
+        vectors = VectorIndex(root, compact_every=2 ** 62, ivf_min_rows=ivf_min_rows, probe=probe)
+        embeddings = synthetic_embeddings(rng, size, dim)
+        start = perf_counter_ns()
+        for i in range(0, size, 5000):
+            vectors.add_many((f"doc-{j}", embeddings[j]) for j in range(i, min(i + 5000, size)))
+        fill_seconds = (perf_counter_ns() - start) / 1.0e9
+
+        picks = rng.integers(0, size, queries)
+        asked = normalize(embeddings[picks] + rng.normal(scale=0.02, size=(queries, dim)))
+        exact_ms, clustered_ms, recall = [], [], []
+        for query in asked:
+            start = perf_counter_ns()
+            exact = vectors.search(query, k, probe=0)
+            exact_ms.append((perf_counter_ns() - start) / 1.0e6)
+            start = perf_counter_ns()
+            clustered = vectors.search(query, k)
+            clustered_ms.append((perf_counter_ns() - start) / 1.0e6)
+            recall.append(len({u for u, _ in exact} & {u for u, _ in clustered}) / len(exact))
+        return {
+            "benchmark": "vectors",
+            "size": size,
+            "dim": dim,
+            "fill_seconds": fill_seconds,
+            "matrix_bytes": size * dim * 4,
+            "clusters": 0 if vectors._centroids is None else len(vectors._centroids),
+            "exact_ms": {"p50": median(exact_ms), "max": max(exact_ms)},
+            "clustered_ms": {"p50": median(clustered_ms), "max": max(clustered_ms)},
+            "recall_at_k": sum(recall) / len(recall),
+        }
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=1024, help="t5-3b's d_model")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--ivf-min-rows", type=int, default=20000)
+    parser.add_argument("--probe", type=int, default=8)
+    args = parser.parse_args()
+    for size in args.sizes:
+        print(json.dumps(run(size, args.dim, args.queries, args.k, args.ivf_min_rows, args.probe)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
 # stolen shamelessly from https://github.com/ml-explore/mlx-examples/blob/main/t5/t5.py
 
+import argparse
+import os
+
 import numpy as np
 from transformers import T5ForConditionalGeneration
 
+from modules.quantize import GROUP_SIZES, quantize_tensor
+from modules.shards import ShardWriter
+
 SHARED_REPLACEMENT_PATTERNS = [
     (".block.", ".layers."),
     (".k.", ".key_proj."),
@@ -45,16 +51,72 @@ def replace_key(key: str) -> str:
     return key
 
 
-def convert(model_name, dtype):
+def weights_file_name(model_name: str, quantize: str = None, sharded: bool = False) -> str:
+    """File name of converted weights, e.g. ``t5-3b.npz``, ``t5-3b-int8.npz`` or ``t5-3b`` (sharded)."""
+    file_name = model_name.replace("/", "-")
+    if quantize:
+        file_name += f"-{quantize}"
+    return file_name if sharded else file_name + ".npz"
+
+
+def convert(model_name, dtype, quantize=None, group_size=64):
+    """Download a HF T5 and save it as .npz next to this file.
+
+    With ``quantize`` (int8 or int4) the linear layers are saved quantized, see
+    ``modules/quantize.py``, the other weights in ``dtype``.
+    """
     dtype = getattr(np, dtype)
     model = T5ForConditionalGeneration.from_pretrained(model_name, torch_dtype="auto")
-    weights = {
-        replace_key(k): v.numpy().astype(dtype) for k, v in model.state_dict().items()
-    }
-    file_name = model_name.replace("/", "-")
-    print(f"Saving weights to {file_name}.npz")
-    np.savez(f"{file_name}.npz", **weights)
+    weights = {}
+    for k, v in model.state_dict().items():
+        weights.update(quantize_tensor(replace_key(k), v.numpy().astype(dtype), quantize, group_size))
+    file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), weights_file_name(model_name, quantize))
+    print(f"Saving weights to {file_name}")
+    np.savez(file_name, **weights)
+
+
+def convert_sharded(model_name, dtype, quantize=None, group_size=64, shard_size=2 * 1024 ** 3):
+    """Stream a HF T5 checkpoint into a sharded directory next to this file.
+
+    Tensors are read one at a time from the checkpoint's safetensors files, so
+    the model is never instantiated and peak memory is about one tensor, see
+    ``modules/shards.py`` for the output format.
+    """
+    from huggingface_hub import snapshot_download
+    from safetensors import safe_open
+
+    dtype = getattr(np, dtype)
+    checkpoint = snapshot_download(model_name, allow_patterns=["*.safetensors", "*.json"])
+    files = sorted(f for f in os.listdir(checkpoint) if f.endswith(".safetensors"))
+    if not files:
+        raise FileNotFoundError(f"{model_name} has no safetensors checkpoint, use --format npz")
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), weights_file_name(model_name, quantize, sharded=True))
+    print(f"Saving weights to {path}")
+    with ShardWriter(path, shard_size) as writer:
+        for file in files:
+            with safe_open(os.path.join(checkpoint, file), framework="np") as f:
+                for k in f.keys():
+                    tensors = quantize_tensor(replace_key(k), f.get_tensor(k).astype(dtype), quantize, group_size)
+                    for name, array in tensors.items():
+                        writer.add(name, array)
 
 
 if __name__ == "__main__":
-    convert("t5-3b", "float32")
+    parser = argparse.ArgumentParser(description="Convert a HF T5 checkpoint for modules/t5.py.")
+    parser.add_argument("--model", default="t5-3b")
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--quantize", choices=["int8", "int4"], default=None)
+    parser.add_argument("--group-size", type=int, choices=GROUP_SIZES, default=64, help="inputs per scale for int4")
+    parser.add_argument(
+        "--format",
+        choices=["sharded", "npz"],
+        default="sharded",
+        help="sharded streams tensor by tensor and loads memory-mapped, npz is a single file",
+    )
+    parser.add_argument("--shard-size-gb", type=float, default=2)
+    args = parser.parse_args()
+    if args.format == "sharded":
+        convert_sharded(args.model, args.dtype, args.quantize, args.group_size, int(args.shard_size_gb * 1024 ** 3))
+    else:
+        convert(args.model, args.dtype, args.quantize, args.group_size)
@@ -0,0 +1,306 @@
+"""Inverted index from the words of each document to the documents containing them.
+
+Terms live in a dict of postings lists, ``{term: [doc id, ...]}``, with a sorted
+term list next to it for prefix lookups by bisection. Doc ids are small ints
+handed out in upload order, so appending keeps every postings list sorted, which
+makes membership a bisection and lets searches walk them newest first and stop
+as soon as they have enough results. Ids map back to document uuids on the way
+out.
+
+On disk the index is a JSON snapshot plus an append-only log of the changes
+made since. Adding a document appends one line to the log, every
+``compact_every`` lines the snapshot is rewritten and the log emptied. Both
+writes go through a temporary file and ``os.replace``, and replaying a log
+entry that's already in the snapshot changes nothing, so a crash at any point
+leaves a loadable index.
+
+Several processes can have the same index open. Appends and compactions hold
+an exclusive lock on ``index.lock`` (see ``modules.locking``) and first read
+whatever the others logged since, or the whole index again if one of them
+compacted, so nothing written by another process is lost from the snapshot.
+Searches pick up other processes' changes the same way.
+"""
+
+import heapq
+import json
+import os
+import re
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from modules.locking import locked
+
+SNAPSHOT_FILE = "index.json"
+LOG_FILE = "index.log"
+LOCK_FILE = "index.lock"
+FORMAT = "docs-token-index"
+
+# lowercased letters and digits, hyphens kept inside a term so "1098-t" stays whole
+TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9\-]*")
+
+
+def tokenize(text: str) -> List[str]:
+    return [t.rstrip("-") for t in TOKEN_RE.findall(text.lower())]
+
+
+def _write_atomic(path: str, text: str):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    """Identity of a file's current version, a replaced file gets a new one."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _contains(postings: List[int], doc: int) -> bool:
+    i = bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+def _size(group: List[List[int]]) -> int:
+    return sum(len(p) for p in group)
+
+
+def _newest_first(group: List[List[int]]) -> Iterator[int]:
+    """Doc ids in any of the postings lists, descending and without repeats.
+
+    A few lists are merged lazily, the many of a short prefix are cheaper to
+    union and sort in one go.
+    """
+    if len(group) == 1:
+        yield from reversed(group[0])
+        return
+    if len(group) > 64:
+        yield from sorted(set().union(*group), reverse=True)
+        return
+    last = None
+    for doc in heapq.merge(*(reversed(p) for p in group), reverse=True):
+        if doc != last:
+            yield doc
+            last = doc
+
+
+class TokenIndex:
+    """Persistent term -> documents index with prefix, multi-term AND search."""
+
+    def __init__(self, path: str, compact_every: int = 1000):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        with locked(self._file(LOCK_FILE), shared=True):
+            self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._ids)
+
+    def __contains__(self, uuid: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return uuid in self._ids
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        self._docs: List[Optional[str]] = []  # doc id -> uuid, None once removed
+        self._ids: Dict[str, int] = {}
+        self._postings: Dict[str, List[int]] = {}
+        self._terms: Optional[List[str]] = None  # sorted, rebuilt after new terms
+        self._log_entries = 0
+        self._log_offset = 0  # bytes of the log applied so far
+        snapshot = self._file(SNAPSHOT_FILE)
+        self._snapshot = _stamp(snapshot)
+        if os.path.exists(snapshot):
+            with open(snapshot) as f:
+                data = json.load(f)
+            if data.get("format") != FORMAT:
+                raise ValueError(f"{snapshot} is not a {FORMAT} snapshot")
+            self._docs = data["docs"]
+            self._ids = {uuid: i for i, uuid in enumerate(self._docs) if uuid is not None}
+            self._postings = data["postings"]
+        self._read_log()
+
+    def _read_log(self):
+        """Apply the log lines past ``_log_offset``."""
+        log = self._file(LOG_FILE)
+        if not os.path.exists(log):
+            return
+        with open(log, "rb") as f:
+            f.seek(self._log_offset)
+            tail = f.read()
+        for line in tail.splitlines(keepends=True):
+            # a write cut short by a crash, nothing after it
+            if not line.endswith(b"\n"):
+                break
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            self._apply(entry)
+            self._log_entries += 1
+            self._log_offset += len(line)
+
+    def _sync(self):
+        """Catch up with the other processes' writes, with ``index.lock`` held."""
+        if _stamp(self._file(SNAPSHOT_FILE)) != self._snapshot:
+            self._load()  # compacted by another process, the doc ids changed
+        else:
+            self._read_log()
+
+    def _refresh(self):
+        """``_sync`` under a shared lock, when the files changed since it last ran."""
+        log = self._file(LOG_FILE)
+        log_size = os.path.getsize(log) if os.path.exists(log) else 0
+        if _stamp(self._file(SNAPSHOT_FILE)) != self._snapshot or log_size != self._log_offset:
+            with locked(self._file(LOCK_FILE), shared=True):
+                self._sync()
+
+    def _apply(self, entry: dict):
+        if entry["op"] == "add":
+            self._add(entry["uuid"], entry["terms"])
+        elif entry["op"] == "remove":
+            self._remove(entry["uuid"])
+
+    def _add(self, uuid: str, terms: Iterable[str]):
+        self._remove(uuid)
+        doc = len(self._docs)
+        self._docs.append(uuid)
+        self._ids[uuid] = doc
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                self._postings[term] = postings = []
+                self._terms = None
+            postings.append(doc)
+
+    def _remove(self, uuid: str):
+        doc = self._ids.pop(uuid, None)
+        if doc is None:
+            return
+        self._docs[doc] = None
+        for term in [t for t, postings in self._postings.items() if _contains(postings, doc)]:
+            postings = self._postings[term]
+            del postings[bisect_left(postings, doc)]
+            if not postings:
+                del self._postings[term]
+                self._terms = None
+
+    def _log(self, *entries: dict):
+        # called with index.lock held after _sync, anything past the offset is a crash's partial line
+        log = self._file(LOG_FILE)
+        if os.path.exists(log) and os.path.getsize(log) > self._log_offset:
+            os.truncate(log, self._log_offset)
+        with open(log, "ab") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries).encode())
+            self._log_offset = f.tell()
+        self._log_entries += len(entries)
+        if self._log_entries >= self.compact_every:
+            self._compact()
+
+    def add(self, uuid: str, *texts: str):
+        """Index a document under every term of ``texts``, replacing what it had before."""
+        terms = sorted(set(t for text in texts if text for t in tokenize(text)))
+        with self._lock, locked(self._file(LOCK_FILE)):
+            self._sync()
+            self._add(uuid, terms)
+            self._log({"op": "add", "uuid": uuid, "terms": terms})
+
+    def add_many(self, documents: Iterable[tuple]):
+        """Index several ``(uuid, *texts)`` documents with a single write to the log."""
+        entries = []
+        for uuid, *texts in documents:
+            terms = sorted(set(t for text in texts if text for t in tokenize(text)))
+            entries.append({"op": "add", "uuid": uuid, "terms": terms})
+        with self._lock, locked(self._file(LOCK_FILE)):
+            self._sync()
+            for entry in entries:
+                self._add(entry["uuid"], entry["terms"])
+            self._log(*entries)
+
+    def remove(self, uuid: str):
+        with self._lock, locked(self._file(LOCK_FILE)):
+            self._sync()
+            if uuid in self._ids:
+                self._remove(uuid)
+                self._log({"op": "remove", "uuid": uuid})
+
+    def compact(self):
+        """Write the whole index to the snapshot and empty the log."""
+        with self._lock, locked(self._file(LOCK_FILE)):
+            self._sync()
+            self._compact()
+
+    def _compact(self):
+        # drop removed documents so the doc ids stay dense
+        remap = {}
+        docs = []
+        for doc, uuid in enumerate(self._docs):
+            if uuid is not None:
+                remap[doc] = len(docs)
+                docs.append(uuid)
+        postings = {term: [remap[d] for d in ids] for term, ids in self._postings.items()}
+        _write_atomic(
+            self._file(SNAPSHOT_FILE),
+            json.dumps({"format": FORMAT, "version": 1, "docs": docs, "postings": postings}),
+        )
+        _write_atomic(self._file(LOG_FILE), "")
+        self._snapshot = _stamp(self._file(SNAPSHOT_FILE))
+        self._log_entries = 0
+        self._log_offset = 0
+        self._docs = docs
+        self._ids = {uuid: i for i, uuid in enumerate(docs)}
+        self._postings = postings
+
+    def _prefix(self, prefix: str) -> List[List[int]]:
+        """Postings of every term that starts with ``prefix``."""
+        if self._terms is None:
+            self._terms = sorted(self._postings)
+        i = bisect_left(self._terms, prefix)
+        group = []
+        while i < len(self._terms) and self._terms[i].startswith(prefix):
+            group.append(self._postings[self._terms[i]])
+            i += 1
+        return group
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[str]:
+        """Uuids of the documents matching every term of ``query``, newest first.
+
+        Each query term matches as a prefix, "tax 109" finds documents with
+        "tax" and "1098" or "1099". Candidates come from the rarest term and are
+        checked against the others by bisection, unless a term is a short prefix
+        matching so many terms that one set of all their documents is cheaper.
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            self._refresh()
+            groups = sorted((self._prefix(t) for t in terms), key=_size)
+            candidates = _size(groups[0])
+            checks: List[Callable[[int], bool]] = []
+            for group in groups[1:]:
+                if candidates * len(group) > _size(group):
+                    checks.append(set().union(*group).__contains__)
+                else:
+                    checks.append(lambda doc, group=group: any(_contains(p, doc) for p in group))
+
+            found = []
+            for doc in _newest_first(groups[0]):
+                if all(check(doc) for check in checks):
+                    found.append(self._docs[doc])
+                    if len(found) == limit:
+                        break
+            return found
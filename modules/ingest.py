@@ -0,0 +1,550 @@
+"""Document ingestion: save the upload, threshold, thumbnail, OCR, summarize, index.
+
+``save_upload`` is all an upload waits for, the rest runs in an
+``IngestWorker`` fed by the job queue in ``modules.jobs``. OCR and image work
+fan out over a process pool, summarization stays on one thread in this process
+so only one copy of the model is ever loaded, or goes to the summarization
+server in ``modules.server`` that several app processes share.
+
+Images are stored by the sha256 of their bytes, so the same image uploaded
+twice is one file. What the pipeline made of it is cached in the store under
+that hash and ``PIPELINE_VERSION``, so it isn't OCR'd or summarized again until
+the pipeline changes. Bump the version when it does.
+
+Each stage's time and size go into the document's ``stage_timings``, see
+``modules.metrics``.
+
+The summarizer's embedding of each document is cached with its results and
+goes into a ``modules.vectors.VectorIndex`` next to the token index, rather
+than into the store.
+"""
+
+import hashlib
+import os
+import pathlib
+import threading
+import traceback
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from time import perf_counter_ns
+from typing import List, Optional
+
+import cv2
+import numpy as np
+import pytesseract
+
+import modules.summarizer as summarizer
+from modules import metrics, ocr, page
+from modules.index import TokenIndex
+from modules.jobs import JobQueue
+from modules.server import LocalSummarizer
+from modules.store import MetadataStore
+from modules.vectors import VectorIndex, pack, unpack
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+THUMBNAIL_SIZE = (128, 128)
+THUMBNAIL_SUFFIX = ".thumb.jpg"
+THRESHOLD_SUFFIX = ".threshold.png"
+HEXTREE_DEPTH = 3
+PIPELINE_VERSION = 4
+# what the pipeline derives from an image's content, cached by its hash
+RESULT_FIELDS = (
+    "thumbnail", "threshold_path", "dhash", "page", "ocr_string", "ocr_words", "t5_summary", "embedding",
+)
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    """Decode image bytes into a BGR array, the only decode ingestion does."""
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("can't decode the image")
+    return img
+
+
+def grayscale(img: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+
+def threshold_image(img: np.ndarray) -> np.ndarray:
+    # apply adaptive threshold on gray img
+    return cv2.adaptiveThreshold(grayscale(img), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 15)
+
+
+def dhash(img: np.ndarray, size: int = 8) -> str:
+    """64 bit difference hash as hex, near identical images differ in a few bits.
+
+    Each bit is whether a pixel of the image shrunk to 9x8 is brighter than its
+    right neighbour, so rescans, recompression and small exposure changes of the
+    same page mostly keep their hash.
+    """
+    small = cv2.resize(grayscale(img), (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def generate_thumbnail_array(file_path: str, img: np.ndarray) -> str:
+    """Generate a thumbnail from a decoded image, saved beside its source file.
+
+    :returns: path to the thumbnail, the source's name + \".thumb.jpg\""""
+    height, width = img.shape[:2]
+    scale = min(THUMBNAIL_SIZE[0] / width, THUMBNAIL_SIZE[1] / height, 1.0)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    thumb = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    thumb_path = os.path.splitext(file_path)[0] + THUMBNAIL_SUFFIX
+    cv2.imwrite(thumb_path, thumb)
+    return thumb_path
+
+
+def hextree_path(root: str, name: str, depth: int = HEXTREE_DEPTH) -> pathlib.Path:
+    """Where a file lives in the hex tree, one directory level per leading hex digit.
+
+    16 ** depth leaf directories keep each one small, 3 levels hold a million
+    files at ~250 per directory. Directories are only made when written to.
+    """
+    return pathlib.Path(root, *name[:depth], name)
+
+
+def save_upload(root: str, data: bytes, metadata: dict, depth: int = HEXTREE_DEPTH) -> dict:
+    """Write an image into the hex tree directory and fill in its metadata.
+
+    The file is named by the content hash and only written if it isn't there
+    already, each document still gets its own uuid.
+    """
+    with metrics.timed("write", metadata.setdefault("stage_timings", {})) as timing:
+        new_uid = uuid.uuid4()
+        sha256 = content_hash(data)
+        metadata["uuid"] = str(new_uid)
+        metadata["sha256"] = sha256
+        metadata["extension"] = ".jpg"
+        file_path = hextree_path(root, sha256 + ".jpg", depth)
+        metadata["full_path"] = str(file_path)
+        metadata["upload_time"] = datetime.isoformat(datetime.utcnow())
+        metadata["upload_time_zone"] = "utc"
+
+        if not file_path.exists():
+            os.makedirs(file_path.parent, exist_ok=True)
+            tmp = file_path.with_suffix(f".{new_uid}.tmp")
+            with open(tmp, "wb") as img:
+                img.write(data)
+            os.replace(tmp, file_path)
+        timing["bytes"] = len(data)
+    return metadata
+
+
+def flag_duplicates(store: MetadataStore, metadata: dict) -> dict:
+    """Point a document at the stored ones with the same or a near identical image."""
+    if not metadata.get("sha256"):
+        return metadata
+    same = [u for u in store.with_hash(metadata["sha256"]) if u != metadata["uuid"]]
+    if same:
+        metadata["duplicate_of"] = same[0]
+    if metadata.get("dhash"):
+        near = store.near_duplicates(metadata["dhash"], metadata["sha256"])
+        if near:
+            metadata["near_duplicates"] = near
+    return metadata
+
+
+# set in each pool process by _init_ocr_process
+_cached_hashes = frozenset()
+_ocr_threads = 1
+
+
+def _init_ocr_process(cached_hashes=frozenset(), ocr_threads: int = 1):
+    global _cached_hashes, _ocr_threads
+    # one thread per tesseract process, the processes times ocr_threads already use every core
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    _cached_hashes = cached_hashes
+    _ocr_threads = ocr_threads
+
+
+def _warm_up_ocr() -> Optional[str]:
+    # returns the error, pytesseract's exceptions don't unpickle and would break the pool
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def ocr_document(file_path: str, data: Optional[bytes] = None, stage_timings: Optional[dict] = None) -> dict:
+    """Flatten, threshold, thumbnail and OCR a saved image, the CPU bound stages.
+
+    The image is decoded once and the arrays are shared by every stage. The
+    page is cropped out of the photo, straightened and scaled to
+    ``modules.page.DPI`` first, so the rest only sees the page. The original stays
+    as uploaded, the threshold image is written beside it and ``page`` has the
+    transform that maps the page's word boxes back onto it.
+    Runs in a pool process, so it only takes and returns plain data, the
+    returned ``stage_timings`` are the given ones plus its own.
+    """
+    timings = dict(stage_timings or {})
+    with metrics.timed("decode", timings) as timing:
+        if data is None:
+            with open(file_path, "rb") as f:
+                data = f.read()
+        img = decode_image(data)
+        timing["bytes"] = len(data)
+    with metrics.timed("flatten", timings) as timing:
+        img, page_info = page.flatten(img)
+        gray = grayscale(img)
+        timing["bytes"] = img.nbytes
+    with metrics.timed("threshold", timings) as timing:
+        threshold = threshold_image(gray)
+        threshold_path = os.path.splitext(file_path)[0] + THRESHOLD_SUFFIX
+        cv2.imwrite(threshold_path, threshold)
+        timing["bytes"] = threshold.nbytes
+    with metrics.timed("thumbnail", timings) as timing:
+        thumbnail = generate_thumbnail_array(file_path, img)
+        timing["bytes"] = os.path.getsize(thumbnail)
+    with metrics.timed("dhash", timings):
+        image_hash = dhash(gray)
+    del img, gray
+
+    with metrics.timed("ocr", timings) as timing:
+        ocr_str, words = ocr.read(threshold, _ocr_threads)
+        timing["bytes"] = len(ocr_str.encode())
+    return {
+        "thumbnail": thumbnail,
+        "threshold_path": threshold_path,
+        "dhash": image_hash,
+        "page": page_info,
+        "ocr_string": ocr_str,
+        "ocr_words": words,
+        "stage_timings": timings,
+    }
+
+
+def import_file(root: str, path: str, tags: str = "", depth: int = HEXTREE_DEPTH) -> dict:
+    """Copy a file into the hex tree and OCR it, a pool task of ``import_directory``.
+
+    Images whose results are already cached aren't OCR'd.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    metadata = save_upload(root, data, dict(original_filename=path, tags=tags), depth)
+    if metadata["sha256"] not in _cached_hashes:
+        metadata.update(ocr_document(metadata["full_path"], data, metadata["stage_timings"]))
+    return metadata
+
+
+def find_images(directory: str) -> List[str]:
+    """Image files under ``directory``, without the thumbnails ingestion makes."""
+    paths = []
+    for dirpath, _, filenames in os.walk(directory):
+        paths.extend(
+            os.path.join(dirpath, f) for f in filenames
+            if f.lower().endswith(IMAGE_EXTENSIONS) and not f.endswith(THUMBNAIL_SUFFIX)
+        )
+    return sorted(paths)
+
+
+def import_directory(
+    root: str,
+    directory: str,
+    store: MetadataStore,
+    index: TokenIndex,
+    tags: str = "",
+    processes: Optional[int] = None,
+    batch_size: int = 32,
+    depth: int = HEXTREE_DEPTH,
+    vectors: Optional[VectorIndex] = None,
+) -> dict:
+    """Import every image under ``directory``, OCR'd across all cores.
+
+    OCR results are summarized ``batch_size`` at a time with
+    ``summarizer.summarize_batch`` and written with one transaction per batch.
+    Files already imported with the same size and mtime are skipped, so an
+    interrupted import picks up where it stopped. The app can keep running:
+    ``index`` and ``vectors`` lock their files against its worker's writes, and
+    its searches see the imported documents as they're added.
+
+    :returns: counts and throughput of the run
+    """
+    imported = store.imported()
+    found = find_images(directory)
+    paths = []
+    for path in found:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if imported.get(path) != (stat.st_size, stat.st_mtime):
+            paths.append((path, stat.st_size, stat.st_mtime))
+    stats = {"found": len(found), "skipped": len(found) - len(paths), "imported": 0, "cached": 0, "failed": 0}
+
+    def flush(batch: List[dict], sources: List[tuple]):
+        todo = []
+        for metadata in batch:
+            cached = store.cached_result(metadata["sha256"], PIPELINE_VERSION)
+            if cached is not None:
+                metadata.update(cached)
+                stats["cached"] += 1
+                metrics.DOCUMENTS.labels("cached").inc()
+            else:
+                todo.append(metadata)
+                metrics.DOCUMENTS.labels("new").inc()
+        summaries, embeddings = [], []
+        if todo:
+            summaries, embeddings = summarizer.summarize_batch(
+                [m["ocr_string"] for m in todo], batch_size, return_embeddings=True
+            )
+        for metadata, summary, embedding in zip(todo, summaries, embeddings):
+            metadata["t5_summary"] = summary
+            metadata["embedding"] = pack(embedding)
+            store.cache_result(metadata["sha256"], PIPELINE_VERSION, {k: metadata[k] for k in RESULT_FIELDS})
+        for metadata in batch:
+            flag_duplicates(store, metadata)
+        # index first, a crash before the store commits re-imports the batch
+        index.add_many((m["uuid"], m["ocr_string"], m["tags"], m["t5_summary"]) for m in batch)
+        embedded = [(m["uuid"], unpack(m.pop("embedding"))) for m in batch if m.get("embedding")]
+        if vectors is not None:
+            vectors.add_many(embedded)
+        store.add_many(batch, sources)
+        for metadata in batch:
+            metrics.observe(metadata["stage_timings"])
+        stats["imported"] += len(batch)
+        elapsed = (perf_counter_ns() - start) / 1.0e9
+        print(f'imported {stats["imported"]}/{len(paths)}, {stats["imported"] / elapsed:.2f} docs/sec', flush=True)
+
+    start = perf_counter_ns()
+    batch, sources = [], []
+    cached_hashes = frozenset(store.cached_hashes(PIPELINE_VERSION))
+    # a document per core keeps every core busy, each one is read on a single thread
+    with ProcessPoolExecutor(processes, initializer=_init_ocr_process, initargs=(cached_hashes, 1)) as pool:
+        futures = [pool.submit(import_file, root, path, tags, depth) for path, _, _ in paths]
+        for source, future in zip(paths, futures):
+            try:
+                metadata = future.result()
+            except Exception as e:
+                stats["failed"] += 1
+                print(f'failed {source[0]}: {e!r}', flush=True)
+                continue
+            batch.append(metadata)
+            sources.append(source)
+            if len(batch) == batch_size:
+                flush(batch, sources)
+                batch, sources = [], []
+        if batch:
+            flush(batch, sources)
+
+    elapsed = (perf_counter_ns() - start) / 1.0e9
+    stats["seconds"] = elapsed
+    stats["docs_per_sec"] = stats["imported"] / elapsed if elapsed else 0.0
+    return stats
+
+
+class IngestWorker:
+    """Works through the job queue until stopped.
+
+    A dispatcher thread keeps up to ``max_pending`` jobs in the OCR process pool,
+    a summarizer thread takes OCR'd jobs one at a time, streams the partial
+    summary into the job, then saves and indexes the document. Jobs for an
+    image with cached results skip straight to saving.
+
+    Each document's text blocks are read on ``ocr_threads`` threads, so a single
+    upload isn't stuck on one core. By default that's up to 4 threads in each of
+    ``cores // ocr_threads`` processes, so a full queue still runs one tesseract
+    per core.
+
+    With ``warm_up`` a third thread starts the OCR processes and loads the
+    summarizer's model right away, rather than when the first document needs them.
+
+    Documents are indexed for semantic search too when given ``vectors``.
+
+    Summaries come from ``service``: a ``modules.server.SummarizerClient`` to
+    share a summarization server with other processes, or by default a
+    ``LocalSummarizer`` that loads the model in this one.
+
+    Other app processes can run workers on the same queue. Each stage claims
+    its jobs, the dispatcher keeps this process's claims' heartbeat fresh and
+    frees the jobs of workers that stopped, see ``modules.jobs``.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        queue: JobQueue,
+        store: MetadataStore,
+        index: TokenIndex,
+        processes: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        warm_up: bool = False,
+        ocr_threads: Optional[int] = None,
+        vectors: Optional[VectorIndex] = None,
+        service=None,
+    ):
+        self.root = root
+        self.queue = queue
+        self.store = store
+        self.index = index
+        self.vectors = vectors
+        self.service = service or LocalSummarizer()
+        cores = os.cpu_count() or 1
+        self.ocr_threads = ocr_threads or min(4, cores)
+        self.processes = processes or max(1, cores // self.ocr_threads)
+        self.max_pending = max_pending or 2 * self.processes
+        self._pool = ProcessPoolExecutor(
+            self.processes, initializer=_init_ocr_process, initargs=(frozenset(), self.ocr_threads)
+        )
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._wake_ocr = threading.Event()
+        self._wake_summarizer = threading.Event()
+        self._stopped = threading.Event()
+
+        self.queue.reset_stale()
+        self._threads = [
+            threading.Thread(target=self._dispatch, name="ingest-ocr", daemon=True),
+            threading.Thread(target=self._summarize, name="ingest-summarizer", daemon=True),
+        ]
+        if warm_up:
+            self._threads.append(threading.Thread(target=self._warm_up, name="ingest-warm-up", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def notify(self):
+        """Wake the dispatcher now rather than at its next poll, after enqueueing."""
+        self._wake_ocr.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake_ocr.set()
+        self._wake_summarizer.set()
+        for thread in self._threads:
+            thread.join()
+        self._pool.shutdown(cancel_futures=True)
+
+    def _warm_up(self):
+        # nothing lost if either fails, the first document tries again and its job reports the error
+        errors = {f.result() for f in [self._pool.submit(_warm_up_ocr) for _ in range(self.processes)]}
+        for error in errors - {None}:
+            print(f"OCR warm up failed: {error}")
+        try:
+            self.service.warm_up()
+        except Exception:
+            traceback.print_exc()
+
+    def _dispatch(self):
+        last_beat = perf_counter_ns()
+        while not self._stopped.is_set():
+            if (perf_counter_ns() - last_beat) / 1.0e9 > self.queue.stale_after / 4:
+                self.queue.beat()
+                self.queue.reset_stale()
+                last_beat = perf_counter_ns()
+            with self._lock:
+                free = self.max_pending - self._pending
+            for job_id, metadata in self.queue.claim("queued", "ocr", free):
+                cached = self._cached(metadata)
+                if cached is not None:
+                    metrics.DOCUMENTS.labels("cached").inc()
+                    try:
+                        self._complete(job_id, {**metadata, **cached})
+                    except Exception:
+                        self.queue.fail(job_id, traceback.format_exc(limit=3), retry_status="queued")
+                    continue
+                with self._lock:
+                    self._pending += 1
+                future = self._pool.submit(ocr_document, metadata["full_path"], None, metadata.get("stage_timings"))
+                future.add_done_callback(lambda f, job_id=job_id: self._ocr_finished(job_id, f))
+            self._wake_ocr.wait(1.0)
+            self._wake_ocr.clear()
+
+    def _ocr_finished(self, job_id: int, future: Future):
+        with self._lock:
+            self._pending -= 1
+        try:
+            self.queue.update(job_id, "summarizing", **future.result())
+        except Exception:
+            # the pool process's own failure count is lost with it
+            metrics.STAGE_FAILURES.labels("ocr").inc()
+            self.queue.fail(job_id, traceback.format_exc(limit=3), retry_status="queued")
+        self._wake_ocr.set()
+        self._wake_summarizer.set()
+
+    def _summarize(self):
+        while not self._stopped.is_set():
+            claimed = self.queue.claim("summarizing", "summarizing")
+            if not claimed:
+                self._wake_summarizer.wait(1.0)
+                self._wake_summarizer.clear()
+                continue
+            job_id, metadata = claimed[0]
+            try:
+                self._finish(job_id, metadata)
+            except Exception:
+                self.queue.fail(job_id, traceback.format_exc(limit=3), retry_status="summarizing")
+
+    def _finish(self, job_id: int, metadata: dict):
+        stream = self.service.stream(metadata["ocr_string"])
+        with metrics.timed("summarize", metadata.setdefault("stage_timings", {})) as timing:
+            for _ in stream:
+                self.queue.update(job_id, partial_summary=stream.text)
+            timing["bytes"] = len(stream.summary.encode())
+        metadata.pop("partial_summary", None)
+        metadata["t5_summary"] = stream.summary
+        metadata["embedding"] = pack(stream.embedding)
+        metadata["t5_time_to_first_token"] = stream.time_to_first_token
+        metadata["t5_tokens_per_sec"] = stream.tokens_per_sec
+        if metadata.get("sha256"):
+            self.store.cache_result(metadata["sha256"], PIPELINE_VERSION, {k: metadata[k] for k in RESULT_FIELDS})
+        metrics.DOCUMENTS.labels("new").inc()
+        self._complete(job_id, metadata)
+
+    def _cached(self, metadata: dict) -> Optional[dict]:
+        # jobs queued before uploads were hashed have no sha256
+        if not metadata.get("sha256"):
+            return None
+        return self.store.cached_result(metadata["sha256"], PIPELINE_VERSION)
+
+    def _complete(self, job_id: int, metadata: dict):
+        # saving twice would fail on the unique uuid, a retry after a crash between
+        # saving and marking the job done only has to finish the job. Indexing is
+        # idempotent, so it goes first and its timing is saved with the document
+        timings = metadata.setdefault("stage_timings", {})
+        embedding = metadata.pop("embedding", None)
+        with metrics.timed("index", timings):
+            self.index.add(metadata["uuid"], metadata["ocr_string"], metadata.get("tags"), metadata["t5_summary"])
+            if self.vectors is not None and embedding:
+                self.vectors.add(metadata["uuid"], unpack(embedding))
+        with metrics.timed("store", timings):
+            if metadata["uuid"] not in self.store:
+                self.store.add(flag_duplicates(self.store, metadata))
+        self.queue.update(job_id, "done", t5_summary=metadata["t5_summary"])
+        metrics.observe(timings)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import tomllib
+
+    parser = argparse.ArgumentParser(description="Import every JPEG under a directory.")
+    parser.add_argument("directory")
+    parser.add_argument("--root", default=None, help="data directory, data_path_root from config.toml by default")
+    parser.add_argument("--tags", default="", help="manual tags for every imported document")
+    parser.add_argument("--processes", type=int, default=None, help="OCR processes, every core by default")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists("config.toml"):
+        with open("config.toml", "rb") as f:
+            config = tomllib.load(f)
+    root = args.root or config.get("app", {}).get("data_path_root", "data")
+    summarizer.configure(**config.get("t5", {}))
+
+    os.makedirs(root, exist_ok=True)
+    store = MetadataStore(os.path.join(root, "metadata.db"))
+    index = TokenIndex(os.path.join(root, "index"))
+    vectors = VectorIndex(os.path.join(root, "vectors"))
+    depth = config.get("app", {}).get("hextree_depth", HEXTREE_DEPTH)
+    stats = import_directory(
+        root, args.directory, store, index, args.tags, args.processes, args.batch_size, depth, vectors
+    )
+    index.compact()
+    vectors.compact()
+    print(json.dumps(stats))
@@ -0,0 +1,223 @@
+"""Persistent queue of documents waiting to be ingested.
+
+Each uploaded document is one row in a SQLite ``jobs`` table carrying its
+metadata as JSON, which the stages fill in as they go. A job moves through
+
+    queued -> ocr -> summarizing -> done
+
+``queued`` jobs wait for the OCR pool and ``ocr`` ones are in it. ``summarizing``
+jobs have their OCR text and wait for, or are in, the summarizer. A stage that
+raises sends the job back to wait for the same stage until it has failed
+``max_attempts`` times, then it's ``failed``. The table lives in a file, so
+jobs outlive the process.
+
+Several app processes can work on the same queue. ``claim`` marks the jobs it
+hands out with the claiming process as their ``owner``, and each owner
+refreshes its jobs' ``heartbeat`` with ``beat``. ``reset_stale`` frees the jobs
+of owners that stopped, a process on this host that's gone or a heartbeat
+older than ``stale_after``: OCR starts again from the queue, summarizing jobs
+wait for any summarizer again.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+STATUSES = ("queued", "ocr", "summarizing", "done", "failed")
+ACTIVE = ("queued", "ocr", "summarizing")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    data TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    owner TEXT,
+    heartbeat TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+def _now() -> str:
+    return datetime.isoformat(datetime.utcnow())
+
+
+def _alive(owner: str) -> bool:
+    """Whether the process that claimed as ``owner`` might still be running."""
+    host, pid, _ = owner.rsplit(":", 2)
+    if host != socket.gethostname():
+        return True  # only its heartbeat can tell
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # someone else's process
+    return True
+
+
+class JobQueue:
+    def __init__(self, path: str, max_attempts: int = 3, stale_after: float = 120.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        # with a token, so a restarted process given the same pid doesn't keep its predecessor's claims alive
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+        self._add_owners()
+
+    def _add_owners(self):
+        """Add the owner columns to a jobs table made before them."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column in ("owner", "heartbeat"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit, transactions are opened explicitly where they're needed
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, metadata: dict) -> int:
+        """Queue a saved document for OCR, ``metadata["uuid"]`` must be new."""
+        now = _now()
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (uuid, status, data, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+            (metadata["uuid"], json.dumps(metadata), now, now),
+        )
+        return cursor.lastrowid
+
+    def claim(self, status: str, new_status: str, limit: int = 1) -> List[Tuple[int, dict]]:
+        """Move up to ``limit`` of the oldest unclaimed ``status`` jobs to ``new_status``, owned by this queue.
+
+        ``new_status`` can be ``status``, to claim jobs a stage works on where they wait.
+
+        :returns: the claimed ``(job id, metadata)`` pairs
+        """
+        if limit <= 0:
+            return []
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, data FROM jobs WHERE status = ? AND owner IS NULL ORDER BY id LIMIT ?", (status, limit)
+            ).fetchall()
+            now = _now()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, updated_at = ? WHERE id = ?",
+                [(new_status, self.owner, now, now, job_id) for job_id, _ in rows],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return [(job_id, json.loads(data)) for job_id, data in rows]
+
+    def beat(self) -> int:
+        """Refresh the heartbeat of the jobs this queue claimed, so they don't look stale."""
+        cursor = self._connection().execute(
+            "UPDATE jobs SET heartbeat = ? WHERE owner = ?", (_now(), self.owner)
+        )
+        return cursor.rowcount
+
+    def update(self, job_id: int, status: Optional[str] = None, **fields):
+        """Merge ``fields`` into a job's metadata, and move it to ``status`` if given.
+
+        A job moved to another status is unclaimed, for whichever process works on that one.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            data, current = conn.execute("SELECT data, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            conn.execute(
+                "UPDATE jobs SET status = ?, data = ?, updated_at = ?,"
+                " owner = CASE WHEN ? THEN NULL ELSE owner END WHERE id = ?",
+                (status or current, json.dumps({**json.loads(data), **fields}), _now(), status is not None, job_id),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def fail(self, job_id: int, error: str, retry_status: str):
+        """Count a failed attempt, the job waits in ``retry_status`` again until it runs out."""
+        self._connection().execute(
+            "UPDATE jobs SET attempts = attempts + 1, error = ?, updated_at = ?, owner = NULL,"
+            " status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE ? END WHERE id = ?",
+            (error, _now(), self.max_attempts, retry_status, job_id),
+        )
+
+    def retry(self, job_id: int):
+        """Queue a failed job again from the start, with its attempts reset."""
+        self._connection().execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, owner = NULL, updated_at = ?"
+            " WHERE id = ? AND status = 'failed'",
+            (_now(), job_id),
+        )
+
+    def reset_stale(self) -> int:
+        """Free the jobs claimed by processes that stopped, see the module docstring.
+
+        OCR cut short starts again from the queue, summarizing jobs are unclaimed.
+        Jobs left in OCR by a version without owners are requeued too.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cutoff = datetime.isoformat(datetime.utcnow() - timedelta(seconds=self.stale_after))
+            rows = conn.execute(
+                "SELECT id, status, owner, heartbeat FROM jobs"
+                " WHERE status = 'ocr' OR (status = 'summarizing' AND owner IS NOT NULL)"
+            ).fetchall()
+            stale = [
+                (status, job_id) for job_id, status, owner, heartbeat in rows
+                if owner is None or heartbeat < cutoff or not _alive(owner)
+            ]
+            conn.executemany(
+                "UPDATE jobs SET status = CASE WHEN ? = 'ocr' THEN 'queued' ELSE status END,"
+                " owner = NULL, updated_at = ? WHERE id = ?",
+                [(status, _now(), job_id) for status, job_id in stale],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(stale)
+
+    def jobs(self, statuses=STATUSES, limit: int = 100) -> List[dict]:
+        """Newest jobs in any of ``statuses``, as dicts of the row with ``data`` decoded."""
+        rows = self._connection().execute(
+            f"SELECT id, uuid, status, attempts, error, data, updated_at FROM jobs"
+            f" WHERE status IN ({','.join('?' * len(statuses))}) ORDER BY id DESC LIMIT ?",
+            (*statuses, limit),
+        )
+        keys = ("id", "uuid", "status", "attempts", "error", "data", "updated_at")
+        return [{**dict(zip(keys, row)), "data": json.loads(row[5])} for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: 0 for status in STATUSES} | dict(rows)
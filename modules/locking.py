@@ -0,0 +1,23 @@
+"""Advisory file locks shared by every process writing to a data directory.
+
+The app's worker, ``python -m modules.ingest`` and ``python -m modules.vectors
+--backfill`` can all have the same index open. Each index keeps a ``.lock`` file
+next to its data and holds ``flock`` on it exclusively while appending or
+compacting, shared while reading what the others wrote. The lock goes with the
+file descriptor, so a process that dies holding it releases it.
+"""
+
+import fcntl
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def locked(path: str, shared: bool = False) -> Iterator[None]:
+    """Hold ``flock`` on ``path``, created if missing, for the duration of the block."""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,140 @@
+"""Timings of the ingest stages and of T5, kept with each document and exported to Prometheus.
+
+A stage runs inside ``timed(stage, timings)``, which writes its seconds, and the
+bytes it handled if the block sets them, into ``timings``. That's a plain dict
+carried in the document's metadata as ``stage_timings``, so it survives the
+trip back from an OCR pool process and ends up in the store with the
+document. Metrics recorded in a pool process would be lost with it, so
+histograms are only fed by ``observe`` once the timings are back in the
+process that serves them with ``serve``.
+"""
+
+import math
+import threading
+from contextlib import contextmanager
+from time import perf_counter_ns
+from typing import Dict, Iterator, List, Optional
+
+from prometheus_client import Counter, Histogram, start_http_server
+
+STAGES = ("write", "decode", "flatten", "threshold", "thumbnail", "dhash", "ocr", "summarize", "index", "store")
+
+STAGE_SECONDS = Histogram(
+    "docs_ingest_stage_seconds", "Time spent in each ingest stage", ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+STAGE_BYTES = Histogram(
+    "docs_ingest_stage_bytes", "Bytes each ingest stage read or produced", ["stage"],
+    buckets=(1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8),
+)
+STAGE_FAILURES = Counter("docs_ingest_stage_failures", "Ingest stages that raised", ["stage"])
+DOCUMENTS = Counter("docs_ingest_documents", "Documents ingested, new or from cached results", ["result"])
+
+T5_PROMPT_TOKENS = Histogram(
+    "docs_t5_prompt_tokens", "Encoder tokens of the final summary prompt",
+    buckets=(16, 32, 64, 128, 256, 384, 512),
+)
+T5_GENERATED_TOKENS = Histogram(
+    "docs_t5_generated_tokens", "Tokens decoded per summary", buckets=(1, 5, 10, 25, 50, 75, 100, 150, 200),
+)
+T5_TOKENS_PER_SEC = Histogram(
+    "docs_t5_tokens_per_second", "Decode rate of each summary", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+T5_TIME_TO_FIRST_TOKEN = Histogram(
+    "docs_t5_time_to_first_token_seconds", "Seconds from starting a summary to its first token",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+T5_SECONDS = Histogram(
+    "docs_t5_summary_seconds", "Seconds per summary, condensing long text included",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+
+_server_lock = threading.Lock()
+_server_port = None
+
+
+@contextmanager
+def timed(stage: str, timings: dict) -> Iterator[dict]:
+    """Time the block into ``timings[stage]``, set ``["bytes"]`` on the yielded dict to record a size.
+
+    Nothing is recorded for a block that raises, apart from counting the failure.
+    """
+    entry = {}
+    start = perf_counter_ns()
+    try:
+        yield entry
+    except BaseException:
+        STAGE_FAILURES.labels(stage).inc()
+        raise
+    timings[stage] = {"seconds": (perf_counter_ns() - start) / 1.0e9, **entry}
+
+
+def observe(timings: Dict[str, dict]):
+    """Feed a document's stage timings into the histograms, once per document."""
+    for stage, entry in timings.items():
+        STAGE_SECONDS.labels(stage).observe(entry["seconds"])
+        if entry.get("bytes") is not None:
+            STAGE_BYTES.labels(stage).observe(entry["bytes"])
+
+
+def observe_summary(stream):
+    """Record a finished ``summarizer.SummaryStream``."""
+    if stream.prompt_tokens is not None:
+        T5_PROMPT_TOKENS.observe(stream.prompt_tokens)
+    T5_GENERATED_TOKENS.observe(stream.tokens)
+    if stream.time_to_first_token is not None:
+        T5_TIME_TO_FIRST_TOKEN.observe(stream.time_to_first_token)
+    if stream.tokens_per_sec is not None:
+        T5_TOKENS_PER_SEC.observe(stream.tokens_per_sec)
+    T5_SECONDS.observe(stream.elapsed)
+
+
+def serve(port: int, addr: str = "127.0.0.1") -> int:
+    """Serve the metrics over HTTP for Prometheus to scrape, once per process."""
+    global _server_port
+    with _server_lock:
+        if _server_port is None:
+            start_http_server(port, addr)
+            _server_port = port
+        return _server_port
+
+
+def _quantile(buckets: List[tuple], count: float, q: float) -> Optional[float]:
+    # interpolated within the bucket the rank falls in, like PromQL's histogram_quantile
+    if not count:
+        return None
+    rank = q * count
+    lower, below = 0.0, 0.0
+    for upper, cumulative in buckets:
+        if cumulative >= rank:
+            if math.isinf(upper):
+                return lower
+            return lower + (upper - lower) * (rank - below) / (cumulative - below)
+        lower, below = upper, cumulative
+    return lower
+
+
+def summary(histogram: Histogram) -> List[dict]:
+    """Count, mean and estimated median and p95 of every labelled series of a histogram."""
+    series = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            labels = {k: v for k, v in sample.labels.items() if k != "le"}
+            row = series.setdefault(tuple(labels.items()), {**labels, "buckets": []})
+            if sample.name.endswith("_bucket"):
+                row["buckets"].append((float(sample.labels["le"]), sample.value))
+            elif sample.name.endswith("_count"):
+                row["count"] = sample.value
+            elif sample.name.endswith("_sum"):
+                row["sum"] = sample.value
+    rows = []
+    for row in series.values():
+        buckets, count, total = row.pop("buckets"), row.pop("count", 0), row.pop("sum", 0.0)
+        rows.append({
+            **row,
+            "count": int(count),
+            "mean": total / count if count else None,
+            "p50": _quantile(buckets, count, 0.5),
+            "p95": _quantile(buckets, count, 0.95),
+        })
+    return rows
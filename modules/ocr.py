@@ -0,0 +1,169 @@
+"""Layout-aware OCR: find a page's text blocks, read them concurrently, keep the word boxes.
+
+Blocks come from the threshold image ingestion already makes: ink dilated until
+the words of a paragraph run together, then one box per contour. They're put
+in reading order by recursive XY cuts, splitting at whitespace that runs the
+whole way across, rows before columns, so a two column page reads down one
+column and then the other.
+
+Each tesseract call starts a process that loads its language data, around a
+tenth of a second, so blocks aren't read one call each. The blocks, in
+reading order, are split into one run per thread, and each run is pasted as a
+stack onto a white canvas and read with a single ``image_to_data`` call.
+Tesseract runs in its own process, so the threads read in parallel. Word boxes
+are mapped back to page coordinates, so search hits can be highlighted
+without running OCR again.
+"""
+
+import os
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import pytesseract
+
+from modules.index import tokenize
+from modules.page import to_photo
+
+Box = Tuple[int, int, int, int]  # x, y, width, height
+# a single column of text of variable sizes, which is what a stack of blocks is
+TESSERACT_CONFIG = "--psm 4"
+GAP = 24  # white pixels around and between the stacked blocks
+
+
+def text_blocks(threshold: np.ndarray, min_height: int = 8) -> List[Box]:
+    """Boxes around the blocks of text of a threshold image, in reading order.
+
+    Blocks under ``min_height`` pixels, or with fewer than ``min_height ** 2``
+    ink pixels, are specks and dropped.
+    """
+    height, width = threshold.shape[:2]
+    ink = cv2.bitwise_not(threshold)
+    # wide enough to join the words of a line, tall enough to join its lines
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, width // 80), max(3, height // 200)))
+    contours, _ = cv2.findContours(cv2.dilate(ink, kernel), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if h >= min_height and w >= min_height and cv2.countNonZero(ink[y:y + h, x:x + w]) >= min_height ** 2:
+            boxes.append((x, y, w, h))
+    return reading_order(boxes)
+
+
+def _split(boxes: Sequence[Box], axis: int) -> List[List[Box]]:
+    """Groups of boxes separated by gaps along ``axis`` (0 is x, 1 is y) that no box crosses."""
+    groups = []
+    end = None
+    for box in sorted(boxes, key=lambda b: b[axis]):
+        if end is None or box[axis] >= end:
+            groups.append([box])
+            end = box[axis] + box[axis + 2]
+        else:
+            groups[-1].append(box)
+            end = max(end, box[axis] + box[axis + 2])
+    return groups
+
+
+def reading_order(boxes: Sequence[Box]) -> List[Box]:
+    if len(boxes) <= 1:
+        return list(boxes)
+    for axis in (1, 0):  # rows, then columns
+        groups = _split(boxes, axis)
+        if len(groups) > 1:
+            return [box for group in groups for box in reading_order(group)]
+    # overlapping boxes, nothing to cut between
+    return sorted(boxes, key=lambda b: (b[1], b[0]))
+
+
+def _runs(boxes: List[Box], n: int) -> List[List[Box]]:
+    """Split boxes into at most ``n`` consecutive runs of about the same area."""
+    target = sum(w * h for _, _, w, h in boxes) / n
+    runs, area = [[]], 0
+    for box in boxes:
+        if runs[-1] and area >= target and len(runs) < n:
+            runs.append([])
+            area = 0
+        runs[-1].append(box)
+        area += box[2] * box[3]
+    return runs
+
+
+def _read_run(threshold: np.ndarray, boxes: List[Box]) -> Tuple[str, List[list]]:
+    width = max(w for _, _, w, _ in boxes) + 2 * GAP
+    height = sum(h for _, _, _, h in boxes) + GAP * (len(boxes) + 1)
+    canvas = np.full((height, width), 255, dtype=np.uint8)
+    offsets = []
+    y = GAP
+    for bx, by, bw, bh in boxes:
+        canvas[y:y + bh, GAP:GAP + bw] = threshold[by:by + bh, bx:bx + bw]
+        offsets.append(y)
+        y += bh + GAP
+
+    data = pytesseract.image_to_data(canvas, config=TESSERACT_CONFIG, output_type=pytesseract.Output.DICT)
+    words = []
+    lines = {}
+    for i, text in enumerate(data["text"]):
+        text = text.strip()
+        if not text:
+            continue
+        left, top, w, h = data["left"][i], data["top"][i], data["width"][i], data["height"][i]
+        k = max(0, bisect_right(offsets, top + h // 2) - 1)  # the block the word was pasted from
+        bx, by = boxes[k][:2]
+        words.append([text, left - GAP + bx, top - offsets[k] + by, w, h])
+        key = (k, data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(text)
+
+    parts = []
+    paragraph = None
+    for key in sorted(lines, key=lambda key: key[0]):  # stable, keeps tesseract's order within a block
+        if parts:
+            parts.append("\n\n" if key[:3] != paragraph else "\n")
+        parts.append(" ".join(lines[key]))
+        paragraph = key[:3]
+    return "".join(parts), words
+
+
+def read(threshold: np.ndarray, threads: Optional[int] = None) -> Tuple[str, List[list]]:
+    """OCR a threshold image block by block on ``threads`` threads, every core by default.
+
+    :returns: the text in reading order, paragraphs separated by blank lines,
+        and its words as ``[text, x, y, width, height]`` in image pixels
+    """
+    height, width = threshold.shape[:2]
+    blocks = text_blocks(threshold) or [(0, 0, width, height)]
+    runs = _runs(blocks, threads or os.cpu_count() or 1)
+    if len(runs) == 1:
+        return _read_run(threshold, runs[0])
+    with ThreadPoolExecutor(len(runs)) as pool:
+        results = list(pool.map(lambda run: _read_run(threshold, run), runs))
+    return "\n\n".join(text for text, _ in results if text), [w for _, words in results for w in words]
+
+
+def matching_words(words: List[list], query: str) -> List[Box]:
+    """Boxes of the words matching a search query, each query term as a prefix like the index."""
+    terms = tokenize(query)
+    return [
+        tuple(box) for text, *box in words
+        if any(t.startswith(q) for t in tokenize(text) for q in terms)
+    ]
+
+
+def highlight(
+    img: np.ndarray, boxes: List[Box], transform: Optional[list] = None, color: Tuple[int, int, int] = (0, 200, 255)
+) -> np.ndarray:
+    """A copy of a BGR image with the boxes shaded and outlined.
+
+    Boxes found on a flattened page are drawn on the photo it came from through
+    the page's ``transform``, see ``modules.page.flatten``.
+    """
+    polygons = [np.float32([[x, y], [x + w, y], [x + w, y + h], [x, y + h]]) for x, y, w, h in boxes]
+    if transform is not None:
+        polygons = [to_photo(transform, p) for p in polygons]
+    polygons = [np.round(p).astype(np.int32) for p in polygons]
+    shaded = img.copy()
+    cv2.fillPoly(shaded, polygons, color)
+    out = cv2.addWeighted(shaded, 0.35, img, 0.65, 0)
+    cv2.polylines(out, polygons, True, color, 2)
+    return out
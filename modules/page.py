@@ -0,0 +1,130 @@
+"""Find the page in a photo, flatten and straighten it, and scale it to a fixed DPI before OCR.
+
+A phone photo of a document is mostly table, at twelve megapixels, and tesseract
+reads all of it. Here the page's four corners are found on a downscaled copy,
+the flattened page is checked for skew from the rectangle around its ink, and
+the perspective, rotation and scale to ``DPI`` make a single 3x3 transform.
+The full size photo is then resampled once, with ``warpPerspective``. The
+transform is kept, so word boxes found on the page can be drawn back onto the
+original photo.
+"""
+
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+DPI = 300
+PAGE_WIDTH_INCHES = 8.5  # letter, the scale assumes the page spans this
+DETECT_SIZE = 800  # long side of the copy the page and its skew are found on
+MAX_SKEW = 15.0  # degrees, anything more is taken as a misreading
+MAX_UPSCALE = 2.0
+
+
+def order_corners(points: np.ndarray) -> np.ndarray:
+    """Four points as top left, top right, bottom right, bottom left."""
+    points = points.reshape(4, 2).astype(np.float32)
+    total = points.sum(axis=1)
+    diff = points[:, 1] - points[:, 0]
+    return points[[np.argmin(total), np.argmin(diff), np.argmax(total), np.argmax(diff)]]
+
+
+def find_page(gray: np.ndarray, min_area: float = 0.25) -> Optional[np.ndarray]:
+    """Corners of the largest four sided outline covering ``min_area`` of the image, or None."""
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    image_area = gray.shape[0] * gray.shape[1]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(contour) < min_area * image_area:
+            break
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            return order_corners(approx)
+    return None
+
+
+def skew_angle(gray: np.ndarray, max_skew: float = MAX_SKEW) -> float:
+    """Degrees the ink of a page is turned counterclockwise, 0 past ``max_skew``."""
+    ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    points = cv2.findNonZero(ink)
+    if points is None or len(points) < 100:
+        return 0.0
+    angle = cv2.minAreaRect(points)[2]
+    # OpenCV versions report the rectangle's angle in [0, 90) or in (-90, 0], either
+    # way its sides are at angle and angle + 90, the one nearest level is the text's
+    angle = 45 - (angle + 45) % 90
+    return angle if abs(angle) <= max_skew else 0.0
+
+
+def _scaling(k: float) -> np.ndarray:
+    return np.diag([k, k, 1.0])
+
+
+def page_transform(
+    img: np.ndarray, dpi: int = DPI, page_width: float = PAGE_WIDTH_INCHES
+) -> Tuple[np.ndarray, Tuple[int, int], dict]:
+    """The transform from the photo to the flat, straight page at ``dpi``.
+
+    :returns: the 3x3 matrix, the ``(width, height)`` of the page it makes, and
+        what was found: ``{"found", "skew", "scale"}``
+    """
+    height, width = img.shape[:2]
+    s = min(1.0, DETECT_SIZE / max(height, width))
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+
+    quad = find_page(small)
+    found = quad is not None
+    if found:
+        quad = quad / s
+    else:
+        quad = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    page_w = max(np.linalg.norm(quad[1] - quad[0]), np.linalg.norm(quad[2] - quad[3]))
+    page_h = max(np.linalg.norm(quad[3] - quad[0]), np.linalg.norm(quad[2] - quad[1]))
+    flat = cv2.getPerspectiveTransform(quad, np.float32([[0, 0], [page_w, 0], [page_w, page_h], [0, page_h]]))
+
+    # skew is measured on the flattened page at the detection size
+    small_flat = cv2.warpPerspective(
+        small, _scaling(s) @ flat @ _scaling(1 / s), (round(page_w * s), round(page_h * s)), borderValue=255
+    )
+    angle = skew_angle(small_flat)
+    rotate = np.eye(3)
+    # turned back clockwise, getRotationMatrix2D's positive angles are counterclockwise
+    rotate[:2] = cv2.getRotationMatrix2D((page_w / 2, page_h / 2), -angle, 1.0)
+    cos, sin = abs(np.cos(np.radians(angle))), abs(np.sin(np.radians(angle)))
+    turned_w, turned_h = page_w * cos + page_h * sin, page_w * sin + page_h * cos
+    rotate[:2, 2] += (turned_w - page_w) / 2, (turned_h - page_h) / 2
+
+    scale = min(dpi * page_width / turned_w, MAX_UPSCALE)
+    matrix = _scaling(scale) @ rotate @ flat
+    size = (max(1, round(turned_w * scale)), max(1, round(turned_h * scale)))
+    return matrix, size, {"found": found, "skew": angle, "scale": scale}
+
+
+def flatten(img: np.ndarray, dpi: int = DPI, page_width: float = PAGE_WIDTH_INCHES) -> Tuple[np.ndarray, dict]:
+    """Crop, flatten, deskew and resample a photo of a page, see ``page_transform``.
+
+    :returns: the page, and ``{"found", "skew", "scale", "transform"}`` with the
+        transform as 9 floats, row by row
+    """
+    matrix, size, info = page_transform(img, dpi, page_width)
+    info["transform"] = matrix.flatten().tolist()
+    if np.allclose(matrix, np.eye(3), atol=1e-3):
+        return img, info
+    scale = info["scale"]
+    border = 255 if img.ndim == 2 else (255, 255, 255)
+    if scale < 0.75:
+        # shrink with area averaging first, warpPerspective alone would alias
+        # (barely, above three quarters, and INTER_AREA at odd ratios is slow)
+        shrunk = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        matrix = matrix @ _scaling(1 / scale)
+        return cv2.warpPerspective(shrunk, matrix, size, flags=cv2.INTER_LINEAR, borderValue=border), info
+    # linear, cubic is three times slower for no difference tesseract can see at this DPI
+    return cv2.warpPerspective(img, matrix, size, flags=cv2.INTER_LINEAR, borderValue=border), info
+
+
+def to_photo(transform: list, points: np.ndarray) -> np.ndarray:
+    """Map points on the page back onto the photo it was flattened from."""
+    matrix = np.linalg.inv(np.array(transform, dtype=np.float64).reshape(3, 3))
+    return cv2.perspectiveTransform(points.reshape(-1, 1, 2).astype(np.float64), matrix).reshape(-1, 2)
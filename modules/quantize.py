@@ -0,0 +1,92 @@
+"""Weight-only quantization of the T5 linear layers.
+
+Two symmetric formats, both stored as ``<layer>.weight`` plus ``<layer>.scales``:
+
+- int8: ``weight`` is int8 [out x in], one scale per output channel, scales [out x 1].
+- int4: ``weight`` is uint8 [out x in / 2], two values per byte (low nibble first)
+  stored with a +8 offset, one scale per ``group_size`` inputs, scales
+  [out x in / group_size].
+
+Dequantized weights are ``scales * q`` (int8) and ``scales * (nibble - 8)`` (int4).
+Embeddings and the relative position bias stay in full precision.
+"""
+
+import numpy as np
+
+QUANTIZED_LAYERS = (
+    "query_proj", "key_proj", "value_proj", "out_proj",
+    "wi", "wi_0", "wi_1", "wo",
+    "lm_head.linear",
+)
+GROUP_SIZES = (32, 64, 128)  # the int4 groups mx.quantized_matmul supports
+
+
+def is_quantizable(name: str, w: np.ndarray) -> bool:
+    """Whether a converted weight name belongs to a linear layer worth quantizing."""
+    return w.ndim == 2 and name.endswith(".weight") and name[:-len(".weight")].endswith(QUANTIZED_LAYERS)
+
+
+def quantize_int8(w: np.ndarray):
+    """Per output channel symmetric int8, returns ``(q, scales)``."""
+    w = w.astype(np.float32)
+    scales = np.abs(w).max(axis=1, keepdims=True) / 127
+    scales[scales == 0] = 1
+    q = np.clip(np.round(w / scales), -127, 127).astype(np.int8)
+    return q, scales.astype(np.float16)
+
+
+def quantize_int4(w: np.ndarray, group_size: int = 64):
+    """Grouped symmetric 4-bit, two values packed per byte, returns ``(packed, scales)``."""
+    out_dims, in_dims = w.shape
+    if in_dims % group_size:
+        raise ValueError(f"group_size {group_size} doesn't divide the {in_dims} input dims")
+    groups = w.astype(np.float32).reshape(out_dims, in_dims // group_size, group_size)
+    scales = np.abs(groups).max(axis=2, keepdims=True) / 7
+    scales[scales == 0] = 1
+    q = (np.clip(np.round(groups / scales), -8, 7) + 8).astype(np.uint8).reshape(out_dims, in_dims)
+    packed = q[:, 0::2] | (q[:, 1::2] << 4)
+    return packed, scales[..., 0].astype(np.float16)
+
+
+def unpack_int4(packed: np.ndarray) -> np.ndarray:
+    """Unpacked 4-bit values as int8 in [-8, 7], [out x in]."""
+    q = np.empty((packed.shape[0], packed.shape[1] * 2), dtype=np.int8)
+    q[:, 0::2] = packed & 0x0F
+    q[:, 1::2] = packed >> 4
+    return q - 8
+
+
+def bits(weight: np.ndarray) -> int:
+    """Bits per value of a quantized weight, from its storage dtype."""
+    return 8 if weight.dtype == np.int8 else 4
+
+
+def dequantize(weight: np.ndarray, scales: np.ndarray, dtype=np.float32) -> np.ndarray:
+    if bits(weight) == 8:
+        return weight.astype(dtype) * scales.astype(dtype)
+    q = unpack_int4(weight).astype(dtype)
+    out_dims, in_dims = q.shape
+    group_size = in_dims // scales.shape[1]
+    q = q.reshape(out_dims, -1, group_size) * scales.astype(dtype)[..., None]
+    return q.reshape(out_dims, in_dims)
+
+
+def quantize_weights(weights: dict, mode: str, group_size: int = 64) -> dict:
+    """Quantize the linear layers of a ``{name: array}`` mapping, ``mode`` is int8 or int4."""
+    out = {}
+    for name, w in weights.items():
+        out.update(quantize_tensor(name, w, mode, group_size))
+    return out
+
+
+def quantize_tensor(name: str, w: np.ndarray, mode: str, group_size: int = 64) -> dict:
+    """``{name: array}`` entries for one converted tensor, quantized when it's a linear layer."""
+    if mode is None or not is_quantizable(name, w):
+        return {name: w}
+    if mode == "int8":
+        q, scales = quantize_int8(w)
+    elif mode == "int4":
+        q, scales = quantize_int4(w, group_size)
+    else:
+        raise ValueError(f"Unknown quantization: {mode}, expected int8 or int4")
+    return {name: q, name[:-len("weight")] + "scales": scales}
@@ -0,0 +1,427 @@
+"""Summarization server: one process owns the T5 model for every app process.
+
+Each Streamlit server that summarizes in process loads its own copy of the
+multi-gigabyte model, and a crash while generating takes the app down with
+it. ``SummaryServer`` is a small HTTP server on localhost that holds the only
+copy. App processes talk to it through ``SummarizerClient``:
+
+- ``POST /summarize`` with ``{"text": ...}`` answers with newline delimited
+  JSON, a ``{"delta": ...}`` line per piece of the summary as it's generated
+  and then a line with the summary, its embedding and T5's timings.
+- ``POST /embed`` with ``{"texts": [...]}`` answers with their embeddings.
+- ``GET /stats`` reports the queue and latencies.
+
+Requests wait in a bounded queue for the one thread that runs the model,
+embeddings ahead of summaries since they're short and someone is waiting on a
+search. When the queue is full the server answers 503 with a ``Retry-After``
+guessed from the queue length and recent summary times, and the client waits
+that long before trying again. A client that hangs up, or times out, cancels
+its request: a queued one is skipped, a running summary stops at its next
+decode sync.
+
+``LocalSummarizer`` has the client's interface and runs the model in the
+calling process, which is what the app does without a server, and what the
+server itself runs.
+"""
+
+import itertools
+import json
+import math
+import queue
+import select
+import socket
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import median
+from time import perf_counter_ns
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import modules.summarizer as summarizer
+from modules import metrics
+from modules.vectors import pack, unpack
+
+PRIORITIES = {"embed": 0, "summarize": 1}
+HANG_UP_POLL_SECONDS = 0.5  # how often a waiting handler checks that its client is still there
+
+
+class ServerBusy(RuntimeError):
+    """The server's queue stayed full for longer than the client would wait."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"summarization server busy, retry after {retry_after:.0f} s")
+        self.retry_after = retry_after
+
+
+class ServerTimeout(TimeoutError):
+    """The server sent nothing for the client's ``timeout`` seconds."""
+
+    def __init__(self, timeout: float):
+        super().__init__(f"summarization server sent nothing for {timeout:g} s")
+        self.timeout = timeout
+
+
+class LocalSummarizer:
+    """Summarize and embed in this process, loading the model here."""
+
+    def stream(self, text: str, cancelled: Optional[Callable[[], bool]] = None) -> summarizer.SummaryStream:
+        return summarizer.SummaryStream(text, cancelled=cancelled)
+
+    def embed(self, texts: List[str]):
+        return summarizer.embed(texts)
+
+    def warm_up(self):
+        summarizer.warm_up(summarizer.SummaryStream.default_model, summarizer.SummaryStream.dtype)
+
+
+class RemoteSummaryStream:
+    """A summary generated by the server, iterated like ``summarizer.SummaryStream``.
+
+    Once iterated it has the same ``summary``, ``embedding`` and timings, which
+    are recorded in this process's ``modules.metrics`` too.
+    """
+
+    def __init__(self, client: "SummarizerClient", prompt: str, cancelled: Optional[Callable[[], bool]] = None):
+        self.prompt = prompt
+        self.chunked = False
+        self.summary = None
+        self.embedding = None
+        self.tokens = 0
+        self.prompt_tokens = None
+        self.time_to_first_token = None
+        self.tokens_per_sec = None
+        self.elapsed = None
+        self._client = client
+        self._cancelled = cancelled or (lambda: False)
+        self._parts = []
+
+    @property
+    def text(self) -> str:
+        """The raw summary generated so far."""
+        return "".join(self._parts)
+
+    def __iter__(self) -> Iterator[str]:
+        messages = self._client._request("/summarize", {"text": self.prompt})
+        finished = False
+        for message in messages:
+            if self._cancelled():
+                messages.close()  # hangs up, which cancels it in the server
+                return
+            if "delta" in message:
+                self._parts.append(message["delta"])
+                yield message["delta"]
+            else:
+                self.embedding = unpack(message.pop("embedding"))
+                for name, value in message.items():
+                    setattr(self, name, value)
+                finished = True
+        if not finished:
+            raise ConnectionError("summarization server hung up before the summary was finished")
+        metrics.observe_summary(self)
+
+
+class SummarizerClient:
+    """Summarize and embed on a ``SummaryServer``, the interface of ``LocalSummarizer``.
+
+    A full queue is waited out for up to ``max_wait`` seconds, then
+    ``ServerBusy`` is raised. A server that sends nothing for ``timeout``
+    seconds, while a request waits in its queue or between deltas, raises
+    ``ServerTimeout``. One that's down or dies mid-request raises ``OSError``,
+    and a summary that failed in the server ``RuntimeError``.
+    """
+
+    def __init__(self, url: str = "http://127.0.0.1:8765", timeout: float = 600.0, max_wait: float = 300.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.max_wait = max_wait
+
+    def _request(self, path: str, payload: Optional[dict] = None) -> Iterator[dict]:
+        data = None if payload is None else json.dumps(payload).encode()
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            request = urllib.request.Request(self.url + path, data, {"Content-Type": "application/json"})
+            try:
+                response = urllib.request.urlopen(request, timeout=self.timeout)
+                break
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    raise
+                retry_after = float(e.headers.get("Retry-After", 1))
+                if time.monotonic() + retry_after > deadline:
+                    raise ServerBusy(retry_after) from e
+                time.sleep(retry_after)
+            except urllib.error.URLError as e:
+                if isinstance(e.reason, TimeoutError):
+                    raise ServerTimeout(self.timeout) from e
+                raise
+            except TimeoutError as e:
+                raise ServerTimeout(self.timeout) from e
+        with response:
+            lines = iter(response)
+            while True:
+                try:
+                    line = next(lines, None)
+                except TimeoutError as e:
+                    raise ServerTimeout(self.timeout) from e
+                if line is None:
+                    return
+                message = json.loads(line)
+                if "error" in message:
+                    raise RuntimeError(f"summarization server: {message['error']}")
+                yield message
+
+    def stream(self, text: str, cancelled: Optional[Callable[[], bool]] = None) -> RemoteSummaryStream:
+        return RemoteSummaryStream(self, text, cancelled)
+
+    def embed(self, texts: List[str]):
+        from modules.vectors import normalize
+
+        message = next(self._request("/embed", {"texts": texts}))
+        return normalize([unpack(e) for e in message["embeddings"]])
+
+    def stats(self) -> dict:
+        return next(self._request("/stats"))
+
+    def warm_up(self):
+        # the server loads its model when it starts, this only checks that it's up
+        self.stats()
+
+
+class _Request:
+    def __init__(self, kind: str, payload: dict):
+        self.kind = kind
+        self.payload = payload
+        self.queued = perf_counter_ns()
+        self.messages = queue.Queue()  # from the model thread to the handler, None at the end
+        self.cancelled = False
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "SummaryServer"
+
+    def _send_json(self, status: int, message: dict, headers: Tuple[Tuple[str, str], ...] = ()):
+        body = (json.dumps(message) + "\n").encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"error": f"no {self.path}"})
+
+    def do_POST(self):
+        kind = {"/summarize": "summarize", "/embed": "embed"}.get(self.path)
+        if kind is None:
+            self._send_json(404, {"error": f"no {self.path}"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            field, expected = ("text", str) if kind == "summarize" else ("texts", list)
+            if not isinstance(payload, dict) or not isinstance(payload.get(field), expected):
+                raise ValueError(f"expected {{\"{field}\": {expected.__name__}}}")
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            request = self.server.submit(kind, payload)
+        except queue.Full:
+            retry_after = self.server.retry_after()
+            self._send_json(503, {"error": "queue full", "retry_after": retry_after}, (("Retry-After", str(retry_after)),))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    message = request.messages.get(timeout=HANG_UP_POLL_SECONDS)
+                except queue.Empty:
+                    # waiting in the queue or between deltas, nothing is written to notice a hang up
+                    if self._hung_up():
+                        request.cancelled = True
+                        return
+                    continue
+                if message is None:
+                    return
+                self.wfile.write((json.dumps(message) + "\n").encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            request.cancelled = True
+
+    def _hung_up(self) -> bool:
+        """Whether the client closed the connection, it sends nothing after its request."""
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.connection.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+
+    def log_message(self, format, *args):
+        pass  # a line per request drowns out everything else
+
+
+class SummaryServer(ThreadingHTTPServer):
+    """Serve ``service`` (a ``LocalSummarizer`` by default) to other processes, see the module docstring.
+
+    Up to ``max_queue`` requests wait beyond the one being run. With ``warm_up``
+    the model is loaded before the first request is taken.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 8765),
+        max_queue: int = 16,
+        service=None,
+        warm_up: bool = False,
+        history: int = 256,
+    ):
+        super().__init__(address, _Handler)
+        self.service = service or LocalSummarizer()
+        self.max_queue = max_queue
+        self.warm_up = warm_up
+        self._requests = queue.PriorityQueue(max_queue)
+        self._order = itertools.count()  # first in, first out within a priority
+        self._lock = threading.Lock()
+        self._counts = {"completed": 0, "failed": 0, "rejected": 0, "cancelled": 0}
+        self._running = None
+        self._waits = deque(maxlen=history)
+        self._services = {kind: deque(maxlen=history) for kind in PRIORITIES}
+        self._model_thread = threading.Thread(target=self._run_model, name="summary-server-model", daemon=True)
+        self._model_thread.start()
+
+    def start(self) -> threading.Thread:
+        """Serve on a background thread, stop with ``shutdown``."""
+        thread = threading.Thread(target=self.serve_forever, name="summary-server", daemon=True)
+        thread.start()
+        return thread
+
+    def submit(self, kind: str, payload: dict) -> _Request:
+        """Queue a request, raises ``queue.Full`` when there's no room."""
+        request = _Request(kind, payload)
+        try:
+            self._requests.put_nowait((PRIORITIES[kind], next(self._order), request))
+        except queue.Full:
+            with self._lock:
+                self._counts["rejected"] += 1
+            raise
+        return request
+
+    def retry_after(self) -> int:
+        """Whole seconds until there's likely room in the queue."""
+        with self._lock:
+            recent = list(self._services["summarize"])
+        # room opens up as each summary finishes
+        return max(1, math.ceil(median(recent))) if recent else 5
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            services = {kind: sorted(s) for kind, s in self._services.items()}
+            return {
+                "queued": self._requests.qsize(),
+                "max_queue": self.max_queue,
+                "running": self._running,
+                **self._counts,
+                "wait_seconds": _percentiles(waits),
+                **{f"{kind}_seconds": _percentiles(s) for kind, s in services.items()},
+            }
+
+    def _run_model(self):
+        if self.warm_up:
+            try:
+                self.service.warm_up()
+            except Exception:
+                traceback.print_exc()
+        while True:
+            _, _, request = self._requests.get()
+            start = perf_counter_ns()
+            with self._lock:
+                self._waits.append((start - request.queued) / 1.0e9)
+                self._running = request.kind
+            outcome = "completed"
+            try:
+                if not self._run(request):
+                    outcome = "cancelled"
+            except Exception:
+                outcome = "failed"
+                request.messages.put({"error": traceback.format_exc(limit=3)})
+            request.messages.put(None)
+            with self._lock:
+                self._running = None
+                self._counts[outcome] += 1
+                if outcome == "completed":
+                    self._services[request.kind].append((perf_counter_ns() - start) / 1.0e9)
+
+    def _run(self, request: _Request) -> bool:
+        """Run a request, putting its messages. False if it was cancelled."""
+        if request.cancelled:
+            return False
+        if request.kind == "embed":
+            embeddings = self.service.embed(request.payload["texts"])
+            request.messages.put({"embeddings": [pack(e) for e in embeddings]})
+            return True
+        stream = self.service.stream(request.payload["text"], cancelled=lambda: request.cancelled)
+        for delta in stream:
+            request.messages.put({"delta": delta})
+        if request.cancelled:
+            return False
+        request.messages.put({
+            "summary": stream.summary,
+            "embedding": pack(stream.embedding),
+            "chunked": stream.chunked,
+            "tokens": stream.tokens,
+            "prompt_tokens": stream.prompt_tokens,
+            "time_to_first_token": stream.time_to_first_token,
+            "tokens_per_sec": stream.tokens_per_sec,
+            "elapsed": stream.elapsed,
+        })
+        return True
+
+
+def _percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None}
+    return {"p50": values[len(values) // 2], "p95": values[min(len(values) - 1, int(0.95 * len(values)))]}
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import tomllib
+
+    parser = argparse.ArgumentParser(description="Serve T5 summaries to the app processes on this machine.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-queue", type=int, default=16, help="requests waiting before 503s")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve T5 metrics for Prometheus too")
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists("config.toml"):
+        with open("config.toml", "rb") as f:
+            config = tomllib.load(f)
+    summarizer.configure(**config.get("t5", {}))
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    server = SummaryServer((args.host, args.port), args.max_queue, warm_up=True)
+    print(f"summarizing on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,136 @@
+"""Sharded, memory-mappable weights format written by ``convert.py``.
+
+A checkpoint is a directory of raw, uncompressed ``shard-NNNNN.bin`` files plus
+an ``index.json`` mapping each tensor name to its shard, byte offset, dtype and
+shape. Tensors start on 64 byte boundaries so every one of them can be viewed
+straight out of a memory map, without reading or copying the rest.
+"""
+
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+FORMAT = "docs-t5-shards"
+ALIGNMENT = 64
+
+
+def is_sharded(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def weights_nbytes(path: str) -> int:
+    """Size on disk of an .npz file or the shards a checkpoint directory's index lists."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        shards = {entry["shard"] for entry in json.load(f)["tensors"].values()}
+    return sum(os.path.getsize(os.path.join(path, shard)) for shard in shards)
+
+
+class ShardWriter:
+    """Append tensors one at a time, starting a new shard past ``shard_size`` bytes."""
+
+    def __init__(self, path: str, shard_size: int = 2 * 1024 ** 3):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_size = shard_size
+        self.tensors = {}
+        self._shards = []
+        # an index left from an earlier conversion would describe shards about to be overwritten,
+        # and a smaller model wouldn't overwrite the last of them
+        if is_sharded(path):
+            os.remove(os.path.join(path, INDEX_FILE))
+        for f in os.listdir(path):
+            if f.startswith("shard-") and f.endswith(".bin"):
+                os.remove(os.path.join(path, f))
+        self._shard = -1
+        self._file = None
+        self._next_shard()
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        self._shard += 1
+        self._name = f"shard-{self._shard:05d}.bin"
+        self._shards.append(self._name)
+        self._file = open(os.path.join(self.path, self._name), "wb")
+
+    def add(self, name: str, array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        if self._file.tell() and self._file.tell() + array.nbytes > self.shard_size:
+            self._next_shard()
+        offset = -self._file.tell() % ALIGNMENT
+        self._file.write(b"\0" * offset)
+        self.tensors[name] = {
+            "shard": self._name,
+            "offset": self._file.tell(),
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+        }
+        self._file.write(array.tobytes())
+
+    def close(self):
+        self._file.close()
+        index = {"format": FORMAT, "version": 1, "tensors": self.tensors}
+        # the index goes last, so a directory without one is an interrupted conversion
+        tmp = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.path, INDEX_FILE))
+
+    def abort(self):
+        """Close and delete the shards written so far, leaving no index behind."""
+        self._file.close()
+        for name in self._shards:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ShardedWeights(Mapping):
+    """Read-only ``{name: np.ndarray}`` view of a sharded checkpoint.
+
+    Each shard is memory-mapped once, tensors are views into the map, so nothing
+    is read from disk until the array is actually touched.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index.get("format") != FORMAT:
+            raise ValueError(f"{path} is not a {FORMAT} checkpoint")
+        self.path = path
+        self._tensors = index["tensors"]
+        self._maps = {}
+
+    def _map(self, shard: str) -> np.memmap:
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(os.path.join(self.path, shard), dtype=np.uint8, mode="r")
+        return self._maps[shard]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        entry = self._tensors[name]
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        start = entry["offset"]
+        data = self._map(entry["shard"])[start:start + count * dtype.itemsize]
+        return data.view(dtype).reshape(entry["shape"])
+
+    def __iter__(self):
+        return iter(self._tensors)
+
+    def __len__(self) -> int:
+        return len(self._tensors)
@@ -0,0 +1,318 @@
+"""Document metadata in SQLite, replacing the map.json that was rewritten on every upload.
+
+Each document is a row keyed by its uuid, with the metadata dict as JSON and
+the upload time, tags and image hashes pulled out into indexed columns. Next
+to them, ``results`` caches what the pipeline made of each image content, so
+uploading the same image again reuses it. Each 64 bit dHash is also split into
+four 16 bit bands with an index each, so ``near_duplicates`` looks up a few
+candidates instead of comparing against every image. The database runs in
+WAL mode, so an insert appends to the log and commits on its own while other
+sessions keep reading, and each thread gets its own connection.
+"""
+
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Set
+
+from modules.index import tokenize
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    upload_time TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_upload_time ON documents (upload_time);
+CREATE TABLE IF NOT EXISTS tags (
+    doc_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+CREATE INDEX IF NOT EXISTS tags_doc_id ON tags (doc_id);
+CREATE TABLE IF NOT EXISTS hashes (
+    doc_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    sha256 TEXT NOT NULL,
+    dhash TEXT,
+    band0 INTEGER,
+    band1 INTEGER,
+    band2 INTEGER,
+    band3 INTEGER
+);
+CREATE INDEX IF NOT EXISTS hashes_sha256 ON hashes (sha256);
+CREATE INDEX IF NOT EXISTS hashes_doc_id ON hashes (doc_id);
+CREATE TABLE IF NOT EXISTS results (
+    sha256 TEXT NOT NULL,
+    pipeline_version INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (sha256, pipeline_version)
+);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    uuid TEXT NOT NULL
+);
+"""
+
+# after the bands are added to a hashes table from before them
+BANDS_SCHEMA = """
+CREATE INDEX IF NOT EXISTS hashes_band0 ON hashes (band0);
+CREATE INDEX IF NOT EXISTS hashes_band1 ON hashes (band1);
+CREATE INDEX IF NOT EXISTS hashes_band2 ON hashes (band2);
+CREATE INDEX IF NOT EXISTS hashes_band3 ON hashes (band3);
+"""
+BANDS = 4
+BAND_BITS = 16
+
+
+def dhash_bands(dhash: Optional[str]) -> List[Optional[int]]:
+    """A 64 bit hex dHash as its four 16 bit bands, most significant first."""
+    if not dhash:
+        return [None] * BANDS
+    value = int(dhash, 16)
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (BAND_BITS * (BANDS - 1 - i))) & mask for i in range(BANDS)]
+
+
+def _within(band: int, radius: int) -> List[int]:
+    """Every band value at most ``radius`` bits from ``band``."""
+    return [
+        band ^ sum(1 << bit for bit in bits)
+        for r in range(radius + 1)
+        for bits in itertools.combinations(range(BAND_BITS), r)
+    ]
+
+
+def split_tags(tags: Optional[str]) -> List[str]:
+    """The manual tags string as lowercased words, "2023 1099 tax form" is four tags."""
+    return sorted(set(tokenize(tags or "")))
+
+
+class MetadataStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+        self._add_bands()
+        with self._connection() as conn:
+            conn.executescript(BANDS_SCHEMA)
+
+    def _add_bands(self):
+        """Add and fill the band columns of a hashes table made before them."""
+        conn = self._connection()
+        # immediate, so two processes opening an old store don't both alter it
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(hashes)")}
+            if "band0" not in columns:
+                for i in range(BANDS):
+                    conn.execute(f"ALTER TABLE hashes ADD COLUMN band{i} INTEGER")
+                rows = conn.execute("SELECT rowid, dhash FROM hashes WHERE dhash IS NOT NULL").fetchall()
+                conn.executemany(
+                    "UPDATE hashes SET band0 = ?, band1 = ?, band2 = ?, band3 = ? WHERE rowid = ?",
+                    [(*dhash_bands(dhash), rowid) for rowid, dhash in rows],
+                )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def revision(self) -> tuple:
+        """Changes whenever a document is added or removed, a cheap cache key for listings."""
+        return self._connection().execute("SELECT COUNT(*), MAX(id) FROM documents").fetchone()
+
+    def __contains__(self, uuid: str) -> bool:
+        row = self._connection().execute("SELECT 1 FROM documents WHERE uuid = ?", (uuid,))
+        return row.fetchone() is not None
+
+    def add(self, metadata: dict):
+        """Insert a document's metadata, ``metadata["uuid"]`` must be new."""
+        with self._connection() as conn:
+            self._insert(conn, metadata)
+
+    def add_many(self, documents: List[dict], sources: Optional[List[tuple]] = None):
+        """Insert several documents in one transaction.
+
+        ``sources`` are the ``(path, size, mtime)`` each document was imported
+        from, recorded in the same transaction so ``imported`` can tell what an
+        interrupted import still has to do.
+        """
+        with self._connection() as conn:
+            for metadata in documents:
+                self._insert(conn, metadata)
+            if sources is not None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO imports (path, size, mtime, uuid) VALUES (?, ?, ?, ?)",
+                    [(*source, metadata["uuid"]) for source, metadata in zip(sources, documents)],
+                )
+
+    def imported(self) -> dict:
+        """``{path: (size, mtime)}`` of every file imported by ``add_many``."""
+        rows = self._connection().execute("SELECT path, size, mtime FROM imports")
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def _insert(self, conn: sqlite3.Connection, metadata: dict):
+        cursor = conn.execute(
+            "INSERT INTO documents (uuid, upload_time, data) VALUES (?, ?, ?)",
+            (metadata["uuid"], metadata.get("upload_time"), json.dumps(metadata)),
+        )
+        conn.executemany(
+            "INSERT INTO tags (doc_id, tag) VALUES (?, ?)",
+            [(cursor.lastrowid, tag) for tag in split_tags(metadata.get("tags"))],
+        )
+        if metadata.get("sha256"):
+            conn.execute(
+                "INSERT INTO hashes (doc_id, sha256, dhash, band0, band1, band2, band3) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cursor.lastrowid, metadata["sha256"], metadata.get("dhash"), *dhash_bands(metadata.get("dhash"))),
+            )
+
+    def with_hash(self, sha256: str) -> List[str]:
+        """Uuids of the documents whose image has this content hash, oldest first."""
+        rows = self._connection().execute(
+            "SELECT d.uuid FROM documents d JOIN hashes h ON h.doc_id = d.id WHERE h.sha256 = ? ORDER BY d.id",
+            (sha256,),
+        )
+        return [uuid for uuid, in rows]
+
+    def near_duplicates(self, dhash: str, sha256: str, max_distance: int = 6) -> List[str]:
+        """Uuids of documents with a different image within ``max_distance`` bits of ``dhash``, oldest first.
+
+        Two hashes that close agree to within ``max_distance // 4`` bits on at
+        least one band, so only the rows one of those band values finds are compared.
+        """
+        target = int(dhash, 16)
+        radius = max_distance // BANDS
+        clauses, values = [], []
+        for i, band in enumerate(dhash_bands(dhash)):
+            near = _within(band, radius)
+            clauses.append(f"h.band{i} IN ({','.join('?' * len(near))})")
+            values += near
+        rows = self._connection().execute(
+            "SELECT d.uuid, h.dhash FROM documents d JOIN hashes h ON h.doc_id = d.id"
+            f" WHERE h.sha256 != ? AND ({' OR '.join(clauses)}) ORDER BY d.id",
+            (sha256, *values),
+        )
+        return [uuid for uuid, other in rows if (int(other, 16) ^ target).bit_count() <= max_distance]
+
+    def cached_result(self, sha256: str, pipeline_version: int) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT data FROM results WHERE sha256 = ? AND pipeline_version = ?", (sha256, pipeline_version)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def cache_result(self, sha256: str, pipeline_version: int, result: dict):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (sha256, pipeline_version, data) VALUES (?, ?, ?)",
+                (sha256, pipeline_version, json.dumps(result)),
+            )
+
+    def cached_hashes(self, pipeline_version: int) -> Set[str]:
+        rows = self._connection().execute(
+            "SELECT sha256 FROM results WHERE pipeline_version = ?", (pipeline_version,)
+        )
+        return {sha256 for sha256, in rows}
+
+    def update(self, uuid: str, **fields):
+        """Merge ``fields`` into a document's metadata."""
+        conn = self._connection()
+        # immediate, a deferred read would fail to upgrade when another process writes first
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM documents WHERE uuid = ?", (uuid,)).fetchone()
+            if row is None:
+                raise KeyError(uuid)
+            conn.execute(
+                "UPDATE documents SET data = ? WHERE uuid = ?",
+                (json.dumps({**json.loads(row[0]), **fields}), uuid),
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def remove(self, uuid: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM documents WHERE uuid = ?", (uuid,))
+
+    def get(self, uuid: str) -> dict:
+        row = self._connection().execute("SELECT data FROM documents WHERE uuid = ?", (uuid,)).fetchone()
+        if row is None:
+            raise KeyError(uuid)
+        return json.loads(row[0])
+
+    def get_many(self, uuids: Iterable[str]) -> List[dict]:
+        """Metadata of the documents that exist, in the order of ``uuids``."""
+        conn = self._connection()
+        found = {}
+        uuids = list(uuids)
+        for i in range(0, len(uuids), 500):  # stay under SQLite's bound parameter limit
+            chunk = uuids[i:i + 500]
+            rows = conn.execute(
+                f"SELECT uuid, data FROM documents WHERE uuid IN ({','.join('?' * len(chunk))})", chunk
+            )
+            found.update(rows)
+        return [json.loads(found[u]) for u in uuids if u in found]
+
+    def documents(self, limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        """Metadata of every document, newest upload first."""
+        rows = self._connection().execute(
+            "SELECT data FROM documents ORDER BY upload_time DESC, id DESC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset),
+        )
+        return [json.loads(data) for data, in rows]
+
+    def uploaded_between(self, start: str, end: str) -> List[dict]:
+        """Documents uploaded in ``[start, end)``, both ISO format times."""
+        rows = self._connection().execute(
+            "SELECT data FROM documents WHERE upload_time >= ? AND upload_time < ? ORDER BY upload_time",
+            (start, end),
+        )
+        return [json.loads(data) for data, in rows]
+
+    def tagged(self, tag: str) -> List[dict]:
+        """Documents with a manual tag, newest upload first."""
+        rows = self._connection().execute(
+            "SELECT d.data FROM documents d JOIN tags t ON t.doc_id = d.id "
+            "WHERE t.tag = ? ORDER BY d.upload_time DESC, d.id DESC",
+            (tag.lower(),),
+        )
+        return [json.loads(data) for data, in rows]
+
+    def migrate_map_json(self, map_path: str) -> int:
+        """Import a map.json in one transaction, then rename it to map.json.migrated.
+
+        Documents already in the store are skipped, so an interrupted migration
+        can simply run again.
+
+        :returns: the number of documents imported
+        """
+        with open(map_path, "r") as map_file:
+            map_data = json.load(map_file)
+        imported = 0
+        with self._connection() as conn:
+            for key in sorted(map_data, key=int):
+                metadata = map_data[key]
+                if metadata["uuid"] not in self:
+                    self._insert(conn, metadata)
+                    imported += 1
+        os.replace(map_path, map_path + ".migrated")
+        return imported
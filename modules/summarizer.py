@@ -0,0 +1,473 @@
+"""Summarize OCR text with T5, on whichever backend suits the platform.
+
+The model code lives in a backend module with the same module tree and
+functions: ``modules.t5`` runs on MLX (Apple silicon), ``modules.t5_numpy`` runs
+anywhere NumPy does. Both load the same converted weights. This module picks
+one, keeps loaded models resident and holds the prompt handling that doesn't
+depend on the backend.
+"""
+
+import importlib
+import os
+import platform
+import re
+import threading
+from collections import OrderedDict
+from itertools import chain, islice
+from time import perf_counter_ns
+from types import ModuleType
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from modules import metrics
+
+BACKENDS = {
+    "mlx": "modules.t5",
+    "numpy": "modules.t5_numpy",
+}
+
+_backend_name = os.environ.get("T5_BACKEND", "auto")
+_quantize = None
+
+
+def default_backend() -> str:
+    """MLX on Apple silicon, NumPy everywhere else."""
+    if platform.system() == "Darwin" and platform.machine() == "arm64":
+        return "mlx"
+    return "numpy"
+
+
+def backend(name: Optional[str] = None) -> ModuleType:
+    """Import a backend module by name, ``auto`` or ``None`` picks by platform."""
+    name = name or _backend_name
+    if name == "auto":
+        name = default_backend()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown T5 backend: {name}, expected auto or one of {list(BACKENDS)}")
+    return importlib.import_module(BACKENDS[name])
+
+
+def configure(
+    backend: str = "auto",
+    memory_budget_gb: Optional[float] = None,
+    quantize: Optional[str] = None,
+    **kwargs,
+):
+    """Apply the ``[t5]`` section of the app config.
+
+    ``quantize`` (int8 or int4) loads the weights written by ``convert.py --quantize``.
+    """
+    global _backend_name, _quantize
+    _backend_name = backend
+    _quantize = quantize or None
+    set_memory_budget(None if memory_budget_gb is None else int(memory_budget_gb * 1024 ** 3))
+
+
+def _weights_path(model_name: str, quantize: Optional[str] = None) -> str:
+    """Find the converted weights for a model, named like ``convert.weights_file_name``.
+
+    A sharded directory is preferred over an .npz file. Looks next to this file
+    first, then in ``modules/`` and the working directory, so it works whether
+    the app is run from the repo root or from ``modules``.
+    """
+    from modules.shards import is_sharded
+
+    name = model_name.replace("/", "-") + (f"-{quantize}" if quantize else "")
+    roots = [os.path.dirname(os.path.abspath(__file__)), "modules", "."]
+    for root in roots:
+        if is_sharded(os.path.join(root, name)):
+            return os.path.join(root, name)
+        if os.path.exists(os.path.join(root, name + ".npz")):
+            return os.path.join(root, name + ".npz")
+    raise FileNotFoundError(
+        f"No converted weights for {name}, run `python -m modules.convert` first."
+    )
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models and tokenizers.
+
+    Entries are keyed by (backend, model name, dtype, weights path). Streamlit reruns and
+    sessions all share the imported module, so every summary after the first one
+    reuses the resident model instead of reading the weights again. When a
+    ``memory_budget`` (bytes) is set, least recently used models are unloaded
+    before a new one is loaded, using the weights' size on disk as an upper bound
+    of what the new model will need.
+
+    The models aren't safe to run from two threads at once, the ingest worker's
+    summarizer and a Streamlit session's query embedding would otherwise share
+    one. Every forward pass holds ``inference``, a stream takes it once per decode
+    step and once per batch of windows it condenses, so an embedding waits for a
+    step or a batch, not a summary.
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None):
+        self.memory_budget = memory_budget
+        self.inference = threading.RLock()
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(
+        backend: ModuleType, model_name: str, dtype: str, weights_path: Optional[str]
+    ) -> Tuple[str, str, str, str]:
+        weights_path = weights_path or _weights_path(model_name, _quantize)
+        return backend.__name__, model_name, dtype, os.path.abspath(weights_path)
+
+    @property
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(nbytes for _, _, nbytes in self._entries.values())
+
+    def loaded(self) -> List[Tuple[str, str, str, str]]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get(
+        self,
+        backend: ModuleType,
+        model_name: str,
+        dtype: str = "bfloat16",
+        weights_path: Optional[str] = None,
+    ):
+        """Return a resident ``(model, tokenizer)``, loading it on first use."""
+        from modules.shards import weights_nbytes
+
+        key = self._key(backend, model_name, dtype, weights_path)
+        # held for the whole load so concurrent sessions don't load the same weights twice
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                model, tokenizer, _ = self._entries[key]
+                return model, tokenizer
+
+            self._evict(weights_nbytes(key[3]))
+            model, tokenizer = backend.load_model(model_name, dtype, key[3])
+            self._entries[key] = (model, tokenizer, backend.model_nbytes(model))
+            return model, tokenizer
+
+    def warm_up(
+        self,
+        backend: ModuleType,
+        model_name: str,
+        dtype: str = "bfloat16",
+        weights_path: Optional[str] = None,
+    ):
+        """Load a model and generate one token so the first real request is fast."""
+        model, tokenizer = self.get(backend, model_name, dtype, weights_path)
+        with self.inference:
+            next(backend.generate("summarize: warm up", model, tokenizer, 0.0, 1)).item()
+        return model, tokenizer
+
+    def unload(self, model_name: Optional[str] = None, dtype: Optional[str] = None) -> int:
+        """Drop matching models (all of them by default), returns how many were dropped."""
+        with self._lock:
+            keys = [
+                key for key in self._entries
+                if (model_name is None or key[1] == model_name)
+                and (dtype is None or key[2] == dtype)
+            ]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def _evict(self, incoming: int):
+        if self.memory_budget is None:
+            return
+        while self._entries and self.resident_bytes + incoming > self.memory_budget:
+            self._entries.popitem(last=False)
+
+
+_registry = ModelRegistry()
+
+
+def get_model(model_name: str = "t5-3b", dtype: str = "bfloat16", weights_path: Optional[str] = None):
+    return _registry.get(backend(), model_name, dtype, weights_path)
+
+
+def warm_up(model_name: str = "t5-3b", dtype: str = "bfloat16", weights_path: Optional[str] = None):
+    return _registry.warm_up(backend(), model_name, dtype, weights_path)
+
+
+def unload(model_name: Optional[str] = None, dtype: Optional[str] = None) -> int:
+    return _registry.unload(model_name, dtype)
+
+
+def set_memory_budget(nbytes: Optional[int]):
+    """Cap the bytes of resident models, ``None`` for no limit."""
+    _registry.memory_budget = nbytes
+
+
+def _clean_text(text: str) -> str:
+    # prompt = prompt.replace('\n',' ')
+    # prompt = prompt.replace('  ', ' ')
+    text = re.sub('[^a-zA-Z0-9 \.]', '', text)
+    return " ".join([i.title() if i == i.upper() else i for i in text.split()])
+
+
+def _prepare_prompt(text: str) -> str:
+    return "summarize: " + _clean_text(text)
+
+
+def _dedupe_response(response: str) -> str:
+    response = response.split(' . ')
+    response = [i.replace(' .', '') for i in response]
+    return '. '.join(set(response))
+
+
+def _summarize_windows(
+    windows: Iterator[List[int]],
+    t5: ModuleType,
+    model,
+    tokenizer,
+    temp: float,
+    max_tokens: int,
+    batch_size: int,
+) -> List[str]:
+    """Summarize token windows ``batch_size`` at a time, in order.
+
+    Each batch holds the model on its own, so an embedding can run between them.
+    """
+    prefix = tokenizer.ids("summarize:")
+    partials = []
+    while True:
+        batch = list(islice(windows, batch_size))
+        if not batch:
+            return partials
+        inputs, attention_mask = tokenizer.pad_batch(
+            [prefix + w + [tokenizer.eos_id] for w in batch]
+        )
+        with _registry.inference:
+            generated = list(t5.generate_batch(inputs, attention_mask, model, tokenizer, temp, max_tokens))
+        for tokens in generated:
+            partials.append(tokenizer.decode(tokens).lstrip(" "))
+
+
+def _condense(
+    windows: Iterator[List[int]],
+    t5: ModuleType,
+    model,
+    tokenizer,
+    temp: float,
+    max_tokens: int,
+    batch_size: int = 8,
+    overlap: int = 64,
+) -> str:
+    """Summarize each window and join the partial summaries until they fit in one window.
+
+    Partial summaries are much shorter than their windows, so repeating this
+    until everything fits terminates quickly. The result is summarized once more
+    by the caller.
+    """
+    size = _window_size(tokenizer)
+    while True:
+        partials = _summarize_windows(windows, t5, model, tokenizer, temp, max_tokens, batch_size)
+        text = _clean_text(" ".join(partials))
+        windows = tokenizer.iter_windows(text, size, overlap)
+        head = list(islice(windows, 2))
+        if len(head) <= 1:
+            return text
+        windows = chain(head, windows)
+
+
+def _window_size(tokenizer) -> int:
+    return tokenizer.max_length - len(tokenizer.ids("summarize:")) - 1
+
+
+class SummaryStream:
+    """Summarize OCR text, yielding the summary as text deltas while it's generated.
+
+    Text longer than the encoder's 512 tokens is split into overlapping windows
+    that are summarized in batches first, only the final summary streams. Once
+    iterated, ``summary`` holds the deduplicated result, ``time_to_first_token``
+    the seconds from start to the first delta, ``prompt_tokens`` the encoder
+    tokens of the final prompt and ``tokens_per_sec`` the decode rate of the final
+    summary. The figures are also recorded in ``modules.metrics``.
+
+    The final prompt's encoder states are averaged into ``embedding``, a unit
+    length float32 vector for ``modules.vectors``, on the way to decoding.
+
+    ``cancelled`` is checked before each stage and at every sync of the decode
+    loop, once ``sync_every`` tokens, and the stream stops early when it returns
+    True, leaving ``summary`` None.
+    """
+
+    default_model = "t5-3b"
+    max_tokens = 100
+    temp = 0.5
+    dtype = "bfloat16"
+    seed = 1
+
+    def __init__(
+        self,
+        prompt: str,
+        overlap: int = 64,
+        batch_size: int = 8,
+        sync_every: int = 8,
+        cancelled: Optional[Callable[[], bool]] = None,
+    ):
+        self.prompt = prompt
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.sync_every = sync_every
+        self.cancelled = cancelled or (lambda: False)
+        self.chunked = False
+        self.summary = None
+        self.tokens = 0
+        self.prompt_tokens = None
+        self.embedding = None
+        self.time_to_first_token = None
+        self.tokens_per_sec = None
+        self.elapsed = None
+        self._detokenizer = None
+
+    @property
+    def text(self) -> str:
+        """The raw summary generated so far."""
+        return self._detokenizer.text if self._detokenizer else ""
+
+    def __iter__(self) -> Iterator[str]:
+        from modules.tokenizer import IncrementalDetokenizer  # pulls in transformers
+        from modules.vectors import normalize
+
+        t5 = backend()
+        t5.seed(self.seed)
+        model, tokenizer = get_model(self.default_model, self.dtype)
+        self._detokenizer = IncrementalDetokenizer(tokenizer)
+
+        start = perf_counter_ns()
+        text = _clean_text(self.prompt)
+        size = _window_size(tokenizer)
+        windows = tokenizer.iter_windows(text, size, self.overlap)
+        head = list(islice(windows, 2))
+        if self.cancelled():
+            return
+        if len(head) > 1:
+            self.chunked = True
+            text = _condense(
+                chain(head, windows), t5, model, tokenizer,
+                self.temp, self.max_tokens, self.batch_size, self.overlap,
+            )
+
+        prompt = "summarize: " + text
+        self.prompt_tokens = len(tokenizer.ids(prompt))
+        decode_start = perf_counter_ns()
+        if self.cancelled():
+            return
+        with _registry.inference:
+            memory = t5.encode(tokenizer.encode(prompt), None, model)
+            self.embedding = normalize(t5.pool(memory))[0]
+        steps = t5.generate_stream(prompt, model, tokenizer, self.temp, self.max_tokens, self.sync_every, memory)
+        while True:
+            if self.cancelled():
+                return
+            with _registry.inference:
+                tokens = next(steps, None)
+            if tokens is None:
+                break
+            if self.time_to_first_token is None:
+                self.time_to_first_token = (perf_counter_ns() - start) / 1.0e9
+            self.tokens += len(tokens)
+            delta = self._detokenizer.add(tokens)
+            if delta:
+                yield delta
+
+        end = perf_counter_ns()
+        self.tokens_per_sec = self.tokens / ((end - decode_start) / 1.0e9)
+        self.summary = _dedupe_response(self._detokenizer.text)
+        self.elapsed = (end - start) / 1.0e9
+        metrics.observe_summary(self)
+
+
+def summarize(prompt, overlap: int = 64, batch_size: int = 8):
+    """Summarize OCR text, see ``SummaryStream`` for a version that streams."""
+    stream = SummaryStream(prompt, overlap, batch_size)
+    for _ in stream:
+        pass
+    return stream.summary
+
+
+def summarize_batch(prompts: List[str], batch_size: int = 8, overlap: int = 64, return_embeddings: bool = False):
+    """Summarize several documents, ``batch_size`` of them per forward pass.
+
+    Documents longer than the encoder's 512 tokens are condensed with map-reduce
+    first, like ``summarize`` does. With ``return_embeddings`` the summaries
+    come with a [documents x d_model] array of embeddings, like
+    ``SummaryStream.embedding``. The model and generation settings are
+    ``SummaryStream``'s.
+    """
+    if not prompts:
+        return ([], np.zeros((0, 0), np.float32)) if return_embeddings else []
+    temp, max_tokens = SummaryStream.temp, SummaryStream.max_tokens
+
+    t5 = backend()
+    t5.seed(SummaryStream.seed)
+    model, tokenizer = get_model(SummaryStream.default_model, SummaryStream.dtype)
+
+    size = _window_size(tokenizer)
+    texts = []
+    for prompt in prompts:
+        text = _clean_text(prompt)
+        windows = tokenizer.iter_windows(text, size, overlap)
+        head = list(islice(windows, 2))
+        if len(head) > 1:
+            text = _condense(chain(head, windows), t5, model, tokenizer, temp, max_tokens, batch_size, overlap)
+        texts.append(text)
+
+    responses = []
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        batch = ["summarize: " + text for text in texts[i:i + batch_size]]
+        inputs, attention_mask = tokenizer.encode_batch(batch)
+        with _registry.inference:
+            memory = t5.encode(inputs, attention_mask, model)
+            if return_embeddings:
+                embeddings.append(t5.pool(memory, attention_mask))
+            generated = list(t5.generate_batch(inputs, attention_mask, model, tokenizer, temp, max_tokens, memory))
+        for tokens in generated:
+            responses.append(_dedupe_response(tokenizer.decode(tokens).lstrip(" ")))
+
+    if return_embeddings:
+        from modules.vectors import normalize
+
+        return responses, normalize(embeddings)
+    return responses
+
+
+def embed(texts: List[str], batch_size: int = 8):
+    """Unit length embeddings of texts, [texts x d_model], for ``modules.vectors``.
+
+    The same averaged encoder states of the summary prompt as
+    ``SummaryStream.embedding``, without generating anything. Text past the
+    encoder's 512 tokens is cut off. For search queries, and for documents
+    summarized before there were embeddings.
+    """
+    from modules.vectors import normalize
+
+    t5 = backend()
+    model, tokenizer = get_model(SummaryStream.default_model, SummaryStream.dtype)
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        inputs, attention_mask = tokenizer.encode_batch([_prepare_prompt(t) for t in texts[i:i + batch_size]])
+        with _registry.inference:
+            embeddings.append(t5.pool(t5.encode(inputs, attention_mask, model), attention_mask))
+    return normalize(embeddings)
+
+
+if __name__ == "__main__":
+    import sys
+    # print(sys.argv[1])
+    stream = SummaryStream(str(sys.argv[1]))
+    for _ in stream:
+        pass
+    if stream.chunked:
+        print('prompt:', len(stream.prompt.split()), 'words, summarized in overlapping windows', '\n')
+    else:
+        print('prompt:', _prepare_prompt(stream.prompt), '\n')
+    print(
+        'elapsed:', stream.elapsed,
+        'ttft:', stream.time_to_first_token,
+        'tokens/sec:', stream.tokens_per_sec, '\n\n',
+        'response:', stream.summary,
+    )
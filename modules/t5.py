@@ -1,16 +1,16 @@
 # stolen shamelessly from https://github.com/ml-explore/mlx-examples/blob/main/t5/t5.py
 
-from time import perf_counter_ns
-from typing import List, Optional, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import mlx.core as mx
 import mlx.nn as nn
 import numpy as np
-from mlx.utils import tree_map, tree_unflatten
-from transformers import AutoTokenizer, T5Config
+from mlx.utils import tree_flatten, tree_unflatten
+from transformers import T5Config
 
-import os
-os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+from modules import quantize
+from modules.shards import ShardedWeights, is_sharded
+from modules.tokenizer import Tokenizer
 
 
 def _relative_position_bucket(
@@ -64,7 +64,15 @@ def _relative_position_bucket(
 
 
 class RelativePositionBias(nn.Module):
-    def __init__(self, config: T5Config, bidirectional: bool):
+    """Binned relative position bias, served from a precomputed table.
+
+    The bias only depends on ``key_position - query_position``, so the full
+    (max_length x max_length) bucket grid is built once and the bias for any
+    window is a slice of it. The embedded table is rebuilt only when the
+    embedding weights change, e.g. after loading a checkpoint.
+    """
+
+    def __init__(self, config: T5Config, bidirectional: bool, max_length: int = 0):
         self.bidirectional = bidirectional
         self.num_buckets = config.relative_attention_num_buckets
         self.max_distance = config.relative_attention_max_distance
@@ -72,26 +80,91 @@ class RelativePositionBias(nn.Module):
         self.embeddings = nn.Embedding(
             config.relative_attention_num_buckets, config.num_heads
         )
-
-    def __call__(self, query_length: int, key_length: int, offset: int = 0):
-        """Compute binned relative position bias"""
-        context_position = mx.arange(offset, query_length)[:, None]
-        memory_position = mx.arange(key_length)[None, :]
-
-        # shape (query_length, key_length)
+        self._max_length = 0
+        self._buckets = None
+        self._table = None
+        self._table_weight = None
+        self.reserve(max_length)
+
+    def reserve(self, length: int):
+        """Make sure the bucket grid covers ``length`` query and key positions."""
+        if length <= self._max_length:
+            return
+        if self._max_length:
+            # grow geometrically so decoding past the reserved size doesn't rebuild every step
+            length = max(length, 2 * self._max_length)
+
+        context_position = mx.arange(length)[:, None]
+        memory_position = mx.arange(length)[None, :]
+
+        # shape (length, length)
         relative_position = memory_position - context_position
-        relative_position_bucket = _relative_position_bucket(
+        self._buckets = _relative_position_bucket(
             relative_position,
             bidirectional=self.bidirectional,
             num_buckets=self.num_buckets,
             max_distance=self.max_distance,
         )
+        self._max_length = length
+        self._table = None
+
+    def _bias_table(self) -> mx.array:
+        weight = self.embeddings.weight
+        if self._table is None or self._table_weight is not weight:
+            # shape (num_heads, length, length)
+            self._table = self.embeddings(self._buckets).transpose(2, 0, 1)
+            self._table_weight = weight
+        return self._table
+
+    def __call__(self, query_length: int, key_length: int, offset: int = 0):
+        """Compute binned relative position bias"""
+        self.reserve(max(query_length, key_length))
+
+        # shape (num_heads, query_length - offset, key_length)
+        return self._bias_table()[:, offset:query_length, :key_length]
+
+
+class KVCache:
+    """Fixed-capacity self-attention keys/values for one decoder layer.
 
-        # shape (query_length, key_length, num_heads)
-        values = self.embeddings(relative_position_bucket)
+    Keys are kept in the transposed layout ``project_kv`` returns,
+    [batch x num heads x hidden dim x sequence], values as
+    [batch x num heads x sequence x hidden dim]. Both buffers are allocated once,
+    on the first update, for ``max_tokens`` positions and each step writes into
+    them at ``offset`` instead of concatenating a fresh copy of the whole cache.
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.offset = 0
+        self.keys = None
+        self.values = None
+
+    def update(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        B, H, D, S = keys.shape
+        if self.keys is None:
+            self.keys = mx.zeros((B, H, D, self.max_tokens), keys.dtype)
+            self.values = mx.zeros((B, H, self.max_tokens, values.shape[-1]), values.dtype)
+
+        end = self.offset + S
+        if end > self.max_tokens:
+            raise ValueError(f"KV cache holds {self.max_tokens} tokens, got {end}")
+        self.keys[:, :, :, self.offset:end] = keys
+        self.values[:, :, self.offset:end, :] = values
+        self.offset = end
+        return self.keys[:, :, :, :end], self.values[:, :, :end, :]
+
+    def select(self, rows: mx.array):
+        """Keep only ``rows`` of the batch, e.g. once other sequences have finished."""
+        if self.keys is not None:
+            self.keys = mx.take(self.keys, rows, axis=0)
+            self.values = mx.take(self.values, rows, axis=0)
 
-        # shape (num_heads, query_length, key_length)
-        return values.transpose(2, 0, 1)
+    @property
+    def nbytes(self) -> int:
+        if self.keys is None:
+            return 0
+        return self.keys.nbytes + self.values.nbytes
 
 
 class MultiHeadAttention(nn.Module):
@@ -104,29 +177,28 @@ class MultiHeadAttention(nn.Module):
         self.value_proj = nn.Linear(config.d_model, inner_dim, bias=False)
         self.out_proj = nn.Linear(inner_dim, config.d_model, bias=False)
 
-    def __call__(
-        self,
-        queries: mx.array,
-        keys: mx.array,
-        values: mx.array,
-        mask: Optional[mx.array],
-        cache: Optional[Tuple[mx.array, mx.array]] = None,
-    ) -> [mx.array, Tuple[mx.array, mx.array]]:
-        queries = self.query_proj(queries)
+    def project_kv(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        """Project keys and values into heads, keys transposed ready for ``queries @ keys``."""
         keys = self.key_proj(keys)
         values = self.value_proj(values)
 
         num_heads = self.num_heads
-        B, L, _ = queries.shape
-        _, S, _ = keys.shape
-        queries = queries.reshape(B, L, num_heads, -1).transpose(0, 2, 1, 3)
+        B, S, _ = keys.shape
         keys = keys.reshape(B, S, num_heads, -1).transpose(0, 2, 3, 1)
         values = values.reshape(B, S, num_heads, -1).transpose(0, 2, 1, 3)
+        return keys, values
 
-        if cache is not None:
-            key_cache, value_cache = cache
-            keys = mx.concatenate([key_cache, keys], axis=3)
-            values = mx.concatenate([value_cache, values], axis=2)
+    def attend(
+        self,
+        queries: mx.array,
+        keys: mx.array,
+        values: mx.array,
+        mask: Optional[mx.array],
+    ) -> mx.array:
+        """Attend with keys and values already returned by ``project_kv``."""
+        queries = self.query_proj(queries)
+        B, L, _ = queries.shape
+        queries = queries.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
 
         # Dimensions are [batch x num heads x sequence x hidden dim]
         scores = queries @ keys
@@ -135,7 +207,76 @@ class MultiHeadAttention(nn.Module):
 
         scores = mx.softmax(scores.astype(mx.float32), axis=-1).astype(scores.dtype)
         values_hat = (scores @ values).transpose(0, 2, 1, 3).reshape(B, L, -1)
-        return self.out_proj(values_hat), (keys, values)
+        return self.out_proj(values_hat)
+
+    def __call__(
+        self,
+        queries: mx.array,
+        keys: mx.array,
+        values: mx.array,
+        mask: Optional[mx.array],
+        cache: Optional[KVCache] = None,
+    ) -> [mx.array, Optional[KVCache]]:
+        keys, values = self.project_kv(keys, values)
+
+        if cache is not None:
+            keys, values = cache.update(keys, values)
+
+        return self.attend(queries, keys, values, mask), cache
+
+
+class QuantizedLinear(nn.Module):
+    """Linear layer over int8 or packed int4 weights, see ``modules.quantize``.
+
+    The int4 layout (low nibble first, +8 offset) read as uint32 is exactly MLX's
+    affine 4-bit layout with ``biases = -8 * scales``, so it runs on
+    ``mx.quantized_matmul`` without repacking. int8 shifted by +128 is the affine
+    8-bit layout with ``biases = -128 * scales``, its per channel scale repeated
+    for every group, so neither format is dequantized per call.
+
+    MLX only groups 32, 64 or 128 inputs. ``group_size_of`` is None for weights
+    that can't be grouped that way, ``load_weights`` keeps those as a plain ``Linear``.
+    """
+
+    def __init__(self, weight: np.ndarray, scales: np.ndarray, dtype=mx.float16):
+        super().__init__()
+        self.bits = quantize.bits(weight)
+        self.group_size = self.group_size_of(weight, scales)
+        if self.group_size is None:
+            raise ValueError(
+                f"{self.bits} bit weights of shape {weight.shape} with scales {scales.shape} "
+                f"can't be split into groups of {quantize.GROUP_SIZES} inputs"
+            )
+        if self.bits == 8:
+            in_dims = weight.shape[1]
+            shifted = (weight.astype(np.int16) + 128).astype(np.uint8)
+            self.weight = mx.array(np.ascontiguousarray(shifted).view(np.uint32))
+            scales = np.repeat(scales[:, :1], in_dims // self.group_size, axis=1)
+            self.scales = mx.array(scales).astype(dtype)
+            self.biases = -128 * self.scales
+        else:
+            self.weight = mx.array(np.ascontiguousarray(weight).view(np.uint32))
+            self.scales = mx.array(scales).astype(dtype)
+            self.biases = -8 * self.scales
+
+    @staticmethod
+    def group_size_of(weight: np.ndarray, scales: np.ndarray) -> Optional[int]:
+        """Inputs per group for ``mx.quantized_matmul``, None if MLX can't run the weights."""
+        if quantize.bits(weight) == 8:
+            return next((g for g in reversed(quantize.GROUP_SIZES) if weight.shape[1] % g == 0), None)
+        group_size = weight.shape[1] * 2 // scales.shape[1]
+        return group_size if group_size in quantize.GROUP_SIZES else None
+
+    def __call__(self, x):
+        return mx.quantized_matmul(
+            x,
+            self.weight,
+            scales=self.scales,
+            biases=self.biases,
+            transpose=True,
+            group_size=self.group_size,
+            bits=self.bits,
+        )
 
 
 class RMSNorm(nn.Module):
@@ -209,10 +350,14 @@ class TransformerEncoder(nn.Module):
             TransformerEncoderLayer(config) for i in range(config.num_layers)
         ]
         self.ln = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
-        self.relative_attention_bias = RelativePositionBias(config, bidirectional=True)
+        self.relative_attention_bias = RelativePositionBias(
+            config, bidirectional=True, max_length=getattr(config, "n_positions", 512)
+        )
 
-    def __call__(self, x: mx.array):
+    def __call__(self, x: mx.array, mask: Optional[mx.array] = None):
         pos_bias = self.relative_attention_bias(x.shape[1], x.shape[1])
+        if mask is not None:
+            pos_bias = pos_bias + mask
         for layer in self.layers:
             x = layer(x, mask=pos_bias)
         return self.ln(x)
@@ -231,17 +376,17 @@ class TransformerDecoderLayer(nn.Module):
     def __call__(
         self,
         x: mx.array,
-        memory: mx.array,
+        memory_kv: Tuple[mx.array, mx.array],
         mask: mx.array,
         memory_mask: mx.array,
-        cache: Optional[List[Tuple[mx.array, mx.array]]] = None,
+        cache: Optional[KVCache] = None,
     ):
         y = self.ln1(x)
         y, cache = self.self_attention(y, y, y, mask, cache)
         x = x + y
 
         y = self.ln2(x)
-        y, _ = self.cross_attention(y, memory, memory, memory_mask)
+        y = self.cross_attention.attend(y, *memory_kv, memory_mask)
         x = x + y
 
         y = self.ln3(x)
@@ -251,6 +396,37 @@ class TransformerDecoderLayer(nn.Module):
         return x, cache
 
 
+class DecoderCache:
+    """Decoding state carried between generation steps.
+
+    The encoder output never changes while generating, so every layer's
+    cross-attention keys and values are projected once, up front, and kept in
+    ``memory_kv``. ``self_kv`` holds one preallocated ``KVCache`` per layer for
+    up to ``max_tokens`` decoder positions.
+    """
+
+    def __init__(self, memory_kv: List[Tuple[mx.array, mx.array]], max_tokens: int):
+        self.memory_kv = memory_kv
+        self.self_kv = [KVCache(max_tokens) for _ in memory_kv]
+
+    @property
+    def offset(self) -> int:
+        return self.self_kv[0].offset
+
+    def select(self, rows: mx.array):
+        self.memory_kv = [
+            (mx.take(k, rows, axis=0), mx.take(v, rows, axis=0)) for k, v in self.memory_kv
+        ]
+        for c in self.self_kv:
+            c.select(rows)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the self-attention buffers and the projected memory."""
+        memory = sum(k.nbytes + v.nbytes for k, v in self.memory_kv)
+        return memory + sum(c.nbytes for c in self.self_kv)
+
+
 class TransformerDecoder(nn.Module):
     def __init__(self, config: T5Config):
         super().__init__()
@@ -259,12 +435,17 @@ class TransformerDecoder(nn.Module):
         self.ln = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
         self.relative_attention_bias = RelativePositionBias(config, bidirectional=False)
 
+    def project_memory(self, memory: mx.array) -> List[Tuple[mx.array, mx.array]]:
+        return [layer.cross_attention.project_kv(memory, memory) for layer in self.layers]
+
+    def make_cache(self, memory: mx.array, max_tokens: int) -> DecoderCache:
+        self.relative_attention_bias.reserve(max_tokens)
+        return DecoderCache(self.project_memory(memory), max_tokens)
+
     def __call__(self, x, memory, mask, memory_mask, cache=None):
-        if cache is not None:
-            offset = cache[0][0].shape[3]
-        else:
-            offset = 0
-            cache = [None] * len(self.layers)
+        if cache is None:
+            cache = self.make_cache(memory, x.shape[1])
+        offset = cache.offset
 
         T = offset + x.shape[1]
         pos_bias = self.relative_attention_bias(T, T, offset=offset)
@@ -274,12 +455,24 @@ class TransformerDecoder(nn.Module):
             mask = pos_bias
 
         for e, layer in enumerate(self.layers):
-            x, cache[e] = layer(x, memory, mask, memory_mask, cache=cache[e])
+            x, cache.self_kv[e] = layer(
+                x, cache.memory_kv[e], mask, memory_mask, cache=cache.self_kv[e]
+            )
         x = self.ln(x)
 
         return x, cache
 
 
+def padding_mask(attention_mask: mx.array, dtype=mx.float32) -> mx.array:
+    """Turn a [batch x sequence] 1/0 attention mask into an additive key mask.
+
+    The result is [batch x 1 x 1 x sequence] so it broadcasts over heads and
+    queries, padded keys get a large negative score.
+    """
+    mask = (1 - attention_mask.astype(mx.float32)) * -1e9
+    return mask.astype(dtype)[:, None, None, :]
+
+
 class OutputHead(nn.Module):
     def __init__(self, config: T5Config):
         self.linear = nn.Linear(config.d_model, config.vocab_size, bias=False)
@@ -298,14 +491,16 @@ class T5(nn.Module):
             self.lm_head = OutputHead(config)
         self.model_dim = config.d_model
 
-    def encode(self, inputs: mx.array):
-        return self.encoder(self.wte(inputs))
+    def encode(self, inputs: mx.array, mask: Optional[mx.array] = None):
+        """Encode token ids, ``mask`` is an additive padding mask from ``padding_mask``."""
+        return self.encoder(self.wte(inputs), mask=mask)
 
     def decode(
         self,
         inputs: mx.array,
-        memory: mx.array,
-        cache=None,
+        memory: Optional[mx.array],
+        cache: Optional[DecoderCache] = None,
+        memory_mask: Optional[mx.array] = None,
     ):
         inputs = self.wte(inputs)
         T = inputs.shape[1]
@@ -316,7 +511,7 @@ class T5(nn.Module):
             mask = None
 
         y, cache = self.decoder(
-            inputs, memory=memory, mask=mask, memory_mask=None, cache=cache
+            inputs, memory=memory, mask=mask, memory_mask=memory_mask, cache=cache
         )
         if not self.tie_word_embeddings:
             y *= self.model_dim**-0.5
@@ -333,108 +528,202 @@ class T5(nn.Module):
         return self.decode(decoder_inputs, self.encode(inputs))[0]
 
 
-class Tokenizer:
-    def __init__(self, config: T5Config):
-        self._decoder_start_id = config.decoder_start_token_id
-        self._tokenizer = AutoTokenizer.from_pretrained(
-            "t5-3b",
-            legacy=False,
-            model_max_length=getattr(config, "n_positions", 512),
-        )
-
-    @property
-    def eos_id(self) -> int:
-        return self._tokenizer.eos_token_id
-
-    @property
-    def decoder_start_id(self) -> int:
-        return self._decoder_start_id
-
-    def encode(self, s: str) -> mx.array:
-        return mx.array(
-            self._tokenizer(
-                s,
-                return_tensors="np",
-                return_attention_mask=False,
-            )["input_ids"]
-        )
-
-    def decode(self, t: List[int], with_sep: bool = True) -> str:
-        tokens = self._tokenizer.convert_ids_to_tokens(t)
-        return "".join(t.replace("▁", " " if with_sep else "") for t in tokens)
-
-
-def generate(prompt: str, model: T5, tokenizer: Tokenizer, temp: Optional[float] = 0.0):
+def _sampler(temp: Optional[float]):
     def sample(logits):
         if temp == 0:
             return mx.argmax(logits, axis=-1)
         else:
             return mx.random.categorical(logits * (1 / temp))
 
-    prompt = tokenizer.encode(prompt)
+    return sample
+
+
+def encode(inputs: np.ndarray, attention_mask: Optional[np.ndarray], model: T5) -> mx.array:
+    """Encoder states of token ids, [batch x sequence x d_model].
+
+    Pass them to ``generate`` or ``generate_batch`` as ``memory`` so the prompt
+    isn't encoded twice, and to ``pool`` for the prompt's embedding.
+    """
+    if attention_mask is None:
+        return model.encode(mx.array(inputs))
+    return model.encode(mx.array(inputs), padding_mask(mx.array(attention_mask)))
+
+
+def pool(memory: mx.array, attention_mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """Mean of the encoder states over the unpadded tokens, float32 [batch x d_model]."""
+    memory = memory.astype(mx.float32)
+    if attention_mask is None:
+        return np.array(mx.mean(memory, axis=1))
+    mask = mx.array(attention_mask).astype(mx.float32)[:, :, None]
+    return np.array((memory * mask).sum(axis=1) / mx.maximum(mask.sum(axis=1), 1.0))
+
+
+def generate(
+    prompt: str,
+    model: T5,
+    tokenizer: Tokenizer,
+    temp: Optional[float] = 0.0,
+    max_tokens: int = 100,
+    memory: Optional[mx.array] = None,
+):
+    """Yield token ids one at a time, ``memory`` is the prompt's states from ``encode`` if already made."""
+    sample = _sampler(temp)
+
     decoder_inputs = mx.array([tokenizer.decoder_start_id])
-    memory = model.encode(prompt)
-    cache = None
+    if memory is None:
+        memory = model.encode(mx.array(tokenizer.encode(prompt)))
+    cache = model.decoder.make_cache(memory, max_tokens)
     y = decoder_inputs
-    while True:
+    for _ in range(max_tokens):
         logits, cache = model.decode(y[None], memory, cache=cache)
         y = sample(logits[:, -1, :])
         yield y.squeeze()
 
 
-def load_model(model_name: str, dtype: str = "float16"):
-    config = T5Config.from_pretrained("t5-3b")
+def generate_stream(
+    prompt: str,
+    model: T5,
+    tokenizer: Tokenizer,
+    temp: Optional[float] = 0.0,
+    max_tokens: int = 100,
+    sync_every: int = 8,
+    memory: Optional[mx.array] = None,
+) -> Iterator[List[int]]:
+    """Generate like ``generate``, yielding lists of token ids up to EOS.
+
+    Steps are queued lazily and evaluated together, so the host waits on the
+    device and checks for EOS once every ``sync_every`` tokens rather than on
+    every one. The first token is synced on its own to keep the time to first
+    token down. Up to ``sync_every - 1`` steps past EOS are computed and dropped.
+    """
+    pending = []
+    for n, y in enumerate(generate(prompt, model, tokenizer, temp, max_tokens, memory)):
+        pending.append(y)
+        if 0 < n < max_tokens - 1 and len(pending) < sync_every:
+            continue
+        tokens = mx.stack(pending).tolist()
+        pending = []
+        if tokenizer.eos_id in tokens:
+            yield tokens[:tokens.index(tokenizer.eos_id)]
+            return
+        yield tokens
+
+
+def generate_batch(
+    inputs: np.ndarray,
+    attention_mask: np.ndarray,
+    model: T5,
+    tokenizer: Tokenizer,
+    temp: Optional[float] = 0.0,
+    max_tokens: int = 100,
+    memory: Optional[mx.array] = None,
+) -> List[List[int]]:
+    """Generate for a padded batch of prompts in one forward pass per step.
+
+    Rows that produce EOS are dropped from the batch, and from every cache, so
+    the remaining rows don't keep paying for them. ``memory`` is the batch's
+    states from ``encode``, if they were already made.
+
+    :returns: the generated token ids of each row, without EOS
+    """
+    sample = _sampler(temp)
+    inputs = mx.array(inputs)
+    attention_mask = mx.array(attention_mask)
+
+    if memory is None:
+        memory = model.encode(inputs, padding_mask(attention_mask))
+    memory_mask = padding_mask(attention_mask, memory.dtype)
+    cache = model.decoder.make_cache(memory, max_tokens)
+
+    rows = list(range(inputs.shape[0]))
+    outputs = [[] for _ in rows]
+    y = mx.array([[tokenizer.decoder_start_id]] * len(rows))
+    for _ in range(max_tokens):
+        logits, cache = model.decode(y, None, cache=cache, memory_mask=memory_mask)
+        y = sample(logits[:, -1, :])
+
+        keep = []
+        for i, token in enumerate(y.tolist()):
+            if token != tokenizer.eos_id:
+                outputs[rows[i]].append(token)
+                keep.append(i)
+        if not keep:
+            break
+        if len(keep) < len(rows):
+            keep_rows = mx.array(keep)
+            cache.select(keep_rows)
+            memory_mask = mx.take(memory_mask, keep_rows, axis=0)
+            y = mx.take(y, keep_rows, axis=0)
+            rows = [rows[i] for i in keep]
+        y = y[:, None]
+    return outputs
+
+
+def _set_module(model: nn.Module, name: str, module: nn.Module):
+    """Replace the submodule at a dotted name, ignored if there is none."""
+    *path, leaf = name.split(".")
+    node = model
+    for part in path:
+        node = node[int(part)] if isinstance(node, list) else node.get(part)
+        if node is None:
+            return
+    if isinstance(node, list):
+        node[int(leaf)] = module
+    elif leaf in node:
+        node[leaf] = module
+
+
+def load_weights(model: T5, weights: dict, dtype: str = "float32"):
+    """Load a ``{name: array}`` mapping into ``model``.
+
+    Linear layers saved with scales by ``convert.py --quantize`` become
+    ``QuantizedLinear`` and stay quantized in memory, the rest is cast to ``dtype``.
+    """
     dtype = getattr(mx, dtype)
-    model = T5(config)
-    # file_name = model_name.replace("/", "-")
-    try:
-        weights = mx.load("modules/t5-3b.npz")
-    except ValueError:
-        weights = mx.load("t5-3b.npz")
-    weights = tree_unflatten(list(weights.items()))
-    weights = tree_map(lambda p: p.astype(dtype), weights)
-    model.update(weights)
+    names = set(weights.keys())
+    plain = []
+    for name in names:
+        prefix = name[:-len(".weight")]
+        if name.endswith(".scales"):
+            continue
+        if name.endswith(".weight") and prefix + ".scales" in names:
+            weight, scales = np.array(weights[name]), np.array(weights[prefix + ".scales"])
+            if QuantizedLinear.group_size_of(weight, scales) is not None:
+                _set_module(model, prefix, QuantizedLinear(weight, scales, dtype))
+            else:
+                # too few or oddly sized inputs to group, stored dequantized in dtype
+                dense = quantize.dequantize(weight, scales)
+                linear = nn.Linear(dense.shape[1], dense.shape[0], bias=False)
+                linear.weight = mx.array(dense).astype(dtype)
+                _set_module(model, prefix, linear)
+        else:
+            # cast and evaluate each tensor on its own so only one full-precision copy is alive
+            p = mx.array(weights[name]).astype(dtype)
+            mx.eval(p)
+            plain.append((name, p))
+    model.update(tree_unflatten(plain))
     mx.eval(model.parameters())
-    return model, Tokenizer(config)
-
-
-def summarize(prompt):
-    # prompt = prompt.replace('\n',' ')
-    # prompt = prompt.replace('  ', ' ')
-    default_model = "t5-3b"
-    import re
-    prompt = re.sub('[^a-zA-Z0-9 \.]', '', prompt)
-    prompt = " ".join([i.title() if i == i.upper() else i for i in prompt.split()])
-    prompt = "summarize: " + prompt
-    print('prompt:', prompt, '\n')
-    max_tokens = 100
-    temp = 0.5
-    dtype = "bfloat16"
-    seed = 1
-
-    mx.random.seed(seed)
-    model, tokenizer = load_model(default_model, dtype)
-
-    start = perf_counter_ns()
-    response = ""
-    for token, n_tokens in zip(
-        generate(prompt, model, tokenizer, temp), range(max_tokens)
-    ):
-        if token.item() == tokenizer.eos_id:
-            break
-        response = response + tokenizer.decode([token.item()], with_sep=n_tokens > 0)
-
-    # deduplicate response
-    response = response.split(' . ')
-    response = [i.replace(' .', '') for i in response]
-    response = '. '.join(set(response))
-    n_tokens += 1
-    end = perf_counter_ns()
-    elapsed = (end - start) / 1.0e9
-    print('elapsed:', elapsed, '\n\n', 'response:', response)
-    return response
-
-if __name__ == "__main__":
-    import sys
-    # print(sys.argv[1])
-    print(summarize(str(sys.argv[1])))
+
+
+def load_model(model_name: str, dtype: str, weights_path: str):
+    """Load converted weights, an .npz file or a sharded directory.
+
+    Sharded weights are memory-mapped and copied into MLX one tensor at a time,
+    so loading needs little more than the model's own memory.
+    """
+    config = T5Config.from_pretrained(model_name)
+    model = T5(config)
+    if is_sharded(weights_path):
+        weights = ShardedWeights(weights_path)
+    else:
+        weights = mx.load(weights_path)
+    load_weights(model, weights, dtype)
+    return model, Tokenizer(config, model_name)
+
+
+def model_nbytes(model: T5) -> int:
+    return sum(p.nbytes for _, p in tree_flatten(model.parameters()))
+
+
+def seed(n: int):
+    mx.random.seed(n)
@@ -0,0 +1,738 @@
+# NumPy port of modules/t5.py for machines without MLX (Linux, Intel macs).
+#
+# Same module tree, attribute names and functions as the MLX version, so the
+# converted .npz weights load unchanged. Matmuls go through NumPy's BLAS, which
+# is multithreaded (OpenBLAS/MKL use every core unless OMP_NUM_THREADS or
+# OPENBLAS_NUM_THREADS say otherwise). NumPy has no bfloat16 and float16
+# matmuls are slow, so everything computes in float32 unless float64 is asked for.
+
+import math
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from transformers import T5Config
+
+from modules import quantize
+from modules.shards import ShardedWeights, is_sharded
+from modules.tokenizer import Tokenizer
+
+_rng = np.random.default_rng()
+_random_init = True
+
+
+@contextmanager
+def _skip_init():
+    """Build modules with zeroed parameters, for when weights are loaded right after.
+
+    ``np.zeros`` pages aren't committed until written, so this avoids filling
+    gigabytes with random numbers that are thrown away.
+    """
+    global _random_init
+    _random_init = False
+    try:
+        yield
+    finally:
+        _random_init = True
+
+
+def _relative_position_bucket(
+    relative_position, bidirectional=True, num_buckets=32, max_distance=128
+):
+    """NumPy version of ``modules.t5._relative_position_bucket``."""
+    relative_buckets = 0
+    if bidirectional:
+        num_buckets //= 2
+        relative_buckets += (relative_position > 0).astype(np.int32) * num_buckets
+        relative_position = np.abs(relative_position)
+    else:
+        relative_position = -np.minimum(relative_position, 0)
+    # now relative_position is in the range [0, inf)
+
+    # half of the buckets are for exact increments in positions
+    max_exact = num_buckets // 2
+    is_small = relative_position < max_exact
+
+    # The other half of the buckets are for logarithmically bigger bins in positions up to max_distance
+    scale = (num_buckets - max_exact) / np.log(max_distance / max_exact)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative_position_if_large = max_exact + (
+            np.log(relative_position.astype(np.float32) / max_exact) * scale
+        ).astype(np.int32)
+    relative_position_if_large = np.minimum(relative_position_if_large, num_buckets - 1)
+    relative_buckets += np.where(is_small, relative_position, relative_position_if_large)
+    return relative_buckets
+
+
+class Module:
+    """Just enough of ``mlx.nn.Module`` to load and count weights by name."""
+
+    def parameters(self) -> Iterator[Tuple[str, np.ndarray]]:
+        """Yield ``(dotted name, array)`` for every weight, like ``tree_flatten``."""
+        for name, value in vars(self).items():
+            if name.startswith("_"):
+                continue
+            if isinstance(value, np.ndarray):
+                yield name, value
+            elif isinstance(value, Module):
+                for child, array in value.parameters():
+                    yield f"{name}.{child}", array
+            elif isinstance(value, list):
+                for i, item in enumerate(value):
+                    for child, array in item.parameters():
+                        yield f"{name}.{i}.{child}", array
+
+    def _parent(self, name: str):
+        """The object holding the last part of a dotted name and that part, or ``None``."""
+        *path, leaf = name.split(".")
+        node = self
+        for part in path:
+            if isinstance(node, list):
+                node = node[int(part)] if int(part) < len(node) else None
+            else:
+                node = getattr(node, part, None)
+            if node is None:
+                return None, leaf
+        return node, leaf
+
+    def update(self, weights: dict):
+        """Set weights from a flat ``{dotted name: array}`` mapping.
+
+        Names without a matching attribute are ignored, as ``mlx.nn.Module.update``
+        does, e.g. ``lm_head`` when the embeddings are tied.
+        """
+        for name, value in weights.items():
+            node, leaf = self._parent(name)
+            if isinstance(node, Module) and isinstance(getattr(node, leaf, None), np.ndarray):
+                setattr(node, leaf, value)
+
+    def set_module(self, name: str, module: "Module"):
+        """Replace the submodule at a dotted name, ignored if there is none."""
+        node, leaf = self._parent(name)
+        if isinstance(node, list):
+            node[int(leaf)] = module
+        elif isinstance(getattr(node, leaf, None), Module):
+            setattr(node, leaf, module)
+
+
+class Linear(Module):
+    def __init__(self, input_dims: int, output_dims: int, dtype=np.float32):
+        if _random_init:
+            scale = math.sqrt(1 / input_dims)
+            self.weight = _rng.uniform(-scale, scale, (output_dims, input_dims)).astype(dtype)
+        else:
+            self.weight = np.zeros((output_dims, input_dims), dtype)
+
+    def __call__(self, x):
+        # one 2D gemm instead of a batched matmul per leading dimension
+        shape = x.shape
+        y = x.reshape(-1, shape[-1]) @ self.weight.T
+        return y.reshape(*shape[:-1], -1)
+
+
+class QuantizedLinear(Module):
+    """Linear layer over int8 or packed int4 weights, see ``modules.quantize``.
+
+    NumPy's BLAS has no integer gemm, so the weights are widened to the input's
+    dtype ``row_block`` output channels at a time, never the whole matrix.
+    """
+
+    row_block = 512
+
+    def __init__(self, weight: np.ndarray, scales: np.ndarray):
+        self.weight = weight
+        self.scales = scales
+
+    def __call__(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        out_dims = self.weight.shape[0]
+        y = np.empty((x.shape[0], out_dims), x.dtype)
+        int8 = quantize.bits(self.weight) == 8
+        for start in range(0, out_dims, self.row_block):
+            rows = slice(start, start + self.row_block)
+            if int8:
+                y[:, rows] = x @ self.weight[rows].T.astype(x.dtype)
+            else:
+                y[:, rows] = x @ quantize.dequantize(self.weight[rows], self.scales[rows], x.dtype).T
+        if int8:
+            # per output channel scales factor out of the matmul
+            y *= self.scales[:, 0].astype(x.dtype)
+        return y.reshape(*shape[:-1], -1)
+
+
+class Embedding(Module):
+    def __init__(self, num_embeddings: int, dims: int, dtype=np.float32):
+        if _random_init:
+            self.weight = _rng.normal(0, 1, (num_embeddings, dims)).astype(dtype)
+        else:
+            self.weight = np.zeros((num_embeddings, dims), dtype)
+
+    def __call__(self, x):
+        return self.weight[x]
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def gelu(x):
+    # tanh approximation, NumPy has no erf
+    return 0.5 * x * (1 + np.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * x ** 3)))
+
+
+def silu(x):
+    return x / (1 + np.exp(-x))
+
+
+def softmax(x, axis=-1):
+    x = x - x.max(axis=axis, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def create_additive_causal_mask(N: int, dtype=np.float32):
+    indices = np.arange(N)
+    mask = indices[:, None] < indices[None]
+    return (mask * -1e9).astype(dtype)
+
+
+class RelativePositionBias(Module):
+    """Binned relative position bias, served from a precomputed table.
+
+    Same caching as ``modules.t5.RelativePositionBias``.
+    """
+
+    def __init__(self, config: T5Config, bidirectional: bool, max_length: int = 0):
+        self.bidirectional = bidirectional
+        self.num_buckets = config.relative_attention_num_buckets
+        self.max_distance = config.relative_attention_max_distance
+        self.n_heads = config.num_heads
+        self.embeddings = Embedding(config.relative_attention_num_buckets, config.num_heads)
+        self._max_length = 0
+        self._buckets = None
+        self._table = None
+        self._table_weight = None
+        self.reserve(max_length)
+
+    def reserve(self, length: int):
+        """Make sure the bucket grid covers ``length`` query and key positions."""
+        if length <= self._max_length:
+            return
+        if self._max_length:
+            # grow geometrically so decoding past the reserved size doesn't rebuild every step
+            length = max(length, 2 * self._max_length)
+
+        # shape (length, length)
+        relative_position = np.arange(length)[None, :] - np.arange(length)[:, None]
+        self._buckets = _relative_position_bucket(
+            relative_position,
+            bidirectional=self.bidirectional,
+            num_buckets=self.num_buckets,
+            max_distance=self.max_distance,
+        )
+        self._max_length = length
+        self._table = None
+
+    def _bias_table(self) -> np.ndarray:
+        weight = self.embeddings.weight
+        if self._table is None or self._table_weight is not weight:
+            # shape (num_heads, length, length)
+            self._table = np.ascontiguousarray(self.embeddings(self._buckets).transpose(2, 0, 1))
+            self._table_weight = weight
+        return self._table
+
+    def __call__(self, query_length: int, key_length: int, offset: int = 0):
+        """Compute binned relative position bias"""
+        self.reserve(max(query_length, key_length))
+
+        # shape (num_heads, query_length - offset, key_length)
+        return self._bias_table()[:, offset:query_length, :key_length]
+
+
+class KVCache:
+    """Fixed-capacity self-attention keys/values for one decoder layer.
+
+    Same layout as ``modules.t5.KVCache``; with NumPy the writes really are in place.
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.offset = 0
+        self.keys = None
+        self.values = None
+
+    def update(self, keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        B, H, D, S = keys.shape
+        if self.keys is None:
+            self.keys = np.zeros((B, H, D, self.max_tokens), keys.dtype)
+            self.values = np.zeros((B, H, self.max_tokens, values.shape[-1]), values.dtype)
+
+        end = self.offset + S
+        if end > self.max_tokens:
+            raise ValueError(f"KV cache holds {self.max_tokens} tokens, got {end}")
+        self.keys[:, :, :, self.offset:end] = keys
+        self.values[:, :, self.offset:end, :] = values
+        self.offset = end
+        return self.keys[:, :, :, :end], self.values[:, :, :end, :]
+
+    def select(self, rows: np.ndarray):
+        """Keep only ``rows`` of the batch, e.g. once other sequences have finished."""
+        if self.keys is not None:
+            self.keys = self.keys[rows]
+            self.values = self.values[rows]
+
+    @property
+    def nbytes(self) -> int:
+        if self.keys is None:
+            return 0
+        return self.keys.nbytes + self.values.nbytes
+
+
+class MultiHeadAttention(Module):
+    def __init__(self, config: T5Config):
+        inner_dim = config.d_kv * config.num_heads
+        self.num_heads = config.num_heads
+        self.query_proj = Linear(config.d_model, inner_dim)
+        self.key_proj = Linear(config.d_model, inner_dim)
+        self.value_proj = Linear(config.d_model, inner_dim)
+        self.out_proj = Linear(inner_dim, config.d_model)
+
+    def project_kv(self, keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Project keys and values into heads, keys transposed ready for ``queries @ keys``."""
+        keys = self.key_proj(keys)
+        values = self.value_proj(values)
+
+        num_heads = self.num_heads
+        B, S, _ = keys.shape
+        keys = keys.reshape(B, S, num_heads, -1).transpose(0, 2, 3, 1)
+        values = values.reshape(B, S, num_heads, -1).transpose(0, 2, 1, 3)
+        return keys, values
+
+    def attend(
+        self,
+        queries: np.ndarray,
+        keys: np.ndarray,
+        values: np.ndarray,
+        mask: Optional[np.ndarray],
+    ) -> np.ndarray:
+        """Attend with keys and values already returned by ``project_kv``."""
+        queries = self.query_proj(queries)
+        B, L, _ = queries.shape
+        queries = queries.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
+
+        # Dimensions are [batch x num heads x sequence x hidden dim]
+        scores = queries @ keys
+        if mask is not None:
+            scores = scores + mask.astype(scores.dtype)
+
+        scores = softmax(scores, axis=-1)
+        values_hat = (scores @ values).transpose(0, 2, 1, 3).reshape(B, L, -1)
+        return self.out_proj(values_hat)
+
+    def __call__(
+        self,
+        queries: np.ndarray,
+        keys: np.ndarray,
+        values: np.ndarray,
+        mask: Optional[np.ndarray],
+        cache: Optional[KVCache] = None,
+    ) -> [np.ndarray, Optional[KVCache]]:
+        keys, values = self.project_kv(keys, values)
+
+        if cache is not None:
+            keys, values = cache.update(keys, values)
+
+        return self.attend(queries, keys, values, mask), cache
+
+
+class RMSNorm(Module):
+    def __init__(self, dims: int, eps: float = 1e-5):
+        self.weight = np.ones((dims,), dtype=np.float32)
+        self.eps = eps
+
+    def __call__(self, x):
+        norm = x / np.sqrt(np.square(x).mean(-1, keepdims=True) + self.eps)
+        return self.weight * norm.astype(x.dtype)
+
+
+class DenseActivation(Module):
+    def __init__(self, config: T5Config):
+        mlp_dims = config.d_ff or config.d_model * 4
+        self.gated = config.feed_forward_proj.startswith("gated")
+        if self.gated:
+            self.wi_0 = Linear(config.d_model, mlp_dims)
+            self.wi_1 = Linear(config.d_model, mlp_dims)
+        else:
+            self.wi = Linear(config.d_model, mlp_dims)
+        self.wo = Linear(mlp_dims, config.d_model)
+        activation = config.feed_forward_proj.removeprefix("gated-")
+        if activation == "relu":
+            self._act = relu
+        elif activation == "gelu":
+            self._act = gelu
+        elif activation == "silu":
+            self._act = silu
+        else:
+            raise ValueError(f"Unknown activation: {activation}")
+
+    def __call__(self, x):
+        if self.gated:
+            hidden_act = self._act(self.wi_0(x))
+            hidden_linear = self.wi_1(x)
+            x = hidden_act * hidden_linear
+        else:
+            x = self._act(self.wi(x))
+        return self.wo(x)
+
+
+class TransformerEncoderLayer(Module):
+    def __init__(self, config: T5Config):
+        self.attention = MultiHeadAttention(config)
+        self.ln1 = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
+        self.ln2 = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
+        self.dense = DenseActivation(config)
+
+    def __call__(self, x, mask):
+        y = self.ln1(x)
+        y, _ = self.attention(y, y, y, mask=mask)
+        x = x + y
+
+        y = self.ln2(x)
+        y = self.dense(y)
+        return x + y
+
+
+class TransformerEncoder(Module):
+    def __init__(self, config: T5Config):
+        self.layers = [
+            TransformerEncoderLayer(config) for i in range(config.num_layers)
+        ]
+        self.ln = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
+        self.relative_attention_bias = RelativePositionBias(
+            config, bidirectional=True, max_length=getattr(config, "n_positions", 512)
+        )
+
+    def __call__(self, x: np.ndarray, mask: Optional[np.ndarray] = None):
+        pos_bias = self.relative_attention_bias(x.shape[1], x.shape[1])
+        if mask is not None:
+            pos_bias = pos_bias + mask
+        for layer in self.layers:
+            x = layer(x, mask=pos_bias)
+        return self.ln(x)
+
+
+class TransformerDecoderLayer(Module):
+    def __init__(self, config: T5Config):
+        self.self_attention = MultiHeadAttention(config)
+        self.cross_attention = MultiHeadAttention(config)
+        self.ln1 = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
+        self.ln2 = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
+        self.ln3 = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
+        self.dense = DenseActivation(config)
+
+    def __call__(
+        self,
+        x: np.ndarray,
+        memory_kv: Tuple[np.ndarray, np.ndarray],
+        mask: np.ndarray,
+        memory_mask: np.ndarray,
+        cache: Optional[KVCache] = None,
+    ):
+        y = self.ln1(x)
+        y, cache = self.self_attention(y, y, y, mask, cache)
+        x = x + y
+
+        y = self.ln2(x)
+        y = self.cross_attention.attend(y, *memory_kv, memory_mask)
+        x = x + y
+
+        y = self.ln3(x)
+        y = self.dense(y)
+        x = x + y
+
+        return x, cache
+
+
+class DecoderCache:
+    """Decoding state carried between generation steps, see ``modules.t5.DecoderCache``."""
+
+    def __init__(self, memory_kv: List[Tuple[np.ndarray, np.ndarray]], max_tokens: int):
+        self.memory_kv = memory_kv
+        self.self_kv = [KVCache(max_tokens) for _ in memory_kv]
+
+    @property
+    def offset(self) -> int:
+        return self.self_kv[0].offset
+
+    def select(self, rows: np.ndarray):
+        self.memory_kv = [(k[rows], v[rows]) for k, v in self.memory_kv]
+        for c in self.self_kv:
+            c.select(rows)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the self-attention buffers and the projected memory."""
+        memory = sum(k.nbytes + v.nbytes for k, v in self.memory_kv)
+        return memory + sum(c.nbytes for c in self.self_kv)
+
+
+class TransformerDecoder(Module):
+    def __init__(self, config: T5Config):
+        n_layers = getattr(config, "num_decoder_layers", config.num_layers)
+        self.layers = [TransformerDecoderLayer(config) for i in range(n_layers)]
+        self.ln = RMSNorm(config.d_model, eps=config.layer_norm_epsilon)
+        self.relative_attention_bias = RelativePositionBias(config, bidirectional=False)
+
+    def project_memory(self, memory: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [layer.cross_attention.project_kv(memory, memory) for layer in self.layers]
+
+    def make_cache(self, memory: np.ndarray, max_tokens: int) -> DecoderCache:
+        self.relative_attention_bias.reserve(max_tokens)
+        return DecoderCache(self.project_memory(memory), max_tokens)
+
+    def __call__(self, x, memory, mask, memory_mask, cache=None):
+        if cache is None:
+            cache = self.make_cache(memory, x.shape[1])
+        offset = cache.offset
+
+        T = offset + x.shape[1]
+        pos_bias = self.relative_attention_bias(T, T, offset=offset)
+        if mask is not None:
+            mask = mask + pos_bias
+        else:
+            mask = pos_bias
+
+        for e, layer in enumerate(self.layers):
+            x, cache.self_kv[e] = layer(
+                x, cache.memory_kv[e], mask, memory_mask, cache=cache.self_kv[e]
+            )
+        x = self.ln(x)
+
+        return x, cache
+
+
+def padding_mask(attention_mask: np.ndarray, dtype=np.float32) -> np.ndarray:
+    """Turn a [batch x sequence] 1/0 attention mask into an additive key mask."""
+    mask = (1 - attention_mask.astype(np.float32)) * -1e9
+    return mask.astype(dtype)[:, None, None, :]
+
+
+class OutputHead(Module):
+    def __init__(self, config: T5Config):
+        self.linear = Linear(config.d_model, config.vocab_size)
+
+    def __call__(self, inputs):
+        return self.linear(inputs)
+
+
+class T5(Module):
+    def __init__(self, config: T5Config):
+        self.wte = Embedding(config.vocab_size, config.d_model)
+        self.encoder = TransformerEncoder(config)
+        self.decoder = TransformerDecoder(config)
+        self.tie_word_embeddings = config.tie_word_embeddings
+        if not self.tie_word_embeddings:
+            self.lm_head = OutputHead(config)
+        self.model_dim = config.d_model
+
+    def encode(self, inputs: np.ndarray, mask: Optional[np.ndarray] = None):
+        """Encode token ids, ``mask`` is an additive padding mask from ``padding_mask``."""
+        return self.encoder(self.wte(inputs), mask=mask)
+
+    def decode(
+        self,
+        inputs: np.ndarray,
+        memory: Optional[np.ndarray],
+        cache: Optional[DecoderCache] = None,
+        memory_mask: Optional[np.ndarray] = None,
+    ):
+        inputs = self.wte(inputs)
+        T = inputs.shape[1]
+        if T > 1:
+            mask = create_additive_causal_mask(T, inputs.dtype)
+        else:
+            mask = None
+
+        y, cache = self.decoder(
+            inputs, memory=memory, mask=mask, memory_mask=memory_mask, cache=cache
+        )
+        if not self.tie_word_embeddings:
+            y *= self.model_dim**-0.5
+            y = self.lm_head(y)
+        else:
+            y = y @ self.wte.weight.T
+        return y, cache
+
+    def __call__(
+        self,
+        inputs: np.ndarray,
+        decoder_inputs: np.ndarray,
+    ):
+        return self.decode(decoder_inputs, self.encode(inputs))[0]
+
+
+def _sampler(temp: Optional[float]):
+    def sample(logits):
+        if temp == 0:
+            return np.argmax(logits, axis=-1)
+        else:
+            # Gumbel-max trick, same distribution as mx.random.categorical
+            return np.argmax(logits * (1 / temp) + _rng.gumbel(size=logits.shape), axis=-1)
+
+    return sample
+
+
+def encode(inputs: np.ndarray, attention_mask: Optional[np.ndarray], model: T5) -> np.ndarray:
+    """Encoder states of token ids, see ``modules.t5.encode``."""
+    if attention_mask is None:
+        return model.encode(inputs)
+    return model.encode(inputs, padding_mask(attention_mask))
+
+
+def pool(memory: np.ndarray, attention_mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """Mean of the encoder states over the unpadded tokens, float32 [batch x d_model]."""
+    memory = memory.astype(np.float32, copy=False)
+    if attention_mask is None:
+        return memory.mean(axis=1)
+    mask = attention_mask.astype(np.float32)[:, :, None]
+    return (memory * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1.0)
+
+
+def generate(
+    prompt: str,
+    model: T5,
+    tokenizer: Tokenizer,
+    temp: Optional[float] = 0.0,
+    max_tokens: int = 100,
+    memory: Optional[np.ndarray] = None,
+):
+    """Yield token ids one at a time, see ``modules.t5.generate``."""
+    sample = _sampler(temp)
+
+    decoder_inputs = np.array([tokenizer.decoder_start_id])
+    if memory is None:
+        memory = model.encode(tokenizer.encode(prompt))
+    cache = model.decoder.make_cache(memory, max_tokens)
+    y = decoder_inputs
+    for _ in range(max_tokens):
+        logits, cache = model.decode(y[None], memory, cache=cache)
+        y = sample(logits[:, -1, :])
+        yield y.squeeze()
+
+
+def generate_stream(
+    prompt: str,
+    model: T5,
+    tokenizer: Tokenizer,
+    temp: Optional[float] = 0.0,
+    max_tokens: int = 100,
+    sync_every: int = 8,
+    memory: Optional[np.ndarray] = None,
+) -> Iterator[List[int]]:
+    """Generate like ``generate``, yielding lists of token ids up to EOS.
+
+    NumPy is eager, so EOS is checked on every token and ``sync_every`` only
+    sets how many tokens go in each list, see ``modules.t5.generate_stream``.
+    """
+    tokens = []
+    for n, y in enumerate(generate(prompt, model, tokenizer, temp, max_tokens, memory)):
+        token = int(y)
+        if token == tokenizer.eos_id:
+            break
+        tokens.append(token)
+        if n == 0 or len(tokens) == sync_every:
+            yield tokens
+            tokens = []
+    if tokens:
+        yield tokens
+
+
+def generate_batch(
+    inputs: np.ndarray,
+    attention_mask: np.ndarray,
+    model: T5,
+    tokenizer: Tokenizer,
+    temp: Optional[float] = 0.0,
+    max_tokens: int = 100,
+    memory: Optional[np.ndarray] = None,
+) -> List[List[int]]:
+    """Generate for a padded batch of prompts, see ``modules.t5.generate_batch``."""
+    sample = _sampler(temp)
+
+    if memory is None:
+        memory = model.encode(inputs, padding_mask(attention_mask))
+    memory_mask = padding_mask(attention_mask, memory.dtype)
+    cache = model.decoder.make_cache(memory, max_tokens)
+
+    rows = list(range(inputs.shape[0]))
+    outputs = [[] for _ in rows]
+    y = np.array([[tokenizer.decoder_start_id]] * len(rows))
+    for _ in range(max_tokens):
+        logits, cache = model.decode(y, None, cache=cache, memory_mask=memory_mask)
+        y = sample(logits[:, -1, :])
+
+        keep = []
+        for i, token in enumerate(y.tolist()):
+            if token != tokenizer.eos_id:
+                outputs[rows[i]].append(token)
+                keep.append(i)
+        if not keep:
+            break
+        if len(keep) < len(rows):
+            keep_rows = np.array(keep)
+            cache.select(keep_rows)
+            memory_mask = memory_mask[keep_rows]
+            y = y[keep_rows]
+            rows = [rows[i] for i in keep]
+        y = y[:, None]
+    return outputs
+
+
+def _compute_dtype(dtype: str):
+    return np.float64 if dtype == "float64" else np.float32
+
+
+def load_weights(model: T5, weights, dtype: str = "float32"):
+    """Load a ``{name: array}`` mapping into ``model``.
+
+    Linear layers saved with scales by ``convert.py --quantize`` become
+    ``QuantizedLinear`` and stay quantized in memory.
+    """
+    dtype = _compute_dtype(dtype)
+    names = set(weights.keys())
+    # one array is read (and cast) at a time, which is what keeps NpzFile loading lean
+    for name in names:
+        prefix = name[:-len(".weight")]
+        if name.endswith(".scales"):
+            continue
+        if name.endswith(".weight") and prefix + ".scales" in names:
+            model.set_module(prefix, QuantizedLinear(weights[name], weights[prefix + ".scales"]))
+        else:
+            model.update({name: weights[name].astype(dtype, copy=False)})
+
+
+def load_model(model_name: str, dtype: str, weights_path: str):
+    """Load converted weights, an .npz file or a sharded directory.
+
+    Sharded weights already stored in the compute dtype stay memory-mapped: no
+    tensor is read until a forward pass touches it, and then only its pages.
+    """
+    config = T5Config.from_pretrained(model_name)
+    with _skip_init():
+        model = T5(config)
+    if is_sharded(weights_path):
+        load_weights(model, ShardedWeights(weights_path), dtype)
+    else:
+        with np.load(weights_path) as weights:
+            load_weights(model, weights, dtype)
+    return model, Tokenizer(config, model_name)
+
+
+def model_nbytes(model: T5) -> int:
+    return sum(p.nbytes for _, p in model.parameters())
+
+
+def seed(n: int):
+    global _rng
+    _rng = np.random.default_rng(n)
@@ -0,0 +1,129 @@
+"""Tokenizer shared by the T5 backends.
+
+It only deals in Python lists and NumPy arrays, each backend converts the
+arrays into its own type.
+"""
+
+import os
+import re
+from itertools import islice
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from transformers import AutoTokenizer, T5Config
+
+os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+
+class Tokenizer:
+    def __init__(self, config: T5Config, model_name: str = "t5-3b"):
+        self._decoder_start_id = config.decoder_start_token_id
+        self._tokenizer = AutoTokenizer.from_pretrained(
+            model_name,
+            legacy=False,
+            model_max_length=getattr(config, "n_positions", 512),
+        )
+
+    @property
+    def eos_id(self) -> int:
+        return self._tokenizer.eos_token_id
+
+    @property
+    def decoder_start_id(self) -> int:
+        return self._decoder_start_id
+
+    def encode(self, s: str) -> np.ndarray:
+        return self._tokenizer(
+            s,
+            return_tensors="np",
+            return_attention_mask=False,
+        )["input_ids"]
+
+    def encode_batch(self, prompts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Encode several prompts, right padded to the longest one.
+
+        :returns: input ids and the 1/0 attention mask, both [batch x sequence]
+        """
+        encoded = self._tokenizer(
+            prompts,
+            padding=True,
+            truncation=True,
+            return_tensors="np",
+        )
+        return encoded["input_ids"], encoded["attention_mask"]
+
+    @property
+    def max_length(self) -> int:
+        return self._tokenizer.model_max_length
+
+    def ids(self, s: str) -> List[int]:
+        """Token ids of ``s`` without special tokens."""
+        return self._tokenizer(s, add_special_tokens=False)["input_ids"]
+
+    def iter_windows(
+        self, text: str, size: int, overlap: int = 64, words_per_piece: int = 256
+    ) -> Iterator[List[int]]:
+        """Yield overlapping windows of at most ``size`` token ids over ``text``.
+
+        The text is tokenized ``words_per_piece`` words at a time, so only one
+        piece and one window are held in memory however long the text is.
+        """
+        if not 0 <= overlap < size:
+            raise ValueError(f"overlap must be at least 0 and less than the window size {size}, got {overlap}")
+        return self._windows(text, size, overlap, words_per_piece)
+
+    def _windows(self, text: str, size: int, overlap: int, words_per_piece: int) -> Iterator[List[int]]:
+        words = (m.group(0) for m in re.finditer(r"\S+", text))
+        buffer = []
+        seen = 0  # tokens at the front of buffer that were already yielded
+        while True:
+            piece = list(islice(words, words_per_piece))
+            if piece:
+                buffer.extend(self.ids(" ".join(piece)))
+            while len(buffer) >= size:
+                yield buffer[:size]
+                buffer = buffer[size - overlap:]
+                seen = overlap
+            if not piece:
+                break
+        if len(buffer) > seen:
+            yield buffer
+
+    def pad_batch(self, windows: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Right pad token id lists into input ids and a 1/0 attention mask."""
+        length = max(len(w) for w in windows)
+        inputs = np.full((len(windows), length), self._tokenizer.pad_token_id, dtype=np.int32)
+        attention_mask = np.zeros((len(windows), length), dtype=np.int32)
+        for i, w in enumerate(windows):
+            inputs[i, :len(w)] = w
+            attention_mask[i, :len(w)] = 1
+        return inputs, attention_mask
+
+    def decode(self, t: List[int], with_sep: bool = True) -> str:
+        tokens = self._tokenizer.convert_ids_to_tokens(t)
+        return "".join(t.replace("▁", " " if with_sep else "") for t in tokens)
+
+
+class IncrementalDetokenizer:
+    """Turn generated token ids into text a chunk at a time.
+
+    SentencePiece pieces carry their own word separator, so each chunk decodes
+    on its own and only the new ids are converted. ``add`` returns the text the
+    chunk appends, ``text`` is everything so far.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self._tokenizer = tokenizer
+        self._parts = []
+
+    def add(self, ids: List[int]) -> str:
+        delta = self._tokenizer.decode(ids)
+        if not self._parts:
+            delta = delta.lstrip(" ")
+        if delta:
+            self._parts.append(delta)
+        return delta
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
@@ -0,0 +1,454 @@
+"""Document embeddings in a memory-mapped matrix, searched by cosine similarity.
+
+Every summarized document has an embedding, the T5 encoder states of its
+summary prompt averaged (see ``summarizer.SummaryStream.embedding``). They're
+rows of one float32 matrix on disk, normalized to unit length, so a query's
+cosine similarity to every document is a single matrix-vector product over
+the memory map and the top ``k`` come out of ``np.argpartition``. Nothing is
+encoded again at search time except the query.
+
+Like ``modules.index``, row -> uuid is a JSON snapshot plus an append-only log.
+Vectors are appended to the matrix before their log line is written, so rows a
+crash left without one are ignored. Removed rows are only dropped from the
+matrix when they're a quarter of it, by a compaction that writes the matrix
+under a new name for the new snapshot to point at.
+
+Several processes can write to the same index, the app's worker, ``--backfill``
+and ``python -m modules.ingest``. Like ``modules.index`` they hold an exclusive
+lock on ``vectors.lock`` to append or compact, and read what the others logged
+first. A row's number is where the matrix file ends under the lock, not how
+many rows the writer knows of. A compaction deletes the previous generation's
+files, which POSIX keeps alive for anyone still mapping them, and the others
+load the new snapshot before their next search or write.
+
+Past ``ivf_min_rows`` documents an inverted file index is trained: spherical
+k-means over the rows, each row filed under its nearest centroid. A search
+then scores the ``probe`` nearest clusters' rows instead of all of them. New
+rows are filed as they're added, the clusters are trained again each time the
+archive doubles.
+"""
+
+import base64
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from modules.locking import locked
+
+SNAPSHOT_FILE = "vectors.json"
+LOG_FILE = "vectors.log"
+LOCK_FILE = "vectors.lock"
+FORMAT = "docs-vector-index"
+
+
+def normalize(vectors) -> np.ndarray:
+    """Stack vectors, or arrays of them, into float32 rows of unit length."""
+    matrix = np.vstack(vectors).astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def pack(vector: np.ndarray) -> str:
+    """A vector as base64 float32 text, for JSON."""
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+
+
+def unpack(text: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(text), dtype=np.float32)
+
+
+def _write_atomic(path: str, text: str):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    """Identity of a file's current version, a replaced file gets a new one."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the ``k`` highest scores, highest first."""
+    if k <= 0:
+        return np.arange(0)
+    if k < len(scores):
+        top = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def kmeans(rows: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Unit length centroids of spherical k-means over unit length rows."""
+    rng = np.random.default_rng(seed)
+    centroids = rows[rng.choice(len(rows), clusters, replace=False)]
+    for _ in range(iterations):
+        assigned = np.argmax(rows @ centroids.T, axis=1)
+        # summed with a matmul, np.add.at and reduceat are many times slower
+        members = np.zeros((clusters, len(rows)), dtype=np.float32)
+        members[assigned, np.arange(len(rows))] = 1.0
+        sums = members @ rows
+        empty = ~members.any(axis=1)
+        # a cluster left empty restarts on a random row
+        sums[empty] = rows[rng.choice(len(rows), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+class VectorIndex:
+    """Persistent uuid -> embedding matrix with exact and clustered cosine top-k search."""
+
+    def __init__(
+        self,
+        path: str,
+        compact_every: int = 1000,
+        ivf_min_rows: int = 20000,
+        probe: int = 8,
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.compact_every = compact_every
+        self.ivf_min_rows = ivf_min_rows
+        self.probe = probe
+        self._lock = threading.Lock()
+        with locked(self._file(LOCK_FILE), shared=True):
+            self._load()
+
+    def __len__(self) -> int:
+        with self._lock, locked(self._file(LOCK_FILE), shared=True):
+            self._sync()
+            return len(self._rows)
+
+    def __contains__(self, uuid: str) -> bool:
+        with self._lock, locked(self._file(LOCK_FILE), shared=True):
+            self._sync()
+            return uuid in self._rows
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        self.dim: Optional[int] = None
+        # bumped by each compaction, which writes its files under new names
+        self._generation = 0
+        self._matrix_file = "vectors.0.f32"
+        self._ivf_file: Optional[str] = None
+        self._uuids: List[Optional[str]] = []  # row -> uuid, None once removed
+        self._rows: Dict[str, int] = {}
+        self._removed: Set[int] = set()
+        self._matrix: Optional[np.memmap] = None  # remapped when rows are added
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: Optional[np.ndarray] = None  # row -> cluster, -1 once removed
+        self._trained_rows = 0
+        self._log_entries = 0
+        self._log_offset = 0  # bytes of the log applied so far
+        snapshot = self._file(SNAPSHOT_FILE)
+        self._snapshot = _stamp(snapshot)
+        if os.path.exists(snapshot):
+            with open(snapshot) as f:
+                data = json.load(f)
+            if data.get("format") != FORMAT:
+                raise ValueError(f"{snapshot} is not a {FORMAT} snapshot")
+            self.dim = data["dim"]
+            self._generation = data["generation"]
+            self._matrix_file = data["matrix"]
+            self._ivf_file = data["ivf"]
+            self._trained_rows = data["trained_rows"]
+            self._uuids = data["uuids"]
+            self._rows = {uuid: row for row, uuid in enumerate(self._uuids) if uuid is not None}
+        self._read_log()
+
+        # rows appended without a log line are a crash's leftovers
+        self._uuids += [None] * (self._matrix_rows() - len(self._uuids))
+        self._removed = {row for row, uuid in enumerate(self._uuids) if uuid is None}
+
+        if self._ivf_file:
+            with np.load(self._file(self._ivf_file)) as ivf:
+                self._centroids, lists = ivf["centroids"], ivf["lists"]
+            # rows added since the snapshot are filed again
+            self._lists = np.concatenate([lists, self._assign(np.arange(len(lists), len(self._uuids)))])
+            self._lists[list(self._removed)] = -1
+
+    def _read_log(self):
+        """Apply the log lines past ``_log_offset``, filing the new rows if the clusters are trained."""
+        log = self._file(LOG_FILE)
+        if not os.path.exists(log):
+            return
+        with open(log, "rb") as f:
+            f.seek(self._log_offset)
+            tail = f.read()
+        for line in tail.splitlines(keepends=True):
+            # a write cut short by a crash, nothing after it
+            if not line.endswith(b"\n"):
+                break
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            # rows of an older generation are already in the snapshot, numbered differently
+            if entry["generation"] == self._generation:
+                self._apply(entry)
+            self._log_entries += 1
+            self._log_offset += len(line)
+        if self._lists is not None and len(self._lists) < len(self._uuids):
+            self._lists = np.concatenate([self._lists, self._assign(np.arange(len(self._lists), len(self._uuids)))])
+
+    def _sync(self):
+        """Catch up with the other processes' writes, with ``vectors.lock`` held."""
+        if _stamp(self._file(SNAPSHOT_FILE)) != self._snapshot:
+            self._load()  # compacted by another process, the rows and files changed
+            return
+        log = self._file(LOG_FILE)
+        if os.path.exists(log) and os.path.getsize(log) != self._log_offset:
+            self._read_log()
+
+    def _apply(self, entry: dict):
+        if entry["op"] == "add":
+            self.dim = entry["dim"]
+            old = self._rows.pop(entry["uuid"], None)
+            if old is not None:
+                self._uuids[old] = None
+                self._drop(old)
+            # rows in between were appended by a writer that crashed before logging them
+            self._removed.update(range(len(self._uuids), entry["row"]))
+            self._uuids += [None] * (entry["row"] + 1 - len(self._uuids))
+            self._uuids[entry["row"]] = entry["uuid"]
+            self._rows[entry["uuid"]] = entry["row"]
+        elif entry["op"] == "remove":
+            row = self._rows.pop(entry["uuid"], None)
+            if row is not None:
+                self._uuids[row] = None
+                self._drop(row)
+
+    def _matrix_rows(self) -> int:
+        path = self._file(self._matrix_file)
+        if self.dim is None or not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // (4 * self.dim)
+
+    def matrix(self) -> np.ndarray:
+        """Every row, removed ones too, memory-mapped read only."""
+        rows = len(self._uuids)
+        if rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        if self._matrix is None or len(self._matrix) != rows:
+            self._matrix = np.memmap(self._file(self._matrix_file), np.float32, "r", shape=(rows, self.dim))
+        return self._matrix
+
+    def _assign(self, rows: np.ndarray) -> np.ndarray:
+        """The cluster of each row, -1 for removed rows."""
+        lists = np.full(len(rows), -1, dtype=np.int32)
+        matrix = self.matrix()
+        for start in range(0, len(rows), 8192):
+            chunk = rows[start:start + 8192]
+            lists[start:start + len(chunk)] = np.argmax(matrix[chunk] @ self._centroids.T, axis=1)
+        if self._removed:
+            lists[np.isin(rows, list(self._removed))] = -1
+        return lists
+
+    def _drop(self, row: int):
+        self._removed.add(row)
+        if self._lists is not None and row < len(self._lists):
+            self._lists[row] = -1
+
+    def _append(self, vectors: np.ndarray) -> int:
+        """Write rows at the end of the matrix file, returns the first one's number."""
+        path = self._file(self._matrix_file)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        row_bytes = 4 * self.dim
+        if size % row_bytes:
+            size -= size % row_bytes
+            os.truncate(path, size)  # a crash's partial row
+        first = size // row_bytes
+        # rows a crash left without a log line
+        self._removed.update(range(len(self._uuids), first))
+        self._uuids += [None] * (first - len(self._uuids))
+        with open(path, "ab") as f:
+            f.write(vectors.tobytes())
+        return first
+
+    def _log(self, *entries: dict):
+        # called with vectors.lock held after _sync, anything past the offset is a crash's partial line
+        log = self._file(LOG_FILE)
+        if os.path.exists(log) and os.path.getsize(log) > self._log_offset:
+            os.truncate(log, self._log_offset)
+        with open(log, "ab") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries).encode())
+            self._log_offset = f.tell()
+        self._log_entries += len(entries)
+        if self._log_entries >= self.compact_every:
+            self._compact()
+
+    def add(self, uuid: str, vector: np.ndarray):
+        self.add_many([(uuid, vector)])
+
+    def add_many(self, documents: Iterable[Tuple[str, np.ndarray]]):
+        """Add ``(uuid, vector)`` pairs, replacing what a uuid had, with one write to the matrix and one to the log."""
+        documents = list(documents)
+        if not documents:
+            return
+        vectors = normalize([v for _, v in documents])
+        with self._lock, locked(self._file(LOCK_FILE)):
+            self._sync()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"{vectors.shape[1]} dimensional vectors in a {self.dim} dimensional index")
+            first = self._append(vectors)
+            entries = []
+            for row, (uuid, _) in enumerate(documents, first):
+                entries.append({"op": "add", "uuid": uuid, "row": row, "dim": self.dim, "generation": self._generation})
+                self._apply(entries[-1])
+            if self._lists is not None:
+                self._lists = np.concatenate([self._lists, self._assign(np.arange(len(self._lists), len(self._uuids)))])
+            self._log(*entries)
+            if len(self._rows) >= max(self.ivf_min_rows, 2 * self._trained_rows):
+                self._train()
+                self._compact()
+
+    def remove(self, uuid: str):
+        with self._lock, locked(self._file(LOCK_FILE)):
+            self._sync()
+            if uuid in self._rows:
+                entry = {"op": "remove", "uuid": uuid, "generation": self._generation}
+                self._apply(entry)
+                self._log(entry)
+
+    def _train(self, per_cluster: int = 64):
+        """Cluster the rows into about the square root of their number of clusters.
+
+        The centroids are fit to a sample of ``per_cluster`` rows each, then every row is filed.
+        """
+        live = np.array(sorted(self._rows.values()))
+        clusters = max(1, int(np.sqrt(len(live))))
+        rng = np.random.default_rng(len(live))
+        training = np.sort(rng.choice(live, min(per_cluster * clusters, len(live)), replace=False))
+        self._centroids = kmeans(np.asarray(self.matrix()[training]), clusters)
+        self._lists = self._assign(np.arange(len(self._uuids)))
+        self._trained_rows = len(live)
+
+    def compact(self):
+        """Write the snapshot, empty the log, and drop removed rows from the matrix if there are many."""
+        with self._lock, locked(self._file(LOCK_FILE)):
+            self._sync()
+            self._compact()
+
+    def _compact(self):
+        # the new snapshot names its own files, so a crash at any point leaves the
+        # old snapshot with all of its files, or the new one with all of its
+        generation = self._generation + 1
+        matrix_file, ivf_file = self._matrix_file, None
+        uuids, lists = self._uuids, self._lists
+        if len(self._removed) * 4 > len(self._uuids):
+            live = np.array(sorted(self._rows.values()), dtype=np.int64)
+            matrix_file = f"vectors.{generation}.f32"
+            with open(self._file(matrix_file), "wb") as f:
+                matrix = self.matrix()
+                for start in range(0, len(live), 8192):
+                    f.write(np.ascontiguousarray(matrix[live[start:start + 8192]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            uuids = [self._uuids[row] for row in live]
+            lists = None if lists is None else lists[live]
+        if self._centroids is not None:
+            ivf_file = f"ivf.{generation}.npz"
+            with open(self._file(ivf_file), "wb") as f:
+                np.savez(f, centroids=self._centroids, lists=lists)
+                f.flush()
+                os.fsync(f.fileno())
+        _write_atomic(
+            self._file(SNAPSHOT_FILE),
+            json.dumps({
+                "format": FORMAT, "version": 1, "dim": self.dim, "generation": generation,
+                "matrix": matrix_file, "ivf": ivf_file, "trained_rows": self._trained_rows, "uuids": uuids,
+            }),
+        )
+        _write_atomic(self._file(LOG_FILE), "")
+        self._snapshot = _stamp(self._file(SNAPSHOT_FILE))
+        self._log_entries = 0
+        self._log_offset = 0
+        for old in (self._matrix_file, self._ivf_file):
+            if old and old not in (matrix_file, ivf_file) and os.path.exists(self._file(old)):
+                os.remove(self._file(old))
+        if matrix_file != self._matrix_file:
+            self._matrix = None
+        self._generation, self._matrix_file, self._ivf_file = generation, matrix_file, ivf_file
+        self._uuids, self._lists = uuids, lists
+        self._rows = {uuid: row for row, uuid in enumerate(uuids) if uuid is not None}
+        self._removed = {row for row, uuid in enumerate(uuids) if uuid is None}
+
+    def search(self, vector: np.ndarray, k: int = 10, probe: Optional[int] = None) -> List[Tuple[str, float]]:
+        """The ``k`` documents most similar to ``vector``, as ``(uuid, cosine similarity)``, best first.
+
+        Once the clusters are trained only the rows of the ``probe`` clusters
+        nearest the query are scored, ``probe=0`` scores every row.
+        """
+        query = normalize([vector])[0]
+        probe = self.probe if probe is None else probe
+        # shared, so a compaction can't delete the files between syncing and mapping them
+        with self._lock, locked(self._file(LOCK_FILE), shared=True):
+            self._sync()
+            if not self._rows:
+                return []
+            matrix = self.matrix()
+            if self._centroids is not None and 0 < probe < len(self._centroids):
+                clusters = _top_k(self._centroids @ query, probe)
+                rows = np.flatnonzero(np.isin(self._lists, clusters))
+                scores = matrix[rows] @ query
+            else:
+                rows = None
+                scores = matrix @ query
+                if self._removed:
+                    scores[list(self._removed)] = -np.inf
+            top = _top_k(scores, min(k, len(scores)))
+            top = top[np.isfinite(scores[top])]
+            found = top if rows is None else rows[top]
+            return [(self._uuids[row], float(scores[i])) for row, i in zip(found, top)]
+
+
+if __name__ == "__main__":
+    import argparse
+    import tomllib
+
+    import modules.summarizer as summarizer
+    from modules.store import MetadataStore
+
+    parser = argparse.ArgumentParser(description="Search documents by meaning, or embed the ones without vectors.")
+    parser.add_argument("query", nargs="?", default=None)
+    parser.add_argument("--root", default=None, help="data directory, data_path_root from config.toml by default")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--backfill", action="store_true", help="embed stored documents that have no vector")
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists("config.toml"):
+        with open("config.toml", "rb") as f:
+            config = tomllib.load(f)
+    root = args.root or config.get("app", {}).get("data_path_root", "data")
+    summarizer.configure(**config.get("t5", {}))
+    vectors = VectorIndex(os.path.join(root, "vectors"))
+
+    if args.backfill:
+        store = MetadataStore(os.path.join(root, "metadata.db"))
+        documents = [d for d in store.documents() if d["uuid"] not in vectors]
+        for start in range(0, len(documents), args.batch_size):
+            batch = documents[start:start + args.batch_size]
+            embeddings = summarizer.embed([d.get("ocr_string") or "" for d in batch], args.batch_size)
+            vectors.add_many(zip([d["uuid"] for d in batch], embeddings))
+            print(f"embedded {start + len(batch)}/{len(documents)}", flush=True)
+        vectors.compact()
+    if args.query:
+        for uuid, score in vectors.search(summarizer.embed([args.query])[0], args.k):
+            print(f"{score:.3f} {uuid}")
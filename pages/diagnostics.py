@@ -0,0 +1,107 @@
+"""Where ingest time goes, from the stage timings saved with each document and this server's metrics."""
+
+import os
+import tomllib
+
+import pandas as pd
+import streamlit as st
+
+from modules import metrics
+from modules.jobs import JobQueue
+from modules.server import SummarizerClient
+from modules.store import MetadataStore
+
+
+@st.cache_resource
+def open_diagnostics(root: str) -> tuple:
+    return MetadataStore(os.path.join(root, 'metadata.db')), JobQueue(os.path.join(root, 'metadata.db'))
+
+
+def stage_table(documents: list[dict]) -> pd.DataFrame:
+    """Seconds and bytes of each stage over ``documents``, one row per stage."""
+    rows = [
+        {"stage": stage, "seconds": timing["seconds"], "bytes": timing.get("bytes")}
+        for doc in documents
+        for stage, timing in doc.get("stage_timings", {}).items()
+    ]
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows)
+    table = df.groupby("stage").agg(
+        documents=("seconds", "size"),
+        median_seconds=("seconds", "median"),
+        p95_seconds=("seconds", lambda s: s.quantile(0.95)),
+        max_seconds=("seconds", "max"),
+        median_bytes=("bytes", "median"),
+    )
+    order = [s for s in metrics.STAGES if s in table.index]
+    return table.loc[order + [s for s in table.index if s not in order]]
+
+
+with open('config.toml', 'rb') as f:
+    config = tomllib.load(f)
+DATA_PATH_ROOT = config['app']['data_path_root']
+
+st.set_page_config(page_title='Diagnostics', page_icon=config['app']['page_icon'], layout='wide')
+st.header('Diagnostics')
+
+if not os.path.exists(os.path.join(DATA_PATH_ROOT, 'metadata.db')):
+    st.info('Nothing ingested yet.')
+    st.stop()
+store, queue = open_diagnostics(DATA_PATH_ROOT)
+
+st.subheader('Jobs')
+for column, (status, count) in zip(st.columns(5), queue.counts().items()):
+    column.metric(status, count)
+
+st.subheader('Recent documents')
+recent = st.number_input('Documents', min_value=10, max_value=10000, value=200, step=50)
+documents = store.documents(limit=recent)
+stages = stage_table(documents)
+if stages.empty:
+    st.caption('No stage timings yet, they are saved with documents ingested from now on.')
+else:
+    st.bar_chart(stages["median_seconds"])
+    st.dataframe(stages, use_container_width=True)
+summaries = pd.DataFrame(
+    [d for d in documents if d.get("t5_tokens_per_sec") is not None],
+    columns=["t5_time_to_first_token", "t5_tokens_per_sec"],
+)
+if not summaries.empty:
+    first_token, rate = st.columns(2)
+    first_token.metric('Median time to first token', f'{summaries["t5_time_to_first_token"].median():.2f} s')
+    rate.metric('Median tokens/sec', f'{summaries["t5_tokens_per_sec"].median():.1f}')
+
+server_url = config.get('t5', {}).get('server')
+if server_url:
+    st.subheader('Summarization server')
+    try:
+        stats = SummarizerClient(server_url, timeout=5).stats()
+    except OSError as e:
+        st.warning(f"Can't reach {server_url}: {e}")
+    else:
+        queued, running, completed, rejected = st.columns(4)
+        queued.metric('Queued', f'{stats["queued"]}/{stats["max_queue"]}')
+        running.metric('Running', stats["running"] or '-')
+        completed.metric('Completed', stats["completed"])
+        rejected.metric('Turned away', stats["rejected"])
+        st.dataframe(
+            pd.DataFrame({k: stats[k] for k in ('wait_seconds', 'summarize_seconds', 'embed_seconds')}),
+            use_container_width=True,
+        )
+
+st.subheader('Since the server started')
+if config['app'].get('metrics_port'):
+    st.caption(f'Scraped by Prometheus from http://127.0.0.1:{config["app"]["metrics_port"]}/metrics')
+for title, histogram in (
+    ('Stage seconds', metrics.STAGE_SECONDS),
+    ('Stage bytes', metrics.STAGE_BYTES),
+    ('T5 time to first token', metrics.T5_TIME_TO_FIRST_TOKEN),
+    ('T5 tokens/sec', metrics.T5_TOKENS_PER_SEC),
+    ('T5 prompt tokens', metrics.T5_PROMPT_TOKENS),
+    ('T5 generated tokens', metrics.T5_GENERATED_TOKENS),
+):
+    rows = [row for row in metrics.summary(histogram) if row["count"]]
+    if rows:
+        st.caption(title)
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from transformers import T5Config
+
+import modules.summarizer as summarizer
+from modules.tokenizer import Tokenizer
+
+
+class WordTokenizer(Tokenizer):
+    """One made up id per word, so tests don't download a tokenizer."""
+
+    class _Pad:
+        pad_token_id = 0
+
+    eos_id = 1
+    max_length = 512
+    _tokenizer = _Pad()
+
+    def __init__(self):
+        self._decoder_start_id = 0
+
+    def ids(self, s):
+        return [sum(map(ord, word)) % 1000 + 2 for word in s.split()]
+
+    def encode(self, s):
+        return np.array([self.ids(s) + [self.eos_id]])
+
+    def encode_batch(self, prompts):
+        return self.pad_batch([self.ids(p) + [self.eos_id] for p in prompts])
+
+    def decode(self, tokens, with_sep=True):
+        return "".join(f" w{t}" for t in tokens)
+
+
+@pytest.fixture
+def tiny_model(monkeypatch):
+    """A randomly initialized two layer T5 on the NumPy backend, in place of t5-3b."""
+    monkeypatch.setattr(summarizer, "_backend_name", "numpy")
+    t5 = summarizer.backend()
+    t5.seed(0)
+    config = T5Config(
+        vocab_size=1024, d_model=64, d_kv=8, d_ff=256, num_layers=2, num_heads=8,
+        feed_forward_proj="relu", decoder_start_token_id=0, tie_word_embeddings=True,
+    )
+    model, tokenizer = t5.T5(config), WordTokenizer()
+    monkeypatch.setattr(summarizer, "get_model", lambda *args, **kwargs: (model, tokenizer))
+    monkeypatch.setattr(summarizer.SummaryStream, "max_tokens", 12)
+    return model, tokenizer
@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+
+from modules.index import LOG_FILE, TokenIndex
+
+
+def test_round_trip(tmp_path):
+    index = TokenIndex(str(tmp_path), compact_every=3)
+    index.add("a", "tax form 1098-T")
+    index.add("b", "tax return 1099")
+    index.add("c", "water bill")
+    index.remove("c")
+    index.add("d", "electric bill")
+    reopened = TokenIndex(str(tmp_path))
+    assert reopened.search("tax 109") == ["b", "a"]
+    assert reopened.search("bill") == ["d"]
+    assert len(reopened) == 3
+
+
+def test_two_writers_keep_each_others_documents(tmp_path):
+    first = TokenIndex(str(tmp_path), compact_every=5)
+    second = TokenIndex(str(tmp_path), compact_every=5)
+    for i in range(12):
+        (first if i % 2 else second).add(f"doc-{i}", f"receipt {i}")
+    first.remove("doc-3")
+    second.compact()
+    first.compact()
+
+    for index in (first, second, TokenIndex(str(tmp_path))):
+        assert sorted(index.search("receipt")) == sorted(f"doc-{i}" for i in range(12) if i != 3)
+
+
+def test_searches_see_other_writers(tmp_path):
+    reader = TokenIndex(str(tmp_path))
+    writer = TokenIndex(str(tmp_path), compact_every=2)
+    writer.add("a", "insurance")
+    assert reader.search("insurance") == ["a"]
+    writer.add("b", "insurance")
+    writer.add("c", "insurance")  # past a compaction the reader loads the new snapshot
+    assert reader.search("insurance") == ["c", "b", "a"]
+
+
+def test_partial_line_from_a_crash_is_dropped(tmp_path):
+    TokenIndex(str(tmp_path)).add("a", "lease")
+    with open(os.path.join(tmp_path, LOG_FILE), "a") as f:
+        f.write('{"op": "add", "uu')
+    index = TokenIndex(str(tmp_path))
+    index.add("b", "lease")
+    assert TokenIndex(str(tmp_path)).search("lease") == ["b", "a"]
+
+
+def _add_documents(path, prefix, count):
+    index = TokenIndex(path, compact_every=7)
+    for i in range(count):
+        index.add(f"{prefix}-{i}", "statement")
+    index.compact()
+
+
+def test_writer_processes(tmp_path):
+    workers = [
+        multiprocessing.Process(target=_add_documents, args=(str(tmp_path), prefix, 40))
+        for prefix in ("app", "cli")
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    assert len(TokenIndex(str(tmp_path)).search("statement")) == 80
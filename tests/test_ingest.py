@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import modules.summarizer as summarizer
+from modules import ingest, ocr
+from modules.index import TokenIndex
+from modules.jobs import JobQueue
+from modules.server import LocalSummarizer
+from modules.store import MetadataStore
+from modules.vectors import VectorIndex
+
+pytestmark = pytest.mark.skipif(
+    multiprocessing.get_start_method() != "fork", reason="the OCR pool has to inherit the stubs"
+)
+
+
+def _scan(path, seed):
+    page = np.full((400, 300), 255, np.uint8)
+    rng = np.random.default_rng(seed)
+    for y in range(40, 360, 24):
+        cv2.line(page, (30, y), (int(rng.integers(120, 270)), y), 0, 6)
+    cv2.imwrite(str(path), page)
+
+
+def _summarize_batch(prompts, batch_size=8, overlap=64, return_embeddings=False):
+    embeddings = [np.random.default_rng(len(p)).normal(size=8) for p in prompts]
+    return ["a lease"] * len(prompts), embeddings
+
+
+def test_import_alongside_the_app(tmp_path, monkeypatch):
+    monkeypatch.setattr(ocr, "read", lambda threshold, threads=None: ("lease agreement", []))
+    monkeypatch.setattr(summarizer, "summarize_batch", _summarize_batch)
+    root, scans = str(tmp_path / "data"), tmp_path / "scans"
+    scans.mkdir()
+    for i in range(3):
+        _scan(scans / f"scan-{i}.jpg", i)
+    os.makedirs(root)
+    store = MetadataStore(os.path.join(root, "metadata.db"))
+    app_index = TokenIndex(os.path.join(root, "index"))
+    app_vectors = VectorIndex(os.path.join(root, "vectors"))
+    app_index.add("uploaded", "lease renewal")
+    app_vectors.add("uploaded", np.ones(8))
+
+    # what python -m modules.ingest does while the app keeps running
+    cli_index = TokenIndex(os.path.join(root, "index"))
+    cli_vectors = VectorIndex(os.path.join(root, "vectors"))
+    stats = ingest.import_directory(root, str(scans), store, cli_index, processes=1, vectors=cli_vectors)
+    cli_index.compact()
+    cli_vectors.compact()
+    assert stats["imported"] == 3
+
+    imported = {d["uuid"] for d in store.documents()}
+    assert set(app_index.search("lease")) == imported | {"uploaded"}
+    app_index.add("uploaded-later", "lease")
+    app_vectors.add("uploaded-later", -np.ones(8))
+    app_index.compact()
+    app_vectors.compact()
+
+    assert set(TokenIndex(os.path.join(root, "index")).search("lease")) == imported | {"uploaded", "uploaded-later"}
+    vectors = VectorIndex(os.path.join(root, "vectors"))
+    assert len(vectors) == 5 and all(uuid in vectors for uuid in imported)
+
+
+class CountingSummarizer(LocalSummarizer):
+    def __init__(self, streamed):
+        self.streamed = streamed
+
+    def stream(self, text, cancelled=None):
+        self.streamed.append(text)
+        return super().stream(text, cancelled)
+
+
+def test_two_workers_share_a_queue(tmp_path, monkeypatch, tiny_model):
+    monkeypatch.setattr(ocr, "read", lambda threshold, threads=None: ("lease agreement", []))
+    root = str(tmp_path)
+    store = MetadataStore(os.path.join(root, "metadata.db"))
+    streamed = []
+    workers = []
+    for _ in range(2):
+        # what each app process opens
+        workers.append(ingest.IngestWorker(
+            root, JobQueue(os.path.join(root, "metadata.db")), store, TokenIndex(os.path.join(root, "index")),
+            processes=1, ocr_threads=1, vectors=VectorIndex(os.path.join(root, "vectors")),
+            service=CountingSummarizer(streamed),
+        ))
+    queue = JobQueue(os.path.join(root, "metadata.db"))
+    for i in range(6):
+        path = tmp_path / f"scan-{i}.jpg"
+        _scan(path, i)
+        queue.enqueue(ingest.save_upload(root, path.read_bytes(), {"original_filename": path.name}))
+    for worker in workers:
+        worker.notify()
+    deadline = time.monotonic() + 60
+    while queue.counts()["done"] < 6:
+        assert time.monotonic() < deadline, queue.counts()
+        time.sleep(0.1)
+    for worker in workers:
+        worker.stop()
+
+    assert len(streamed) == 6
+    assert len(store) == 6
+    assert len(TokenIndex(os.path.join(root, "index")).search("lease")) == 6
+    assert len(VectorIndex(os.path.join(root, "vectors"))) == 6
@@ -0,0 +1,100 @@
+import sqlite3
+import subprocess
+import sys
+
+from modules.jobs import JobQueue
+
+
+def _queue(path, **kwargs):
+    return JobQueue(str(path / "metadata.db"), **kwargs)
+
+
+def _summarizing(queue, count):
+    for i in range(count):
+        queue.enqueue({"uuid": f"doc-{i}"})
+    claimed = queue.claim("queued", "ocr", count)
+    for job_id, _ in claimed:
+        queue.update(job_id, "summarizing", ocr_string="text")
+    return [job_id for job_id, _ in claimed]
+
+
+def _owners(path):
+    with sqlite3.connect(str(path / "metadata.db")) as conn:
+        return dict(conn.execute("SELECT id, owner FROM jobs"))
+
+
+def test_summarizing_jobs_are_claimed_once(tmp_path):
+    first, second = _queue(tmp_path), _queue(tmp_path)
+    _summarizing(first, 5)
+    claimed = []
+    while True:
+        got = first.claim("summarizing", "summarizing") + second.claim("summarizing", "summarizing")
+        if not got:
+            break
+        claimed += [job_id for job_id, _ in got]
+    assert sorted(claimed) == [1, 2, 3, 4, 5]
+    assert {job["status"] for job in first.jobs()} == {"summarizing"}
+
+
+def test_moving_a_job_on_unclaims_it(tmp_path):
+    queue = _queue(tmp_path)
+    [job_id] = _summarizing(queue, 1)
+    assert _owners(tmp_path)[job_id] is None
+    queue.claim("summarizing", "summarizing")
+    queue.update(job_id, partial_summary="so far")
+    assert _owners(tmp_path)[job_id] == queue.owner
+    queue.fail(job_id, "boom", retry_status="summarizing")
+    assert queue.claim("summarizing", "summarizing")[0][0] == job_id
+
+
+def test_reset_stale_leaves_live_owners_alone(tmp_path):
+    working, starting = _queue(tmp_path), _queue(tmp_path)
+    _summarizing(working, 2)
+    working.enqueue({"uuid": "doc-ocr"})
+    working.claim("summarizing", "summarizing", 2)
+    working.claim("queued", "ocr")
+    assert starting.reset_stale() == 0
+    assert working.counts()["ocr"] == 1
+    assert starting.claim("summarizing", "summarizing") == []
+
+
+def test_reset_stale_frees_jobs_of_stopped_processes(tmp_path):
+    queue = _queue(tmp_path)
+    _summarizing(queue, 1)
+    queue.enqueue({"uuid": "doc-ocr"})
+    queue.claim("summarizing", "summarizing")
+    queue.claim("queued", "ocr")
+    gone = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    host, _, token = queue.owner.rsplit(":", 2)
+    with sqlite3.connect(str(tmp_path / "metadata.db")) as conn:
+        conn.execute("UPDATE jobs SET owner = ?", (f"{host}:{gone.stdout.strip()}:{token}",))
+
+    assert _queue(tmp_path).reset_stale() == 2
+    assert queue.counts() == {"queued": 1, "ocr": 0, "summarizing": 1, "done": 0, "failed": 0}
+    assert len(queue.claim("summarizing", "summarizing")) == 1
+
+
+def test_reset_stale_frees_jobs_without_a_heartbeat(tmp_path):
+    queue = _queue(tmp_path, stale_after=60)
+    _summarizing(queue, 2)
+    queue.claim("summarizing", "summarizing", 2)
+    with sqlite3.connect(str(tmp_path / "metadata.db")) as conn:
+        conn.execute("UPDATE jobs SET heartbeat = '2000-01-01T00:00:00' WHERE id = 1")
+    assert queue.reset_stale() == 1
+    assert queue.beat() == 1
+    assert [job_id for job_id, _ in queue.claim("summarizing", "summarizing", 2)] == [1]
+
+
+def test_owners_added_to_an_old_queue(tmp_path):
+    with sqlite3.connect(str(tmp_path / "metadata.db")) as conn:
+        conn.executescript("""
+            CREATE TABLE jobs (
+                id INTEGER PRIMARY KEY, uuid TEXT NOT NULL UNIQUE, status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0, error TEXT, data TEXT NOT NULL,
+                created_at TEXT NOT NULL, updated_at TEXT NOT NULL
+            );
+            INSERT INTO jobs (uuid, status, data, created_at, updated_at) VALUES ('old', 'ocr', '{}', '', '');
+        """)
+    queue = _queue(tmp_path)
+    assert queue.reset_stale() == 1
+    assert queue.claim("queued", "ocr") == [(1, {})]
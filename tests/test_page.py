@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+import pytest
+
+from modules import page
+
+
+@pytest.fixture(scope="module")
+def rendered():
+    """A letter page of text lines at 100 dpi."""
+    img = np.full((1100, 850), 255, np.uint8)
+    rng = np.random.default_rng(0)
+    for y in range(130, 980, 34):
+        words = " ".join("".join(rng.choice(list("abcdefghijklmnopqrstuvwxyz"), rng.integers(2, 9))) for _ in range(9))
+        cv2.putText(img, words, (90, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, 0, 2)
+    return img
+
+
+def turned(img, angle):
+    """``img`` turned ``angle`` degrees counterclockwise, like a crooked scan."""
+    height, width = img.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(img, matrix, (width, height), borderValue=255)
+
+
+@pytest.mark.parametrize("angle", [-8.0, -5.0, -3.0, 3.0, 5.0, 8.0])
+def test_skew_angle(rendered, angle):
+    assert page.skew_angle(turned(rendered, angle)) == pytest.approx(angle, abs=0.5)
+
+
+@pytest.mark.parametrize("angle", [-8.0, -5.0, -3.0, 0.0, 3.0, 5.0, 8.0])
+def test_flatten_straightens(rendered, angle):
+    flat, info = page.flatten(turned(rendered, angle), dpi=100)
+    assert info["skew"] == pytest.approx(angle, abs=0.5)
+    assert abs(page.skew_angle(flat, max_skew=45.0)) < 0.5
+
+
+def test_to_photo_inverts_the_transform(rendered):
+    photo = turned(rendered, 5.0)
+    flat, info = page.flatten(photo, dpi=100)
+    # a word's box on the flattened page lands on the same ink in the photo
+    ys, xs = np.nonzero(flat < 128)
+    points = np.stack([xs, ys], axis=1)[:: max(1, len(xs) // 200)].astype(np.float32)
+    back = np.round(page.to_photo(info["transform"], points)).astype(int)
+    inside = (back[:, 0] >= 0) & (back[:, 0] < photo.shape[1]) & (back[:, 1] >= 0) & (back[:, 1] < photo.shape[0])
+    assert inside.all()
+    dark = cv2.erode(photo, np.ones((5, 5), np.uint8))[back[:, 1], back[:, 0]] < 128
+    assert dark.mean() > 0.95
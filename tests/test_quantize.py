@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from modules import quantize
+from modules.t5_numpy import QuantizedLinear
+
+
+@pytest.fixture
+def layer():
+    rng = np.random.default_rng(0)
+    w = rng.normal(scale=0.05, size=(300, 384)).astype(np.float32)
+    x = rng.normal(size=(2, 7, 384)).astype(np.float32)
+    return w, x
+
+
+@pytest.mark.parametrize("mode, tolerance", [("int8", 0.01), ("int4", 0.15)])
+def test_quantized_linear_close_to_float(layer, mode, tolerance):
+    w, x = layer
+    quantized = quantize.quantize_tensor("wo.weight", w, mode)
+    linear = QuantizedLinear(quantized["wo.weight"], quantized["wo.scales"])
+    linear.row_block = 128  # exercise a partial last block
+    y = linear(x)
+    expected = x @ w.T
+    assert y.shape == expected.shape and y.dtype == np.float32
+    assert np.linalg.norm(y - expected) / np.linalg.norm(expected) < tolerance
+
+
+@pytest.mark.parametrize("mode", ["int8", "int4"])
+def test_quantized_linear_matches_dequantized(layer, mode):
+    w, x = layer
+    quantized = quantize.quantize_tensor("wo.weight", w, mode)
+    weight, scales = quantized["wo.weight"], quantized["wo.scales"]
+    y = QuantizedLinear(weight, scales)(x)
+    np.testing.assert_allclose(y, x @ quantize.dequantize(weight, scales).T, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,124 @@
+import http.client
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import modules.summarizer as summarizer
+from modules.server import LocalSummarizer, ServerTimeout, SummarizerClient, SummaryServer
+
+
+@pytest.fixture
+def server(tiny_model):
+    server = SummaryServer(("127.0.0.1", 0))
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    return SummarizerClient(f"http://127.0.0.1:{server.server_port}", timeout=30)
+
+
+def _wait_for(condition, seconds=10.0):
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_local_summarizer(tiny_model):
+    local = LocalSummarizer()
+    stream = local.stream("the insurance letter from acme")
+    assert "".join(stream) == stream.text and stream.summary is not None
+    assert float(local.embed(["the insurance letter from acme"])[0] @ stream.embedding) > 0.999
+
+
+def test_summary_and_embedding_match_local(client):
+    local = LocalSummarizer().stream("a water bill for march")
+    list(local)
+    remote = client.stream("a water bill for march")
+    assert "".join(remote) == local.text
+    assert remote.summary == local.summary
+    np.testing.assert_allclose(remote.embedding, local.embedding, atol=1e-6)
+    np.testing.assert_allclose(client.embed(["a query"]), LocalSummarizer().embed(["a query"]), atol=1e-6)
+
+
+def test_hung_up_request_is_skipped_before_it_runs(server, client):
+    with summarizer._registry.inference:
+        running = threading.Thread(target=lambda: list(client.stream("first in line")))
+        running.start()
+        _wait_for(lambda: server.stats()["running"] == "summarize")
+
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+        connection.request("POST", "/summarize", '{"text": "given up on"}', {"Content-Type": "application/json"})
+        assert connection.getresponse().status == 200
+        _wait_for(lambda: server.stats()["queued"] == 1)
+        connection.close()
+        time.sleep(1.5)  # a few of the handler's polls
+    running.join()
+    _wait_for(lambda: server.stats()["queued"] == 0 and server.stats()["running"] is None)
+    stats = server.stats()
+    assert stats["completed"] == 1 and stats["cancelled"] == 1
+
+
+def test_cancelled_stream_stops_between_decode_steps(tiny_model, monkeypatch):
+    monkeypatch.setattr(summarizer.SummaryStream, "max_tokens", 64)
+    steps = []
+    stream = LocalSummarizer().stream("a long letter", cancelled=lambda: len(steps) >= 2)
+    for delta in stream:
+        steps.append(delta)
+    assert stream.summary is None
+    assert stream.tokens <= 2 * stream.sync_every
+
+
+def test_client_stream_cancels_on_the_server(server, client, monkeypatch):
+    monkeypatch.setattr(summarizer.SummaryStream, "max_tokens", 200)
+    deltas = []
+    stream = client.stream("a long letter", cancelled=lambda: len(deltas) >= 1)
+    for delta in stream:
+        deltas.append(delta)
+    assert stream.summary is None
+    _wait_for(lambda: server.stats()["cancelled"] == 1)
+
+
+def test_timeout_is_its_own_error():
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen()
+    try:
+        client = SummarizerClient(f"http://127.0.0.1:{silent.getsockname()[1]}", timeout=0.3)
+        with pytest.raises(ServerTimeout):
+            client.embed(["anything"])
+    finally:
+        silent.close()
+
+
+def test_server_hanging_up_mid_stream_is_a_connection_error():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def one_delta_then_die():
+        connection, _ = listener.accept()
+        with connection:
+            connection.recv(65536)
+            connection.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: application/x-ndjson\r\n\r\n{"delta": " w1"}\n')
+
+    dying = threading.Thread(target=one_delta_then_die)
+    dying.start()
+    try:
+        client = SummarizerClient(f"http://127.0.0.1:{listener.getsockname()[1]}", timeout=5)
+        stream = client.stream("a letter")
+        deltas = []
+        with pytest.raises(ConnectionError):
+            for delta in stream:
+                deltas.append(delta)
+        assert deltas == [" w1"] and stream.summary is None
+    finally:
+        dying.join()
+        listener.close()
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pytest
+
+from modules.shards import ShardedWeights, ShardWriter, is_sharded, weights_nbytes
+
+
+def test_round_trip(tmp_path):
+    tensors = {"a": np.arange(10, dtype=np.float32), "b": np.ones((3, 5), np.int8)}
+    with ShardWriter(str(tmp_path), shard_size=48) as writer:
+        for name, array in tensors.items():
+            writer.add(name, array)
+    weights = ShardedWeights(str(tmp_path))
+    assert sorted(weights) == ["a", "b"]
+    for name, array in tensors.items():
+        np.testing.assert_array_equal(weights[name], array)
+
+
+def test_interrupted_conversion_leaves_no_index(tmp_path):
+    with pytest.raises(KeyboardInterrupt):
+        with ShardWriter(str(tmp_path), shard_size=48) as writer:
+            writer.add("a", np.arange(10, dtype=np.float32))
+            writer.add("b", np.arange(10, dtype=np.float32))
+            raise KeyboardInterrupt
+    assert not is_sharded(str(tmp_path))
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".bin")]
+
+
+def test_rewrite_drops_the_old_index_until_closed(tmp_path):
+    with ShardWriter(str(tmp_path)) as writer:
+        writer.add("a", np.zeros(4, np.float32))
+    writer = ShardWriter(str(tmp_path))
+    assert not is_sharded(str(tmp_path))
+    writer.abort()
+
+
+def test_smaller_rewrite_leaves_no_old_shards(tmp_path):
+    with ShardWriter(str(tmp_path), shard_size=48) as writer:
+        for name in "abc":
+            writer.add(name, np.arange(10, dtype=np.float32))
+    with ShardWriter(str(tmp_path), shard_size=48) as writer:
+        writer.add("a", np.arange(10, dtype=np.float32))
+    assert sorted(f for f in os.listdir(tmp_path) if f.endswith(".bin")) == ["shard-00000.bin"]
+    assert weights_nbytes(str(tmp_path)) == 40
@@ -0,0 +1,75 @@
+import multiprocessing
+import sqlite3
+
+import numpy as np
+
+from modules.store import MetadataStore
+
+
+def _hex(value):
+    return f"{value:016x}"
+
+
+def test_near_duplicates_match_a_full_scan(tmp_path):
+    rng = np.random.default_rng(0)
+    store = MetadataStore(str(tmp_path / "metadata.db"))
+    target = int(rng.integers(0, 2 ** 63))
+    hashes = []
+    for i in range(300):
+        if i % 3:
+            value = int(rng.integers(0, 2 ** 63))
+        else:
+            # flip up to 9 bits of the target, spread over every band
+            value = target
+            for bit in rng.choice(64, int(rng.integers(0, 10)), replace=False):
+                value ^= 1 << int(bit)
+        hashes.append(value)
+        store.add({"uuid": f"doc-{i}", "sha256": f"sha-{i}", "dhash": _hex(value)})
+    store.add({"uuid": "no-dhash", "sha256": "sha-none"})
+
+    for max_distance in (0, 3, 6, 9):
+        expected = [
+            f"doc-{i}" for i, value in enumerate(hashes)
+            if (value ^ target).bit_count() <= max_distance
+        ]
+        assert store.near_duplicates(_hex(target), "sha-query", max_distance) == expected
+    assert "doc-0" not in store.near_duplicates(_hex(hashes[0]), "sha-0")
+
+
+def test_bands_added_to_an_old_store(tmp_path):
+    path = str(tmp_path / "metadata.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE documents (id INTEGER PRIMARY KEY, uuid TEXT NOT NULL UNIQUE, upload_time TEXT, data TEXT NOT NULL);
+        CREATE TABLE hashes (doc_id INTEGER NOT NULL, sha256 TEXT NOT NULL, dhash TEXT);
+        INSERT INTO documents (id, uuid, data) VALUES (1, 'old', '{}');
+        INSERT INTO hashes VALUES (1, 'sha-old', '00ff00ff00ff00ff');
+    """)
+    conn.commit()
+    conn.close()
+
+    store = MetadataStore(path)
+    assert store.near_duplicates("00ff00ff00ff00fe", "sha-new") == ["old"]
+    assert MetadataStore(path).near_duplicates("00ff00ff00ff00ff", "sha-new") == ["old"]
+
+
+def _update_fields(path, prefix, count):
+    store = MetadataStore(path)
+    for i in range(count):
+        store.update("doc", **{f"{prefix}-{i}": i})
+
+
+def test_updates_from_two_processes(tmp_path):
+    path = str(tmp_path / "metadata.db")
+    MetadataStore(path).add({"uuid": "doc", "sha256": "sha"})
+    workers = [
+        multiprocessing.Process(target=_update_fields, args=(path, prefix, 200))
+        for prefix in ("app", "cli")
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    data = MetadataStore(path).get("doc")
+    assert all(f"{prefix}-{i}" in data for prefix in ("app", "cli") for i in range(200))
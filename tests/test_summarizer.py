@@ -0,0 +1,93 @@
+import threading
+
+import numpy as np
+
+import modules.summarizer as summarizer
+
+
+def test_embeddings_match_the_stream(tiny_model):
+    stream = summarizer.SummaryStream("the insurance letter from acme")
+    deltas = list(stream)
+    assert "".join(deltas) == stream.text
+    embedding = summarizer.embed(["the insurance letter from acme"])[0]
+    assert float(embedding @ stream.embedding) > 0.999
+
+
+def test_embedding_waits_for_a_decode_step(tiny_model):
+    done = threading.Event()
+    worker = threading.Thread(target=lambda: (summarizer.embed(["a query"]), done.set()))
+    with summarizer._registry.inference:
+        worker.start()
+        assert not done.wait(0.2)
+    assert done.wait(10)
+    worker.join()
+
+
+def test_concurrent_streams_and_embeddings(tiny_model):
+    texts = [f"statement {i} from the bank" for i in range(6)]
+    expected = summarizer.embed(texts)
+    found, errors = {}, []
+
+    def summarize():
+        try:
+            for text in texts:
+                stream = summarizer.SummaryStream(text)
+                list(stream)
+                found[text] = stream.embedding
+        except Exception as e:
+            errors.append(e)
+
+    def query():
+        try:
+            for _ in range(20):
+                np.testing.assert_allclose(summarizer.embed(texts[:2]), expected[:2], atol=1e-5)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=summarize), threading.Thread(target=query)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    np.testing.assert_allclose(np.stack([found[t] for t in texts]), expected, atol=1e-5)
+
+
+def test_embedding_runs_between_condensed_batches(tiny_model, monkeypatch):
+    _, tokenizer = tiny_model
+    pad_batch = type(tokenizer).pad_batch
+    summarizing = threading.current_thread()
+    done = threading.Event()
+    worker = threading.Thread(target=lambda: (summarizer.embed(["a query"]), done.set()))
+    waited = []
+
+    def pad_and_embed(self, windows):
+        # before a batch of windows, the summary shouldn't hold the model
+        if threading.current_thread() is summarizing and not waited:
+            worker.start()
+            waited.append(done.wait(5))
+        return pad_batch(self, windows)
+
+    monkeypatch.setattr(type(tokenizer), "pad_batch", pad_and_embed)
+    stream = summarizer.SummaryStream(" ".join(f"word{i}" for i in range(1200)), batch_size=1)
+    list(stream)
+    worker.join()
+    assert stream.chunked and waited == [True]
+
+
+def test_library_functions_print_nothing(tiny_model, capsys):
+    assert summarizer.summarize("a water bill for march") is not None
+    assert len(summarizer.summarize_batch(["a water bill", "a bank statement"])) == 2
+    assert capsys.readouterr().out == ""
+
+
+def test_batch_uses_the_stream_settings(tiny_model, monkeypatch):
+    monkeypatch.setattr(summarizer.SummaryStream, "max_tokens", 3)
+    summaries = summarizer.summarize_batch(["a water bill", "a bank statement"])
+    assert all(0 < len(s.split()) <= 3 for s in summaries)
+
+
+def test_empty_batch(tiny_model):
+    assert summarizer.summarize_batch([]) == []
+    summaries, embeddings = summarizer.summarize_batch([], return_embeddings=True)
+    assert summaries == [] and len(embeddings) == 0
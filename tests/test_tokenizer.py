@@ -0,0 +1,17 @@
+import pytest
+
+
+def test_windows_overlap(tiny_model):
+    _, tokenizer = tiny_model
+    text = " ".join(f"word{i}" for i in range(25))
+    windows = list(tokenizer.iter_windows(text, 10, 3, words_per_piece=4))
+    assert [len(w) for w in windows] == [10, 10, 10, 4]
+    assert all(a[-3:] == b[:3] for a, b in zip(windows, windows[1:]))
+    assert tokenizer.ids(text) == windows[0] + [t for w in windows[1:] for t in w[3:]]
+
+
+@pytest.mark.parametrize("overlap", [-1, 10, 11])
+def test_overlap_must_be_less_than_the_window(tiny_model, overlap):
+    _, tokenizer = tiny_model
+    with pytest.raises(ValueError):
+        tokenizer.iter_windows("a few words", 10, overlap)
@@ -0,0 +1,78 @@
+import multiprocessing
+
+import numpy as np
+
+from modules.vectors import VectorIndex, normalize
+
+
+def _vectors(seed, n, dim=16):
+    return normalize(np.random.default_rng(seed).normal(size=(n, dim)))
+
+
+def _nearest(index, vector):
+    return index.search(vector, 1, probe=0)[0][0]
+
+
+def test_round_trip(tmp_path):
+    rows = _vectors(0, 30)
+    index = VectorIndex(str(tmp_path), compact_every=7)
+    index.add_many((f"doc-{i}", row) for i, row in enumerate(rows))
+    for i in range(10):
+        index.remove(f"doc-{i}")
+    index.add("doc-12", rows[0])
+    index.compact()
+    reopened = VectorIndex(str(tmp_path))
+    assert len(reopened) == 20
+    assert _nearest(reopened, rows[0]) == "doc-12"
+    assert _nearest(reopened, rows[25]) == "doc-25"
+
+
+def test_two_writers_keep_each_others_rows(tmp_path):
+    rows = _vectors(1, 40)
+    first = VectorIndex(str(tmp_path), compact_every=6)
+    second = VectorIndex(str(tmp_path), compact_every=6)
+    for i, row in enumerate(rows):
+        (first if i % 2 else second).add(f"doc-{i}", row)
+        if i % 9 == 0:
+            (second if i % 2 else first).compact()
+    first.remove("doc-5")
+
+    for index in (first, second, VectorIndex(str(tmp_path))):
+        assert len(index) == 39
+        for i, row in enumerate(rows):
+            if i != 5:
+                assert _nearest(index, row) == f"doc-{i}"
+
+
+def test_clusters_follow_other_writers(tmp_path):
+    rows = _vectors(2, 120)
+    reader = VectorIndex(str(tmp_path), ivf_min_rows=50, probe=4)
+    writer = VectorIndex(str(tmp_path), ivf_min_rows=50, probe=4)
+    writer.add_many((f"doc-{i}", row) for i, row in enumerate(rows[:60]))
+    reader.add_many((f"doc-{i}", row) for i, row in enumerate(rows[60:], 60))
+    assert writer.search(rows[100], 1) == reader.search(rows[100], 1)
+    assert reader.search(rows[10], 1)[0][0] == "doc-10"
+
+
+def _add_vectors(path, seed, prefix, count):
+    index = VectorIndex(path, compact_every=5)
+    for i, row in enumerate(_vectors(seed, count)):
+        index.add(f"{prefix}-{i}", row)
+    index.compact()
+
+
+def test_writer_processes(tmp_path):
+    workers = [
+        multiprocessing.Process(target=_add_vectors, args=(str(tmp_path), seed, prefix, 30))
+        for seed, prefix in ((3, "app"), (4, "cli"))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    index = VectorIndex(str(tmp_path))
+    assert len(index) == 60
+    for seed, prefix in ((3, "app"), (4, "cli")):
+        for i, row in enumerate(_vectors(seed, 30)):
+            assert _nearest(index, row) == f"{prefix}-{i}"